@@ -1,17 +1,53 @@
 import os
 import json
+import asyncio
+import contextlib
+import contextvars
+import functools
+import random
 import uuid
 import time
-from typing import Any, Dict, List, Optional, Tuple
-
+import sqlite3
+import base64
+import codecs
+import bisect
+import copy
+import difflib
+import hashlib
+import heapq
+import itertools
+import re
+import threading
+import weakref
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 import anyio
 
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # optional: without watchdog the index reconciles on WORKSPACE_INDEX_TTL
+    FileSystemEventHandler = object
+    Observer = None
+
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+except ImportError:  # optional: without scikit-learn the classifier fast path runs on rules only
+    make_pipeline = None
+
 load_dotenv()
 
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY", "").strip()
@@ -23,8 +59,58 @@ PREVIEW_DIR = os.path.join(WORKSPACE_DIR, "preview")
 RUNS_DIR = os.path.join(WORKSPACE_DIR, "runs")
 PROJECTS_DIR = os.path.join(WORKSPACE_DIR, "projects")
 RUNTIME_MEMORY_PATH = os.path.join(WORKSPACE_DIR, "project_memory.json")
+RUNTIME_DB_PATH = os.path.join(WORKSPACE_DIR, "runtime.db")
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "sqlite").strip().lower()
 RUNTIME_PERMISSIONS_PATH = os.path.join(WORKSPACE_DIR, "permissions_runtime.json")
 MISTRAL_REASONING_MODEL = os.getenv("MISTRAL_REASONING_MODEL", "").strip()
+MISTRAL_TIMEOUT = float(os.getenv("MISTRAL_TIMEOUT", "120"))
+MISTRAL_MAX_CONNECTIONS = int(os.getenv("MISTRAL_MAX_CONNECTIONS", "20"))
+MISTRAL_KEEPALIVE_EXPIRY = float(os.getenv("MISTRAL_KEEPALIVE_EXPIRY", "30"))
+MISTRAL_MAX_RETRIES = int(os.getenv("MISTRAL_MAX_RETRIES", "4"))
+MISTRAL_BACKOFF_BASE = float(os.getenv("MISTRAL_BACKOFF_BASE", "0.5"))
+MISTRAL_BACKOFF_MAX = float(os.getenv("MISTRAL_BACKOFF_MAX", "30"))
+MISTRAL_RETRY_BUDGET = float(os.getenv("MISTRAL_RETRY_BUDGET", "180"))
+LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "").strip()  # JSON list of {name, base_url, api_key, weight, models, rpm, tpm}
+MISTRAL_API_KEYS = os.getenv("MISTRAL_API_KEYS", "").strip()  # comma-separated, spread over MISTRAL_API_URL
+LLM_BALANCE = os.getenv("LLM_BALANCE", "least_outstanding").strip()  # or "weighted_round_robin"
+LLM_MODEL_ROUTES = os.getenv("LLM_MODEL_ROUTES", "").strip()  # JSON {call site: model}
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "3"))
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))
+LLM_HEALTH_INTERVAL = float(os.getenv("LLM_HEALTH_INTERVAL", "0"))
+MISTRAL_RPM = float(os.getenv("MISTRAL_RPM", "0"))  # requests/min per API key, 0 = unlimited
+MISTRAL_TPM = float(os.getenv("MISTRAL_TPM", "0"))  # tokens/min per API key, 0 = unlimited
+WORKFLOW_TOOL_CONCURRENCY = int(os.getenv("WORKFLOW_TOOL_CONCURRENCY", "8"))
+WORKFLOW_EVENTS_MAX = 2000
+EVENT_FLUSH_EVENTS = int(os.getenv("WORKFLOW_EVENT_FLUSH_EVENTS", "64"))
+EVENT_FLUSH_SECONDS = float(os.getenv("WORKFLOW_EVENT_FLUSH_SECONDS", "1.0"))
+TRACE_CACHE_MAX_TRACES = int(os.getenv("WORKFLOW_TRACE_CACHE_MAX_TRACES", "200"))
+TRACE_CACHE_MAX_BYTES = int(os.getenv("WORKFLOW_TRACE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TRACE_CACHE_TTL = float(os.getenv("WORKFLOW_TRACE_CACHE_TTL", "3600"))
+WORKSPACE_INDEX_TTL = float(os.getenv("WORKSPACE_INDEX_TTL", "5"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "").strip()
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "128"))
+DESCRIBE_VISUALS_EAGER = os.getenv("DESCRIBE_VISUALS_EAGER", "0").strip() in ("1", "true", "yes")
+WORKFLOW_WORKERS = int(os.getenv("WORKFLOW_WORKERS", "4"))
+WORKFLOW_JOB_MAX_ATTEMPTS = int(os.getenv("WORKFLOW_JOB_MAX_ATTEMPTS", "3"))
+WORKFLOW_JOB_LEASE = float(os.getenv("WORKFLOW_JOB_LEASE", "60"))  # seconds without a heartbeat before a running job is presumed dead
+POSTPROCESS_CONCURRENCY = int(os.getenv("POSTPROCESS_CONCURRENCY", "2"))
+POSTPROCESS_RETRIES = int(os.getenv("POSTPROCESS_RETRIES", "2"))
+POSTPROCESS_RETRY_DELAY = float(os.getenv("POSTPROCESS_RETRY_DELAY", "2"))
+READ_FILE_MAX_CHARS = int(os.getenv("READ_FILE_MAX_CHARS", "200000"))
+READ_FILE_TOOL_MAX_CHARS = int(os.getenv("READ_FILE_TOOL_MAX_CHARS", "40000"))
+READ_FILE_DEFAULT_LINES = int(os.getenv("READ_FILE_DEFAULT_LINES", "400"))
+READ_GREP_MAX_MATCHES = int(os.getenv("READ_GREP_MAX_MATCHES", "100"))
+PATCH_FUZZY_THRESHOLD = float(os.getenv("PATCH_FUZZY_THRESHOLD", "0.85"))
+WORKFLOW_CONTEXT_TOKENS = int(os.getenv("WORKFLOW_CONTEXT_TOKENS", "32000"))
+WORKFLOW_CONTEXT_KEEP_RECENT = int(os.getenv("WORKFLOW_CONTEXT_KEEP_RECENT", "8"))
+FAST_CLASSIFIER = os.getenv("FAST_CLASSIFIER", "1").strip() not in ("0", "false", "no")
+FAST_CLASSIFIER_THRESHOLD = float(os.getenv("FAST_CLASSIFIER_THRESHOLD", "0.9"))
+FAST_CLASSIFIER_SHADOW_RATE = float(os.getenv("FAST_CLASSIFIER_SHADOW_RATE", "0.05"))  # share of local answers re-checked by the LLM
+FAST_CLASSIFIER_MIN_SAMPLES = int(os.getenv("FAST_CLASSIFIER_MIN_SAMPLES", "50"))
+SPECULATIVE_PLAN = os.getenv("SPECULATIVE_PLAN", "0").strip() in ("1", "true", "yes")
+WORKSPACE_WATCH = os.getenv("WORKSPACE_WATCH", "1").strip() not in ("0", "false", "no")
 
 class OrchestratorState(BaseModel):
     pending_execution: bool = False
@@ -33,17 +119,10 @@ class OrchestratorState(BaseModel):
     updated_at: float = Field(default_factory=time.time)
 
 def _load_state(project_id: str) -> OrchestratorState:
-    mem = _read_runtime_memory()
-    projects = mem.get("projects", {})
-    proj = projects.get(project_id, {})
-    return OrchestratorState(**proj.get("state", {}))
+    return OrchestratorState(**(MEMORY_STORE.get_field(project_id, "state") or {}))
 
 def _save_state(project_id: str, state: OrchestratorState) -> None:
-    mem = _read_runtime_memory()
-    projects = mem.setdefault("projects", {})
-    projects[project_id] = projects.get(project_id, {})
-    projects[project_id]["state"] = state.dict()
-    _write_runtime_memory(mem)
+    MEMORY_STORE.set_field(project_id, "state", state.dict())
 
 SYSTEM_DIR = os.path.join(BASE_DIR, "system")
 
@@ -130,79 +209,328 @@ def _resolve_path(project_id: str, rel_path: str) -> str:
     root = _project_root(project_id)
     return os.path.normpath(os.path.join(root, rel_path))
 
+DEFAULT_PERMISSIONS = {"self_modify": False, "file_write": True, "shell": False, "web": False}
+
+# permissions_runtime.json is cached in-process and re-read only when its stat signature
+# changes (another worker wrote it). Reads never write; _set_project_permissions writes through.
+_PERMISSIONS_LOCK = threading.Lock()
+_PERMISSIONS_CACHE: Dict[str, Any] = {"sig": None, "data": None}
+
+def _permissions_signature() -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(RUNTIME_PERMISSIONS_PATH)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _cached_runtime_permissions() -> Dict[str, Any]:
+    sig = _permissions_signature()
+    with _PERMISSIONS_LOCK:
+        if _PERMISSIONS_CACHE["data"] is None or _PERMISSIONS_CACHE["sig"] != sig:
+            _PERMISSIONS_CACHE["data"] = _read_runtime_permissions()
+            _PERMISSIONS_CACHE["sig"] = sig
+        return _PERMISSIONS_CACHE["data"]
+
 def _get_project_permissions(project_id: str) -> Dict[str, Any]:
-    mem = _read_runtime_permissions()
-    projects = mem.setdefault("projects", {})
-    perms = projects.setdefault(project_id, {
-        "self_modify": False,
-        "file_write": True,
-        "shell": False,
-        "web": False,
-    })
-    _write_runtime_permissions(mem)
+    perms = dict(DEFAULT_PERMISSIONS)
+    perms.update((_cached_runtime_permissions().get("projects") or {}).get(project_id) or {})
     return perms
 
 def _set_project_permissions(project_id: str, perms: Dict[str, Any]) -> Dict[str, Any]:
-    mem = _read_runtime_permissions()
-    projects = mem.setdefault("projects", {})
-    current = projects.setdefault(project_id, {})
-    for k in ("self_modify", "file_write", "shell", "web"):
-        if k in perms:
-            current[k] = bool(perms[k])
-    for k, v in {"self_modify": False, "file_write": True, "shell": False, "web": False}.items():
-        current.setdefault(k, v)
-    _write_runtime_permissions(mem)
-    return current
+    with _PERMISSIONS_LOCK:
+        mem = _read_runtime_permissions()
+        projects = mem.setdefault("projects", {})
+        current = projects.setdefault(project_id, {})
+        for k in DEFAULT_PERMISSIONS:
+            if k in perms:
+                current[k] = bool(perms[k])
+        for k, v in DEFAULT_PERMISSIONS.items():
+            current.setdefault(k, v)
+        _write_runtime_permissions(mem)
+        _PERMISSIONS_CACHE["data"] = mem
+        _PERMISSIONS_CACHE["sig"] = _permissions_signature()
+        return dict(current)
 
 WorkflowKey = Tuple[str, str]
-WORKFLOW_EVENTS: Dict[WorkflowKey, List[Dict[str, Any]]] = {}
-WORKFLOW_AGENTS: Dict[WorkflowKey, Dict[str, Dict[str, Any]]] = {}
+WORKFLOW_SUBSCRIBERS: Dict[WorkflowKey, List[Tuple[asyncio.Queue, asyncio.AbstractEventLoop]]] = {}
+LIVE_TRACES: set = set()
+
+class _TraceCache:
+    """LRU + TTL cache of per-trace events/agents, bounded by trace count and approximate bytes.
+
+    Keys in `pinned` (live runs) are never evicted; call enforce() once they are released.
+    Appends only sweep for expired traces every `sweep_interval` seconds; lookups expire lazily.
+    """
+
+    def __init__(self, max_traces: int, max_bytes: int, ttl: float, pinned: set):
+        self.max_traces = max_traces
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.pinned = pinned
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.sweep_interval = max(1.0, min(ttl, 60.0))
+        self._swept = time.monotonic()
+        self._entries: "OrderedDict[WorkflowKey, Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.RLock()
+
+    def _new_entry(self) -> Dict[str, Any]:
+        return {
+            "events": deque(maxlen=WORKFLOW_EVENTS_MAX),
+            "sizes": deque(maxlen=WORKFLOW_EVENTS_MAX),
+            "agents": {},
+            "seq": 0,
+            "bytes": 0,
+            "touched": time.monotonic(),
+        }
+
+    def _expired(self, key: WorkflowKey, entry: Dict[str, Any]) -> bool:
+        return key not in self.pinned and time.monotonic() - entry["touched"] > self.ttl
+
+    def _drop_locked(self, key: WorkflowKey) -> None:
+        entry = self._entries.pop(key)
+        self.bytes -= entry["bytes"]
+        self.evictions += 1
+
+    def lookup(self, key: WorkflowKey) -> Optional[Dict[str, Any]]:
+        """Counted lookup: a miss means the caller has to go to disk."""
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(key, entry):
+                self._drop_locked(key)
+                entry = None
+            if entry is None or not entry["events"]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["touched"] = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry
+
+    def peek(self, key: WorkflowKey) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return self._entries.get(key)
+
+    def entry(self, key: WorkflowKey) -> Dict[str, Any]:
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = self._new_entry()
+            entry["touched"] = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry
+
+    def add_event(self, key: WorkflowKey, ev: Dict[str, Any], size: int) -> Dict[str, Any]:
+        with self.lock:
+            entry = self.entry(key)
+            entry["seq"] = max(entry["seq"], int(ev.get("seq") or 0))
+            if len(entry["sizes"]) == entry["sizes"].maxlen:
+                entry["bytes"] -= entry["sizes"][0]
+                self.bytes -= entry["sizes"][0]
+            entry["events"].append(ev)
+            entry["sizes"].append(size)
+            entry["bytes"] += size
+            self.bytes += size
+            if time.monotonic() - self._swept >= self.sweep_interval:
+                self._sweep_locked(keep=key)
+            self._evict_locked(keep=key)
+            return entry
+
+    def load(self, key: WorkflowKey, events: Iterable[Tuple[Dict[str, Any], int]],
+             agents: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """Bulk-insert a trace read from disk, then enforce the bounds once without evicting it."""
+        with self.lock:
+            entry = self.entry(key)
+            if not entry["events"]:  # a live run may have filled it meanwhile
+                for ev, size in events:
+                    entry["seq"] = max(entry["seq"], int(ev.get("seq") or 0))
+                    entry["events"].append(ev)
+                    entry["sizes"].append(size)
+                entry["bytes"] = sum(entry["sizes"])
+                self.bytes += entry["bytes"]
+            for name, a in agents.items():
+                entry["agents"].setdefault(name, a)
+            self._sweep_locked(keep=key)
+            self._evict_locked(keep=key)
+            return entry
+
+    def enforce(self) -> None:
+        with self.lock:
+            self._sweep_locked()
+            self._evict_locked()
+
+    def _sweep_locked(self, keep: Optional[WorkflowKey] = None) -> None:
+        self._swept = time.monotonic()
+        for key in [k for k, e in self._entries.items() if k != keep and self._expired(k, e)]:
+            self._drop_locked(key)
+
+    def _evict_locked(self, keep: Optional[WorkflowKey] = None) -> None:
+        while len(self._entries) > self.max_traces or self.bytes > self.max_bytes:
+            victim = next((k for k in self._entries if k not in self.pinned and k != keep), None)
+            if victim is None:
+                break
+            self._drop_locked(victim)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "traces": len(self._entries),
+                "pinned": sum(1 for k in self._entries if k in self.pinned),
+                "bytes": self.bytes,
+                "max_traces": self.max_traces,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+TRACE_CACHE = _TraceCache(TRACE_CACHE_MAX_TRACES, TRACE_CACHE_MAX_BYTES, TRACE_CACHE_TTL, LIVE_TRACES)
+
+def _subscribe(project_id: str, trace_id: str) -> asyncio.Queue:
+    queue: asyncio.Queue = asyncio.Queue()
+    WORKFLOW_SUBSCRIBERS.setdefault((project_id, trace_id), []).append((queue, asyncio.get_running_loop()))
+    return queue
+
+def _unsubscribe(project_id: str, trace_id: str, queue: asyncio.Queue) -> None:
+    key = (project_id, trace_id)
+    subs = [s for s in WORKFLOW_SUBSCRIBERS.get(key, []) if s[0] is not queue]
+    if subs:
+        WORKFLOW_SUBSCRIBERS[key] = subs
+    else:
+        WORKFLOW_SUBSCRIBERS.pop(key, None)
+
+def _publish(project_id: str, trace_id: str, record: Dict[str, Any]) -> None:
+    for queue, loop in list(WORKFLOW_SUBSCRIBERS.get((project_id, trace_id), [])):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, record)
+        except RuntimeError:
+            pass
+
+class _EventSink:
+    """Buffered appender for one trace's workflow_events.jsonl; the handle stays open while the run is live."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lines: List[str] = []
+        self.handle: Any = None
+        self.last_flush = time.monotonic()
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+
+    def write(self, line: str) -> None:
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= EVENT_FLUSH_EVENTS or time.monotonic() - self.last_flush >= EVENT_FLUSH_SECONDS:
+                self._flush_locked()
+            elif not self.flush_scheduled:
+                self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        """Bound how long buffered events wait on disk when the run goes quiet."""
+        self.flush_scheduled = True
+        try:
+            asyncio.get_running_loop().call_later(EVENT_FLUSH_SECONDS, self.flush)
+        except RuntimeError:  # written from a worker thread
+            timer = threading.Timer(EVENT_FLUSH_SECONDS, self.flush)
+            timer.daemon = True
+            timer.start()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        self.last_flush = time.monotonic()
+        self.flush_scheduled = False
+        if not self.lines:
+            return
+        try:
+            if self.handle is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.handle = open(self.path, "a", encoding="utf-8")
+            self.handle.write("".join(self.lines))
+            self.handle.flush()
+        except Exception:
+            pass
+        self.lines.clear()
+
+    def close(self) -> None:
+        with self.lock:
+            self._flush_locked()
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+EVENT_SINKS: Dict[WorkflowKey, _EventSink] = {}
+_EVENT_SINKS_LOCK = threading.Lock()
+
+def _event_sink(project_id: str, trace_id: str) -> _EventSink:
+    key = (project_id, trace_id)
+    with _EVENT_SINKS_LOCK:
+        sink = EVENT_SINKS.get(key)
+        if sink is None:
+            sink = EVENT_SINKS[key] = _EventSink(os.path.join(RUNS_DIR, project_id, trace_id, "workflow_events.jsonl"))
+        return sink
+
+def _close_event_sink(project_id: str, trace_id: str) -> None:
+    with _EVENT_SINKS_LOCK:
+        sink = EVENT_SINKS.pop((project_id, trace_id), None)
+    if sink is not None:
+        sink.close()
 
 def _emit_event(project_id: str, trace_id: str, agent: str, text: str, *,
                kind: str = "info", level: str = "info", mission: Optional[str] = None,
                status: Optional[str] = None) -> None:
     key = (project_id, trace_id)
-    ts = time.time() * 1000.0
-    ev = {"ts": ts, "agent": agent, "text": text, "kind": kind, "level": level}
-    WORKFLOW_EVENTS.setdefault(key, []).append(ev)
-    if len(WORKFLOW_EVENTS[key]) > 2000:
-        WORKFLOW_EVENTS[key] = WORKFLOW_EVENTS[key][-2000:]
-
-    agents = WORKFLOW_AGENTS.setdefault(key, {})
-    a = agents.setdefault(agent, {"name": agent, "status": "Idle", "mission": ""})
+    if key not in LIVE_TRACES and TRACE_CACHE.peek(key) is None:
+        # Cold trace: resume its sequence numbers from disk.
+        _load_events_from_disk(project_id, trace_id)
+    with TRACE_CACHE.lock:
+        seq = TRACE_CACHE.entry(key)["seq"] + 1
+        ev = {"seq": seq, "ts": time.time() * 1000.0, "agent": agent, "text": text, "kind": kind, "level": level}
+        line = json.dumps(ev, ensure_ascii=False) + "\n"
+        entry = TRACE_CACHE.add_event(key, ev, len(line))
+
+    a = entry["agents"].setdefault(agent, {"name": agent, "status": "Idle", "mission": ""})
     if mission is not None:
         a["mission"] = mission
     if status is not None:
         a["status"] = status
 
-    run_dir = os.path.join(RUNS_DIR, project_id, trace_id)
-    os.makedirs(run_dir, exist_ok=True)
-    path = os.path.join(run_dir, "workflow_events.jsonl")
-    try:
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(ev, ensure_ascii=False) + "\n")
-    except Exception:
-        pass
+    _publish(project_id, trace_id, {"type": "event", **ev})
+    if mission is not None or status is not None:
+        _publish(project_id, trace_id, {"type": "agent", **a})
+
+    _event_sink(project_id, trace_id).write(line)
+    if key not in LIVE_TRACES:
+        _close_event_sink(project_id, trace_id)
 
 def _load_events_from_disk(project_id: str, trace_id: str) -> None:
     key = (project_id, trace_id)
-    if key in WORKFLOW_EVENTS and WORKFLOW_EVENTS[key]:
+    if TRACE_CACHE.lookup(key) is not None:
         return
     run_dir = os.path.join(RUNS_DIR, project_id, trace_id)
     path = os.path.join(run_dir, "workflow_events.jsonl")
     if not os.path.exists(path):
         return
-    events: List[Dict[str, Any]] = []
+    loaded: "deque[Tuple[Dict[str, Any], int]]" = deque(maxlen=WORKFLOW_EVENTS_MAX)
     agents: Dict[str, Dict[str, Any]] = {}
+    seq = 0
     try:
         with open(path, "r", encoding="utf-8") as f:
             for line in f:
+                size = len(line)
                 line = line.strip()
                 if not line:
                     continue
                 try:
                     ev = json.loads(line)
-                    events.append(ev)
+                    seq = max(seq + 1, int(ev.get("seq") or 0))
+                    ev["seq"] = seq
+                    loaded.append((ev, size))
                     ag = ev.get("agent")
                     if ag and ag not in agents:
                         agents[ag] = {"name": ag, "status": "Idle", "mission": ""}
@@ -210,28 +538,566 @@ def _load_events_from_disk(project_id: str, trace_id: str) -> None:
                     continue
     except Exception:
         return
-    WORKFLOW_EVENTS[key] = events[-2000:]
-    WORKFLOW_AGENTS[key] = agents
+    TRACE_CACHE.load(key, loaded, agents)
 
-def _read_runtime_memory() -> Dict[str, Any]:
+def _read_runtime_memory(path: str = RUNTIME_MEMORY_PATH) -> Dict[str, Any]:
     try:
-        with open(RUNTIME_MEMORY_PATH, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception:
         return {"version": "1.0.0", "projects": {}}
 
-def _write_runtime_memory(mem: Dict[str, Any]) -> None:
-    tmp = RUNTIME_MEMORY_PATH + ".tmp"
+def _write_runtime_memory(mem: Dict[str, Any], path: str = RUNTIME_MEMORY_PATH) -> None:
+    tmp = path + ".tmp"
     with open(tmp, "w", encoding="utf-8") as f:
         json.dump(mem, f, indent=2, ensure_ascii=False)
-    os.replace(tmp, RUNTIME_MEMORY_PATH)
+    os.replace(tmp, path)
+
+def _sqlite_connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+class _SqliteStore:
+    """Base for stores in runtime.db: one connection per thread, explicit write transactions."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _sqlite_connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+class JsonMemoryStore:
+    """Legacy backend: the whole project_memory.json document is rewritten on every update."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+
+    def list_projects(self) -> List[str]:
+        return list(_read_runtime_memory(self.path).get("projects", {}).keys())
+
+    def ensure_project(self, project_id: str) -> None:
+        with self._lock:
+            mem = _read_runtime_memory(self.path)
+            if project_id not in mem.setdefault("projects", {}):
+                mem["projects"][project_id] = {}
+                _write_runtime_memory(mem, self.path)
+
+    def get_project(self, project_id: str) -> Dict[str, Any]:
+        return dict(_read_runtime_memory(self.path).get("projects", {}).get(project_id) or {})
+
+    def get_field(self, project_id: str, field: str, default: Any = None) -> Any:
+        return self.get_project(project_id).get(field, default)
+
+    def set_field(self, project_id: str, field: str, value: Any) -> None:
+        self.update_field(project_id, field, lambda _: value)
+
+    def update_field(self, project_id: str, field: str, fn: Callable[[Any], Any]) -> Any:
+        with self._lock:
+            mem = _read_runtime_memory(self.path)
+            bucket = mem.setdefault("projects", {}).setdefault(project_id, {})
+            bucket[field] = fn(bucket.get(field))
+            _write_runtime_memory(mem, self.path)
+            return bucket[field]
+
+    def export(self) -> Dict[str, Any]:
+        return _read_runtime_memory(self.path)
+
+class SqliteMemoryStore(_SqliteStore):
+    """Default backend: one row per (project, field) in runtime.db, updated in place."""
+
+    def __init__(self, path: str, legacy_json_path: Optional[str] = None):
+        super().__init__(path)
+        with self._tx() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS projects (project_id TEXT PRIMARY KEY, created_at REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS project_memory (project_id TEXT NOT NULL, field TEXT NOT NULL, "
+                "value TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (project_id, field))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_json_path:
+            self._migrate_from_json(legacy_json_path)
+
+    def _migrate_from_json(self, json_path: str) -> None:
+        with self._tx() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return
+            now = time.time()
+            for project_id, bucket in (_read_runtime_memory(json_path).get("projects") or {}).items():
+                conn.execute("INSERT OR IGNORE INTO projects VALUES (?, ?)", (project_id, now))
+                for field, value in (bucket or {}).items():
+                    conn.execute(
+                        "INSERT OR IGNORE INTO project_memory VALUES (?, ?, ?, ?)",
+                        (project_id, field, json.dumps(value, ensure_ascii=False), now),
+                    )
+            conn.execute("INSERT INTO meta VALUES ('json_migrated', ?)", (json_path,))
+
+    def list_projects(self) -> List[str]:
+        return [r[0] for r in self._conn().execute("SELECT project_id FROM projects ORDER BY project_id")]
+
+    def ensure_project(self, project_id: str) -> None:
+        with self._tx() as conn:
+            conn.execute("INSERT OR IGNORE INTO projects VALUES (?, ?)", (project_id, time.time()))
+
+    def get_project(self, project_id: str) -> Dict[str, Any]:
+        rows = self._conn().execute("SELECT field, value FROM project_memory WHERE project_id = ?", (project_id,))
+        return {field: json.loads(value) for field, value in rows}
+
+    def get_field(self, project_id: str, field: str, default: Any = None) -> Any:
+        row = self._conn().execute(
+            "SELECT value FROM project_memory WHERE project_id = ? AND field = ?", (project_id, field)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_field(self, project_id: str, field: str, value: Any) -> None:
+        self.update_field(project_id, field, lambda _: value)
+
+    def update_field(self, project_id: str, field: str, fn: Callable[[Any], Any]) -> Any:
+        with self._tx() as conn:
+            row = conn.execute(
+                "SELECT value FROM project_memory WHERE project_id = ? AND field = ?", (project_id, field)
+            ).fetchone()
+            value = fn(json.loads(row[0]) if row else None)
+            now = time.time()
+            conn.execute("INSERT OR IGNORE INTO projects VALUES (?, ?)", (project_id, now))
+            conn.execute(
+                "INSERT INTO project_memory VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(project_id, field) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (project_id, field, json.dumps(value, ensure_ascii=False), now),
+            )
+            return value
+
+    def export(self) -> Dict[str, Any]:
+        projects: Dict[str, Dict[str, Any]] = {pid: {} for pid in self.list_projects()}
+        for project_id, field, value in self._conn().execute("SELECT project_id, field, value FROM project_memory"):
+            projects.setdefault(project_id, {})[field] = json.loads(value)
+        return {"version": "1.0.0", "projects": projects}
+
+def _make_memory_store() -> Any:
+    if MEMORY_BACKEND == "json":
+        return JsonMemoryStore(RUNTIME_MEMORY_PATH)
+    if MEMORY_BACKEND != "sqlite":
+        raise RuntimeError(f"Unknown MEMORY_BACKEND: {MEMORY_BACKEND!r} (expected 'sqlite' or 'json')")
+    return SqliteMemoryStore(RUNTIME_DB_PATH, legacy_json_path=RUNTIME_MEMORY_PATH)
+
+MEMORY_STORE = _make_memory_store()
+
+def _export_runtime_memory() -> Dict[str, Any]:
+    mem = MEMORY_STORE.export()
+    if not isinstance(MEMORY_STORE, JsonMemoryStore):
+        _write_runtime_memory(mem)
+    return mem
 
 def _project_bucket(project_id: str) -> Dict[str, Any]:
-    mem = _read_runtime_memory()
-    projects = mem.setdefault("projects", {})
-    bucket = projects.setdefault(project_id, {"runs": [], "notes": []})
-    _write_runtime_memory(mem)
-    return bucket
+    MEMORY_STORE.ensure_project(project_id)
+    return MEMORY_STORE.get_project(project_id)
+
+class RunIndex(_SqliteStore):
+    """Catalogue of workflow runs in runtime.db, written at run start/finish and backfilled once per project."""
+
+    COLUMNS = ("project_id", "trace_id", "goal", "status", "started_at", "ended_at", "steps",
+               "prompt_tokens", "completion_tokens", "files_touched")
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        with self._tx() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs (project_id TEXT NOT NULL, trace_id TEXT NOT NULL, goal TEXT, "
+                "status TEXT NOT NULL, started_at REAL NOT NULL, ended_at REAL, steps INTEGER NOT NULL DEFAULT 0, "
+                "prompt_tokens INTEGER NOT NULL DEFAULT 0, completion_tokens INTEGER NOT NULL DEFAULT 0, "
+                "files_touched TEXT NOT NULL DEFAULT '[]', PRIMARY KEY (project_id, trace_id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_by_time ON runs (project_id, started_at, trace_id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _row(self, row: Tuple[Any, ...]) -> Dict[str, Any]:
+        item = dict(zip(self.COLUMNS, row))
+        item["files_touched"] = json.loads(item["files_touched"] or "[]")
+        return item
+
+    def record_start(self, project_id: str, trace_id: str, goal: str, started_at: float) -> None:
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT INTO runs (project_id, trace_id, goal, status, started_at) VALUES (?, ?, ?, 'running', ?) "
+                "ON CONFLICT(project_id, trace_id) DO UPDATE SET status = 'running', ended_at = NULL",
+                (project_id, trace_id, goal, started_at),
+            )
+
+    def record_finish(self, project_id: str, trace_id: str, status: str, *, steps: int = 0,
+                      usage: Optional[Dict[str, Any]] = None, files_touched: Optional[List[str]] = None) -> None:
+        usage = usage or {}
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE runs SET status = ?, ended_at = ?, steps = ?, prompt_tokens = ?, completion_tokens = ?, "
+                "files_touched = ? WHERE project_id = ? AND trace_id = ?",
+                (status, time.time(), steps, int(usage.get("prompt_tokens") or 0),
+                 int(usage.get("completion_tokens") or 0), json.dumps(sorted(set(files_touched or []))),
+                 project_id, trace_id),
+            )
+
+    def get(self, project_id: str, trace_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM runs WHERE project_id = ? AND trace_id = ?", (project_id, trace_id)
+        ).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, project_id: str, *, status: Optional[str] = None, since: Optional[float] = None,
+             until: Optional[float] = None, order: str = "desc", limit: int = 50,
+             cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        desc = order != "asc"
+        where, params = ["project_id = ?"], [project_id]
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        if since is not None:
+            where.append("started_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("started_at < ?")
+            params.append(until)
+        if cursor:
+            after_ts, after_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            where.append("(started_at, trace_id) < (?, ?)" if desc else "(started_at, trace_id) > (?, ?)")
+            params += [after_ts, after_id]
+        direction = "DESC" if desc else "ASC"
+        rows = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM runs WHERE {' AND '.join(where)} "
+            f"ORDER BY started_at {direction}, trace_id {direction} LIMIT ?",
+            params + [limit + 1],
+        ).fetchall()
+        items = [self._row(r) for r in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = base64.urlsafe_b64encode(json.dumps([last["started_at"], last["trace_id"]]).encode()).decode()
+        return items, next_cursor
+
+    def backfill(self, project_id: str) -> None:
+        """Index run directories created before the catalogue existed (runs once per project)."""
+        meta_key = f"runs_backfilled:{project_id}"
+        if self._conn().execute("SELECT 1 FROM meta WHERE key = ?", (meta_key,)).fetchone():
+            return
+        base = os.path.join(RUNS_DIR, project_id)
+        rows = []
+        for entry in (os.scandir(base) if os.path.isdir(base) else []):
+            if entry.is_dir():
+                rows.append(_scan_legacy_run(project_id, entry.name, entry.path))
+        with self._tx() as conn:
+            for row in rows:
+                conn.execute(
+                    "INSERT OR IGNORE INTO runs (project_id, trace_id, goal, status, started_at, ended_at, steps) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", row,
+                )
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (meta_key, str(time.time())))
+
+def _scan_legacy_run(project_id: str, trace_id: str, run_dir: str) -> Tuple[Any, ...]:
+    started_at = os.stat(run_dir).st_mtime
+    events_path = os.path.join(run_dir, "workflow_events.jsonl")
+    try:
+        with open(events_path, "r", encoding="utf-8") as f:
+            first = _try_parse_json(f.readline()) or {}
+        if first.get("ts"):
+            started_at = float(first["ts"]) / 1000.0
+    except OSError:
+        pass
+    goal, status, steps = None, "unknown", 0
+    run_path = os.path.join(run_dir, "run.json")
+    if os.path.exists(run_path):
+        try:
+            with open(run_path, "r", encoding="utf-8") as f:
+                run = json.load(f)
+            goal = run.get("goal")
+            status = run.get("status") or "complete"
+            steps = int(run.get("used_steps") or run.get("steps") or 0)
+        except Exception:
+            pass
+    return (project_id, trace_id, goal, status, started_at, os.stat(run_dir).st_mtime, steps)
+
+RUN_INDEX = RunIndex(RUNTIME_DB_PATH)
+
+# Identifies this process as the lease owner of the jobs its workers claim.
+JOB_WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+class JobQueue(_SqliteStore):
+    """Persistent workflow queue in runtime.db. Jobs carry their request and the last step checkpoint.
+
+    A running job is leased to its owner; `updated_at` is the lease heartbeat.
+    """
+
+    COLUMNS = ("trace_id", "project_id", "request", "status", "attempts", "checkpoint", "error", "created_at", "updated_at",
+               "owner")
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        with self._tx() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (trace_id TEXT PRIMARY KEY, project_id TEXT NOT NULL, request TEXT NOT NULL, "
+                "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, checkpoint TEXT, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at)")
+            if "owner" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _row(self, row: Optional[Tuple[Any, ...]]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        item = dict(zip(self.COLUMNS, row))
+        item["request"] = json.loads(item["request"])
+        item["checkpoint"] = json.loads(item["checkpoint"]) if item["checkpoint"] else None
+        return item
+
+    def submit(self, project_id: str, trace_id: str, request: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT INTO jobs (trace_id, project_id, request, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (trace_id, project_id, json.dumps(request, ensure_ascii=False), now, now),
+            )
+
+    def claim(self, owner: str = JOB_WORKER_ID) -> Optional[Dict[str, Any]]:
+        with self._tx() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, owner = ?, updated_at = ? WHERE trace_id = ?",
+                (owner, time.time(), row[0]),
+            )
+        job = self._row(row)
+        job["status"], job["attempts"], job["owner"] = "running", job["attempts"] + 1, owner
+        return job
+
+    def heartbeat(self, trace_id: str, owner: str = JOB_WORKER_ID) -> bool:
+        """Extend the lease; False once the job is no longer running under `owner`."""
+        with self._tx() as conn:
+            return conn.execute(
+                "UPDATE jobs SET updated_at = ? WHERE trace_id = ? AND owner = ? AND status = 'running'",
+                (time.time(), trace_id, owner),
+            ).rowcount > 0
+
+    def checkpoint(self, trace_id: str, data: Dict[str, Any]) -> None:
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE jobs SET checkpoint = ?, updated_at = ? WHERE trace_id = ?",
+                (json.dumps(data, ensure_ascii=False, default=str), time.time(), trace_id),
+            )
+
+    def finish(self, trace_id: str, status: str, error: Optional[str] = None) -> None:
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE trace_id = ?",
+                (status, error, time.time(), trace_id),
+            )
+
+    def requeue_interrupted(self, max_attempts: int, lease: float = WORKFLOW_JOB_LEASE) -> int:
+        """Put running jobs whose lease expired (owner died) back in the queue, or fail them once out of attempts."""
+        now = time.time()
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'too many interrupted attempts', owner = NULL, updated_at = ? "
+                "WHERE status = 'running' AND updated_at < ? AND attempts >= ?",
+                (now, now - lease, max_attempts),
+            )
+            return conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE status = 'running' AND updated_at < ?",
+                (now, now - lease),
+            ).rowcount
+
+    def get(self, trace_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE trace_id = ?", (trace_id,)
+        ).fetchone()
+        return self._row(row)
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+JOB_QUEUE = JobQueue(RUNTIME_DB_PATH)
+
+_GATE_APPROVE = re.compile(
+    r"^(?:(?:yes|yep|yeah|yup|y|ok|okay|sure|go|go ahead|do it|start|proceed|confirm(?:ed)?|approved?|lgtm|"
+    r"sounds good|looks good|let'?s go|let'?s do it|tak|👍)(?: |$))+(?:please|thanks?|thank you)?$"
+)
+_GATE_REJECT = re.compile(
+    r"^(?:(?:no|nope|nah|n|stop|cancel|abort|don'?t|do not|never ?mind|not now|nie|👎)(?: |$))+(?:please|thanks?|thank you)?$"
+)
+_INTENT_BUILD = re.compile(
+    r"^(?:please |(?:can|could|would) you |i (?:want|need|would like) (?:you )?to |i'd like (?:you )?to |let'?s )?"
+    r"(?:create|build|make|generate|set ?up|develop|modify|fix|update|change|add|remove|implement|write|scaffold)\b"
+)
+_BUILD_OBJECTS = re.compile(
+    r"\b(?:page|site|website|web ?app|app|application|component|file|feature|form|button|api|endpoint|function|class|"
+    r"script|game|dashboard|layout|navbar|nav|header|footer|section|stylesheet|css|html|javascript|js|module|portfolio|"
+    r"blog|shop|store|menu|modal|login|signup|bug|test|project|template|animation|gallery|widget|ui|frontend|backend)s?\b"
+)
+_INTENT_IDIOMS = re.compile(r"^(?:update me|add up|make sense|change of|make up|write me a (?:poem|story|song|joke|letter))\b")
+_BUILD_TERMS = re.compile(r"\b(?:create|build|make|generate|set ?up|develop|modify|fix|update|change|add|remove|implement)\b")
+_INTENT_QUESTION = re.compile(r"^(?:what|why|how|which|when|where|who|is|are|does|do|should|explain|tell me)\b")
+_INTENT_SMALLTALK = re.compile(r"^(?:hi|hello|hey|thanks|thank you|good (?:morning|afternoon|evening)|cześć)\b")
+
+def _normalize_reply(text: str) -> str:
+    return " ".join(re.sub(r"[.,!;:]+", " ", str(text or "").lower()).split())
+
+def _gate_rules(text: str) -> Tuple[Optional[str], float]:
+    txt = _normalize_reply(text)
+    if not txt or len(txt) > 60:
+        return None, 0.0
+    if _GATE_APPROVE.match(txt):
+        return "approve", 0.97
+    if _GATE_REJECT.match(txt):
+        return "reject", 0.97
+    return None, 0.0
+
+def _intent_rules(text: str) -> Tuple[Optional[str], float]:
+    txt = _normalize_reply(text.replace("?", " ?"))
+    words = txt.split()
+    if not words or len(txt) > 400:  # long messages often mix asks; leave them to the LLM
+        return None, 0.0
+    if _INTENT_BUILD.match(txt) and not _INTENT_IDIOMS.match(txt):
+        # A construction verb alone is not enough ("write me a poem"); it needs something to build.
+        return "workflow", 0.92 if _BUILD_OBJECTS.search(txt) else 0.6
+    if _INTENT_QUESTION.match(txt):
+        return "chat", 0.95 if words[-1] == "?" else 0.8
+    if _INTENT_SMALLTALK.match(txt) and len(words) <= 4:
+        return "chat", 0.95
+    return None, 0.0
+
+def _looks_like_build(text: str) -> bool:
+    """Cheap pre-check for speculative planning: a construction verb anywhere, and not phrased as a question."""
+    txt = _normalize_reply(text)
+    return bool(_BUILD_TERMS.search(txt)) and not _INTENT_QUESTION.match(txt)
+
+class LocalClassifier(_SqliteStore):
+    """On-box fast path for the gate and intent calls: regex rules, then (with scikit-learn) a
+    TF-IDF/logistic regression model trained on the labels the LLM gave. Decisions are logged to runtime.db."""
+
+    RULES = {"gate": _gate_rules, "intent": _intent_rules}
+    RETRAIN_EVERY = 25
+    EMPTY_COUNTERS = {"predicted": 0, "local": 0, "llm": 0, "compared": 0, "agreed": 0, "local_ms": 0.0}
+    MAX_TRAINING_ROWS = 5000
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        with self._tx() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS classifier_log (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, "
+                "text TEXT NOT NULL, label TEXT NOT NULL, source TEXT NOT NULL, local_label TEXT, local_conf REAL, "
+                "created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS classifier_log_by_kind ON classifier_log (kind, source, id)")
+        self._lock = threading.Lock()
+        self._models: Dict[str, Tuple[Any, int]] = {}
+        self._training: set = set()
+        self._counters: Dict[str, Dict[str, float]] = {}
+
+    def _count(self, kind: str, **inc: float) -> None:
+        with self._lock:
+            c = self._counters.setdefault(kind, dict(self.EMPTY_COUNTERS))
+            for k, v in inc.items():
+                c[k] += v
+
+    def predict(self, kind: str, text: str) -> Tuple[Optional[str], float]:
+        t0 = time.perf_counter()
+        label, conf = self.RULES[kind](text)
+        model = self._models.get(kind)
+        if conf < FAST_CLASSIFIER_THRESHOLD and model is not None:
+            proba = model[0].predict_proba([text])[0]
+            best = int(proba.argmax())
+            if proba[best] > conf:
+                label, conf = str(model[0].classes_[best]), float(proba[best])
+        self._count(kind, predicted=1, local_ms=(time.perf_counter() - t0) * 1000.0)
+        return label, conf
+
+    def record(self, kind: str, text: str, label: str, source: str,
+               local: Optional[Tuple[Optional[str], float]] = None) -> None:
+        """Log a decision. LLM labels become training data and, when a local guess existed, agreement samples."""
+        local_label, local_conf = local or (None, None)
+        if source == "local":
+            self._count(kind, local=1)
+        else:
+            self._count(kind, llm=int(source == "llm"))
+            if local_label is not None:
+                self._count(kind, compared=1, agreed=int(local_label == label))
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT INTO classifier_log (kind, text, label, source, local_label, local_conf, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, str(text)[:1000], label, source, local_label, local_conf, time.time()),
+            )
+        if source == "llm" and make_pipeline is not None:
+            self._maybe_retrain(kind)
+
+    def _maybe_retrain(self, kind: str) -> None:
+        n = self._conn().execute(
+            "SELECT COUNT(*) FROM classifier_log WHERE kind = ? AND source != 'local'", (kind,)
+        ).fetchone()[0]
+        trained_on = (self._models.get(kind) or (None, 0))[1]
+        if n < FAST_CLASSIFIER_MIN_SAMPLES or (trained_on and n - trained_on < self.RETRAIN_EVERY):
+            return
+        with self._lock:
+            if kind in self._training:
+                return
+            self._training.add(kind)
+        threading.Thread(target=self.train, args=(kind,), daemon=True).start()
+
+    def train(self, kind: str) -> bool:
+        try:
+            rows = self._conn().execute(
+                "SELECT text, label FROM classifier_log WHERE kind = ? AND source != 'local' ORDER BY id DESC LIMIT ?",
+                (kind, self.MAX_TRAINING_ROWS),
+            ).fetchall()
+            if make_pipeline is None or len({label for _, label in rows}) < 2:
+                return False
+            model = make_pipeline(TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True),
+                                  LogisticRegression(max_iter=1000, class_weight="balanced"))
+            model.fit([t for t, _ in rows], [label for _, label in rows])
+            self._models[kind] = (model, len(rows))
+            return True
+        finally:
+            with self._lock:
+                self._training.discard(kind)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {k: dict(v) for k, v in self._counters.items()}
+        out: Dict[str, Any] = {}
+        for kind in self.RULES:
+            c = counters.get(kind) or self.EMPTY_COUNTERS
+            decided = c["local"] + c["llm"]
+            out[kind] = {
+                "local": c["local"],
+                "llm": c["llm"],
+                "fast_path_rate": round(c["local"] / decided, 4) if decided else 0.0,
+                "compared": c["compared"],
+                "agreement": round(c["agreed"] / c["compared"], 4) if c["compared"] else None,
+                "avg_local_ms": round(c["local_ms"] / max(1, c["predicted"]), 4),
+                "model_trained_on": (self._models.get(kind) or (None, 0))[1],
+            }
+        return out
+
+LOCAL_CLASSIFIER = LocalClassifier(RUNTIME_DB_PATH)
 
 def _save_run_artifacts(project_id: str, trace_id: str, payload: Dict[str, Any]) -> str:
     run_dir = os.path.join(RUNS_DIR, project_id, trace_id)
@@ -246,7 +1112,49 @@ def _try_parse_json(text: str) -> Any:
     except Exception:
         return None
 
-def _post_run_compact(project_id: str, trace_id: str, goal: str, transcript: List[Dict[str, Any]], model_for_post: str) -> Dict[str, Any]:
+async def _post_chat(model: str, system: str, user: Dict[str, Any], site: str) -> str:
+    resp = await mistral_post_async("/v1/chat/completions", {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": json.dumps(user)}
+        ],
+        "temperature": 0.2,
+    }, site=site)
+    msg = (resp.get("choices") or [{}])[0].get("message", {})
+    return str(msg.get("content", "")).strip()
+
+def _write_postprocess_status(project_id: str, trace_id: str, status: Dict[str, Any]) -> None:
+    run_dir = os.path.join(RUNS_DIR, project_id, trace_id)
+    os.makedirs(run_dir, exist_ok=True)
+    path = os.path.join(run_dir, "postprocess.json")
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(status, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+async def _postprocess_stage(project_id: str, trace_id: str, status: Dict[str, Any], name: str, fn: Callable[[], Any]) -> Any:
+    for attempt in range(POSTPROCESS_RETRIES + 1):
+        stage = status["stages"][name] = {"status": "running", "attempts": attempt + 1}
+        _write_postprocess_status(project_id, trace_id, status)
+        try:
+            result = await fn()
+        except Exception as e:
+            last = attempt == POSTPROCESS_RETRIES
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            stage.update(status="failed" if last else "retrying", error=str(detail)[:500])
+            _write_postprocess_status(project_id, trace_id, status)
+            if last:
+                raise
+            await asyncio.sleep(POSTPROCESS_RETRY_DELAY * 2 ** attempt)
+            continue
+        stage["status"] = "complete"
+        _write_postprocess_status(project_id, trace_id, status)
+        return result
+
+async def _post_run_compact(project_id: str, trace_id: str, goal: str, transcript: List[Dict[str, Any]], model_for_post: str,
+                            status: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    status = status if status is not None else {"stages": {}}
     tail = transcript[-30:]
     architect_prompt = (
         "You are the Architect. Compress the run into strict JSON. "
@@ -255,16 +1163,8 @@ def _post_run_compact(project_id: str, trace_id: str, goal: str, transcript: Lis
         "goal, decisions (array), files_touched (array), changes_summary, open_questions (array), next_steps (array), risks (array).\n\n"
         f"GOAL: {goal}"
     )
-    architect_resp = mistral_post("/v1/chat/completions", {
-        "model": model_for_post,
-        "messages": [
-            {"role": "system", "content": architect_prompt},
-            {"role": "user", "content": json.dumps({"trace_id": trace_id, "transcript_tail": tail})}
-        ],
-        "temperature": 0.2,
-    })
-    architect_msg = (architect_resp.get("choices") or [{}])[0].get("message", {})
-    architect_text = str(architect_msg.get("content", "")).strip()
+    architect_text = await _postprocess_stage(project_id, trace_id, status, "architect", lambda: _post_chat(
+        model_for_post, architect_prompt, {"trace_id": trace_id, "transcript_tail": tail}, "architect"))
     architect_json = _try_parse_json(architect_text) or {"error": "architect_parse_failed", "raw": architect_text[:5000]}
 
     notes_prompt = (
@@ -272,32 +1172,16 @@ def _post_run_compact(project_id: str, trace_id: str, goal: str, transcript: Lis
         "failures, wrong assumptions, blockers, regressions, repo landmines, and the minimal fixes that resolved them. "
         "No fluff. No success stories. Max 40 lines."
     )
-    notes_resp = mistral_post("/v1/chat/completions", {
-        "model": model_for_post,
-        "messages": [
-            {"role": "system", "content": notes_prompt},
-            {"role": "user", "content": json.dumps({"goal": goal, "architect": architect_json})}
-        ],
-        "temperature": 0.2,
-    })
-    notes_msg = (notes_resp.get("choices") or [{}])[0].get("message", {})
-    notes_md = str(notes_msg.get("content", "")).strip()
-
     meta_prompt = (
         "You are the Meta-Reviewer. Output strict JSON only. "
         "Keys: workflow_issues (array), prompt_improvements (array), tool_improvements (array), memory_improvements (array). "
         "No extra keys."
     )
-    meta_resp = mistral_post("/v1/chat/completions", {
-        "model": model_for_post,
-        "messages": [
-            {"role": "system", "content": meta_prompt},
-            {"role": "user", "content": json.dumps({"goal": goal, "architect": architect_json, "notes": notes_md})}
-        ],
-        "temperature": 0.2,
-    })
-    meta_msg = (meta_resp.get("choices") or [{}])[0].get("message", {})
-    meta_text = str(meta_msg.get("content", "")).strip()
+    # Each stage reads the previous one's output, so they stay sequential; runs post-process concurrently instead.
+    notes_md = await _postprocess_stage(project_id, trace_id, status, "notes", lambda: _post_chat(
+        model_for_post, notes_prompt, {"goal": goal, "architect": architect_json}, "note_taker"))
+    meta_text = await _postprocess_stage(project_id, trace_id, status, "meta", lambda: _post_chat(
+        model_for_post, meta_prompt, {"goal": goal, "architect": architect_json, "notes": notes_md}, "meta_review"))
     meta_json = _try_parse_json(meta_text) or {"error": "meta_parse_failed", "raw": meta_text[:5000]}
 
     run_dir = os.path.join(RUNS_DIR, project_id, trace_id)
@@ -314,19 +1198,15 @@ def _post_run_compact(project_id: str, trace_id: str, goal: str, transcript: Lis
         issues = meta_json.get("workflow_issues") or []
     had_issue = bool(issues) or (isinstance(architect_json, dict) and architect_json.get("error"))
 
-    mem = _read_runtime_memory()
-    projects = mem.setdefault("projects", {})
-    bucket = projects.setdefault(project_id, {"bad_examples": []})
     if had_issue:
-        bucket["bad_examples"].append({
+        example = {
             "trace_id": trace_id,
             "goal": goal,
             "architect": architect_json,
             "notes_md": notes_md,
             "meta": meta_json,
-        })
-        bucket["bad_examples"] = bucket["bad_examples"][-50:]
-        _write_runtime_memory(mem)
+        }
+        MEMORY_STORE.update_field(project_id, "bad_examples", lambda cur: ((cur or []) + [example])[-50:])
 
     return {"architect": architect_json, "notes_md": notes_md, "meta": meta_json}
 
@@ -356,32 +1236,770 @@ app.add_middleware(
 
 app.mount("/preview", StaticFiles(directory=PROJECTS_DIR, html=True), name="preview")
 
-def _auth_headers() -> Dict[str, str]:
-    if not MISTRAL_API_KEY:
+def _auth_headers(api_key: Optional[str] = None, required: bool = True) -> Dict[str, str]:
+    api_key = MISTRAL_API_KEY if api_key is None else api_key
+    if not api_key and required:
         raise HTTPException(status_code=500, detail="MISTRAL_API_KEY is not set. Put it in .env and restart.")
-    return {
-        "Authorization": f"Bearer {MISTRAL_API_KEY}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
+    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    return headers
 
-def _safe_json(resp: requests.Response) -> Any:
+def _safe_json(resp: Any) -> Any:
     try:
         return resp.json()
     except Exception:
         return {"text": resp.text}
 
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# POSTs without side effects: safe to resend even if the first attempt may have been processed.
+_REPLAYABLE_PATHS = {"/v1/chat/completions", "/v1/fim/completions", "/v1/embeddings"}
+_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, requests.ConnectTimeout)
+
+# Lower lanes are served first when calls queue on the rate limiter.
+_LANES = {"gate": 0, "intent": 0, "chat": 1, "planner": 1, "agents": 1, "visualizer": 2, "plan_improver": 2,
+          "executor": 2, "architect": 3, "note_taker": 3, "meta_review": 3}
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Seconds to wait before retry `attempt` (0-based): Retry-After if given, else full-jitter exponential backoff."""
+    if retry_after:
+        try:
+            return min(MISTRAL_BACKOFF_MAX * 4, max(0.0, float(retry_after)))
+        except ValueError:
+            with contextlib.suppress(TypeError, ValueError):
+                return min(MISTRAL_BACKOFF_MAX * 4, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+    return random.uniform(0, min(MISTRAL_BACKOFF_MAX, MISTRAL_BACKOFF_BASE * 2 ** attempt))
+
+def _replayable(path: str, error: Optional[BaseException] = None, status: Optional[int] = None) -> bool:
+    """Whether a failed POST may be resent without risking a duplicate side effect (e.g. creating an agent twice)."""
+    if path in _REPLAYABLE_PATHS:
+        return True
+    if error is not None:
+        return isinstance(error, _UNSENT_ERRORS)  # the request never reached the server
+    return status in (425, 429, 503)
+
+def _retry_allowed(attempt: int, started: float, delay: float) -> bool:
+    """Attempts remain and the next one would start within MISTRAL_RETRY_BUDGET seconds of the first."""
+    return attempt < MISTRAL_MAX_RETRIES and time.monotonic() - started + delay <= MISTRAL_RETRY_BUDGET
+
+def _estimate_tokens(payload: Dict[str, Any]) -> int:
+    prompt = len(json.dumps(payload.get("messages") or payload.get("inputs") or "", ensure_ascii=False, default=str)) // 4
+    return prompt + int(payload.get("max_tokens") or 0)
+
+class _RateLimiter:
+    """Token buckets for requests/min and tokens/min with a priority queue of waiters.
+
+    Only the highest-priority waiter (lowest lane, then FIFO) may draw from the buckets, so
+    interactive calls overtake queued bulk calls. `pause` holds everyone after a 429.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = rpm
+        self._tokens = tpm
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._queue: List[Tuple[int, int]] = []
+        self._seq = itertools.count()
+        self._changed: Optional[asyncio.Event] = None
+        self._loop: Any = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self._stamp = now - self._stamp, now
+        if self.rpm > 0:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _delay(self, tokens: int) -> float:
+        self._refill()
+        wait = max(0.0, self._paused_until - time.monotonic())
+        if self.rpm > 0 and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+        if self.tpm > 0:
+            need = min(tokens, self.tpm)  # a call larger than the bucket waits for a full bucket
+            if self._tokens < need:
+                wait = max(wait, (need - self._tokens) * 60 / self.tpm)
+        return wait
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            event, self._changed = self._changed, asyncio.Event()
+            event.set()
+
+    async def acquire(self, tokens: int, lane: int) -> None:
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._changed, self._queue = loop, asyncio.Event(), []
+        entry = (lane, next(self._seq))
+        heapq.heappush(self._queue, entry)
+        self._notify()
+        try:
+            while True:
+                changed = self._changed
+                if self._queue[0] == entry:
+                    wait = self._delay(tokens)
+                    if wait <= 0:
+                        self._requests -= 1 if self.rpm > 0 else 0
+                        self._tokens -= tokens if self.tpm > 0 else 0
+                        return
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(changed.wait(), wait)
+                else:
+                    await changed.wait()
+        finally:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            self._notify()
+
+    def settle(self, estimated: int, actual: int) -> None:
+        """Charge the difference between the estimate and the provider-reported token usage."""
+        if self.tpm > 0 and actual:
+            self._tokens -= actual - estimated
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+_RATE_LIMITERS: Dict[str, _RateLimiter] = {}
+
+def _rate_limiter(api_key: str, rpm: Optional[float] = None, tpm: Optional[float] = None) -> _RateLimiter:
+    limiter = _RATE_LIMITERS.get(api_key)
+    if limiter is None:
+        limiter = _RATE_LIMITERS[api_key] = _RateLimiter(MISTRAL_RPM if rpm is None else rpm, MISTRAL_TPM if tpm is None else tpm)
+    return limiter
+
+class _Provider:
+    """One LLM endpoint + key, with its own outstanding-request count and circuit breaker."""
+
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float = 1.0, models: Optional[List[str]] = None,
+                 rpm: Optional[float] = None, tpm: Optional[float] = None, key_required: bool = False):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.weight = max(0.01, float(weight))
+        self.models = set(models or [])
+        self.key_required = key_required
+        self.limiter = _rate_limiter(api_key or self.base_url, rpm, tpm)
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.current_weight = 0.0
+
+    def headers(self) -> Dict[str, str]:
+        return _auth_headers(self.api_key, required=self.key_required)
+
+    def available(self, now: float) -> bool:
+        # Past the cooldown a tripped endpoint is half-open: it gets one trial request at a time.
+        return self.open_until <= now and (self.failures < LLM_CIRCUIT_FAILURES or self.outstanding == 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name, "base_url": self.base_url, "weight": self.weight, "models": sorted(self.models),
+            "outstanding": self.outstanding, "requests": self.requests, "errors": self.errors,
+            "consecutive_failures": self.failures,
+            "circuit": "open" if self.open_until > time.time() else "half_open" if self.failures >= LLM_CIRCUIT_FAILURES else "closed",
+        }
+
+class ProviderPool:
+    """Spreads LLM calls over providers by least outstanding requests or smooth weighted round-robin."""
+
+    def __init__(self, providers: List[_Provider], strategy: str = "least_outstanding"):
+        if not providers:
+            raise ValueError("At least one LLM provider is required.")
+        self.providers = providers
+        self.strategy = strategy
+        self._lock = threading.Lock()
+
+    def acquire(self, model: str = "") -> _Provider:
+        now = time.time()
+        with self._lock:
+            candidates = [p for p in self.providers if not p.models or not model or model in p.models] or self.providers
+            healthy = [p for p in candidates if p.available(now)]
+            if not healthy:
+                # Everything is tripped: try the endpoint that recovers first rather than failing outright.
+                healthy = [min(candidates, key=lambda p: p.open_until)]
+            if self.strategy == "weighted_round_robin":
+                total = sum(p.weight for p in healthy)
+                for p in healthy:
+                    p.current_weight += p.weight
+                chosen = max(healthy, key=lambda p: p.current_weight)
+                chosen.current_weight -= total
+            else:
+                chosen = min(healthy, key=lambda p: (p.outstanding / p.weight, p.requests / p.weight))
+            chosen.outstanding += 1
+            chosen.requests += 1
+            return chosen
+
+    def release(self, provider: _Provider, healthy: Optional[bool]) -> None:
+        """Return a slot; `healthy=None` (a cancelled call) says nothing about the endpoint and leaves its circuit alone."""
+        with self._lock:
+            provider.outstanding = max(0, provider.outstanding - 1)
+            if healthy is not None:
+                self._mark(provider, healthy)
+
+    def _mark(self, provider: _Provider, healthy: bool) -> None:
+        if healthy:
+            provider.failures, provider.open_until = 0, 0.0
+            return
+        provider.errors += 1
+        provider.failures += 1
+        if provider.failures >= LLM_CIRCUIT_FAILURES:
+            provider.open_until = time.time() + LLM_CIRCUIT_COOLDOWN
+
+    def mark(self, provider: _Provider, healthy: bool) -> None:
+        with self._lock:
+            self._mark(provider, healthy)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [p.stats() for p in self.providers]
+
+def _build_provider_pool() -> ProviderPool:
+    if LLM_PROVIDERS:
+        specs = json.loads(LLM_PROVIDERS)
+        providers = [_Provider(
+            name=str(spec.get("name") or f"provider-{i}"), base_url=str(spec["base_url"]),
+            api_key=str(spec.get("api_key") or os.getenv(str(spec.get("api_key_env") or ""), "") or ""),
+            weight=float(spec.get("weight", 1)), models=spec.get("models"), rpm=spec.get("rpm"), tpm=spec.get("tpm"),
+        ) for i, spec in enumerate(specs)]
+    else:
+        keys = [k.strip() for k in MISTRAL_API_KEYS.split(",") if k.strip()] or [MISTRAL_API_KEY]
+        providers = [_Provider(f"mistral-{i}", MISTRAL_BASE_URL, key, key_required=True) for i, key in enumerate(keys)]
+    return ProviderPool(providers, LLM_BALANCE)
+
+_PROVIDER_POOL: Optional[Tuple[Tuple[str, ...], ProviderPool]] = None
+
+def _provider_pool() -> ProviderPool:
+    """The pool for the current provider settings; rebuilt if they change at runtime."""
+    global _PROVIDER_POOL
+    config = (LLM_PROVIDERS, MISTRAL_API_KEYS, MISTRAL_API_KEY, MISTRAL_BASE_URL, LLM_BALANCE)
+    if _PROVIDER_POOL is None or _PROVIDER_POOL[0] != config:
+        _PROVIDER_POOL = (config, _build_provider_pool())
+    return _PROVIDER_POOL[1]
+
+def _route_model(site: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply LLM_MODEL_ROUTES: a per-call-site model overrides the requested one."""
+    routes = _MODEL_ROUTES_CACHE.get(LLM_MODEL_ROUTES)
+    if routes is None:
+        routes = _MODEL_ROUTES_CACHE[LLM_MODEL_ROUTES] = json.loads(LLM_MODEL_ROUTES) if LLM_MODEL_ROUTES else {}
+    model = routes.get(site)
+    if not model or "model" not in payload or payload.get("model") == model:
+        return payload
+    return {**payload, "model": model}
+
+_MODEL_ROUTES_CACHE: Dict[str, Dict[str, str]] = {}
+
+def _raise_for_mistral(resp: Any) -> Any:
+    if resp.status_code >= 400:
+        raise HTTPException(status_code=502, detail={"mistral_status": resp.status_code, "mistral_body": _safe_json(resp)})
+    return resp.json()
+
+# Keep-alive pools: one requests.Session for sync callers, one httpx.AsyncClient per
+# (base_url, event loop) for async callers, each capped at MISTRAL_MAX_CONNECTIONS.
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=MISTRAL_MAX_CONNECTIONS))
+_HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MISTRAL_MAX_CONNECTIONS))
+_ASYNC_CLIENTS: Dict[str, Tuple[httpx.AsyncClient, Any]] = {}
+
+def _async_client(base_url: str) -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    entry = _ASYNC_CLIENTS.get(base_url)
+    if entry is None or entry[1] is not loop or entry[0].is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MISTRAL_MAX_CONNECTIONS,
+                max_keepalive_connections=MISTRAL_MAX_CONNECTIONS,
+                keepalive_expiry=MISTRAL_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(MISTRAL_TIMEOUT, connect=10.0),
+        )
+        _ASYNC_CLIENTS[base_url] = (client, loop)
+        return client
+    return entry[0]
+
+async def _check_provider(pool: ProviderPool, provider: _Provider) -> None:
+    try:
+        r = await _async_client(provider.base_url).get(f"{provider.base_url}/v1/models", headers=provider.headers(), timeout=10)
+        healthy = r.status_code < 500
+    except (httpx.HTTPError, HTTPException):
+        healthy = False
+    pool.mark(provider, healthy)
+
+async def _provider_health_loop() -> None:
+    while True:
+        await asyncio.sleep(LLM_HEALTH_INTERVAL)
+        pool = _provider_pool()
+        await asyncio.gather(*(_check_provider(pool, p) for p in pool.providers))
+
+@app.on_event("startup")
+async def _start_provider_health_checks() -> None:
+    if LLM_HEALTH_INTERVAL > 0:
+        _spawn(_provider_health_loop())
+
+@app.on_event("shutdown")
+async def _close_http_clients() -> None:
+    for client, _ in list(_ASYNC_CLIENTS.values()):
+        await client.aclose()
+    _ASYNC_CLIENTS.clear()
+    _HTTP_SESSION.close()
+
+@app.on_event("shutdown")
+def _close_event_sinks() -> None:
+    for project_id, trace_id in list(EVENT_SINKS.keys()):
+        _close_event_sink(project_id, trace_id)
+
 def mistral_get(path: str) -> Any:
-    r = requests.get(f"{MISTRAL_BASE_URL}{path}", headers=_auth_headers(), timeout=60)
-    if r.status_code >= 400:
-        raise HTTPException(status_code=502, detail={"mistral_status": r.status_code, "mistral_body": _safe_json(r)})
-    return r.json()
+    pool = _provider_pool()
+    provider = pool.acquire()
+    try:
+        r = _HTTP_SESSION.get(f"{provider.base_url}{path}", headers=provider.headers(), timeout=60)
+    except requests.RequestException:
+        pool.release(provider, False)
+        raise
+    except BaseException:
+        pool.release(provider, None)
+        raise
+    pool.release(provider, r.status_code < 500)
+    return _raise_for_mistral(r)
 
 def mistral_post(path: str, payload: Dict[str, Any]) -> Any:
-    r = requests.post(f"{MISTRAL_BASE_URL}{path}", headers=_auth_headers(), json=payload, timeout=120)
-    if r.status_code >= 400:
-        raise HTTPException(status_code=502, detail={"mistral_status": r.status_code, "mistral_body": _safe_json(r)})
-    return r.json()
+    pool = _provider_pool()
+    started = time.monotonic()
+    for attempt in range(MISTRAL_MAX_RETRIES + 1):
+        provider = pool.acquire(str(payload.get("model") or ""))
+        try:
+            r = _HTTP_SESSION.post(f"{provider.base_url}{path}", headers=provider.headers(), json=payload, timeout=MISTRAL_TIMEOUT)
+        except requests.RequestException as e:
+            pool.release(provider, False)
+            delay = _retry_delay(attempt)
+            if not (_replayable(path, error=e) and _retry_allowed(attempt, started, delay)):
+                raise
+            time.sleep(delay)
+            continue
+        pool.release(provider, r.status_code < 500)
+        delay = _retry_delay(attempt, r.headers.get("retry-after"))
+        if (r.status_code not in RETRYABLE_STATUS or not _replayable(path, status=r.status_code)
+                or not _retry_allowed(attempt, started, delay)):
+            return _raise_for_mistral(r)
+        time.sleep(delay)
+
+async def mistral_get_async(path: str) -> Any:
+    pool = _provider_pool()
+    provider = pool.acquire()
+    try:
+        r = await _async_client(provider.base_url).get(f"{provider.base_url}{path}", headers=provider.headers(), timeout=60)
+    except (httpx.TransportError, httpx.TimeoutException):
+        pool.release(provider, False)
+        raise
+    except BaseException:
+        pool.release(provider, None)
+        raise
+    pool.release(provider, r.status_code < 500)
+    return _raise_for_mistral(r)
+
+class _ResponseCache:
+    """Content-addressed cache of LLM responses: in-memory LRU, optional on-disk tier, TTL on both."""
+
+    KEY_FIELDS = ("model", "messages", "tools", "temperature", "response_format")
+
+    def __init__(self, max_entries: int, ttl: float, disk_dir: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @classmethod
+    def key(cls, path: str, payload: Dict[str, Any]) -> str:
+        material = {"path": path, **{k: payload.get(k) for k in cls.KEY_FIELDS}}
+        return hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None and now - hit[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return copy.deepcopy(hit[1])
+            self._entries.pop(key, None)
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                    stored = json.load(f)
+                if now - float(stored["stored_at"]) <= self.ttl:
+                    self._remember(key, float(stored["stored_at"]), stored["response"])
+                    with self._lock:
+                        self.disk_hits += 1
+                    return stored["response"]
+            except Exception:
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: str, stored_at: float, response: Any) -> None:
+        with self._lock:
+            self._entries[key] = (stored_at, copy.deepcopy(response))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key: str, response: Any) -> None:
+        stored_at = time.time()
+        self._remember(key, stored_at, response)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"stored_at": stored_at, "response": response}, f, ensure_ascii=False)
+                os.replace(tmp, path)
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "disk_tier": bool(self.disk_dir),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+LLM_RESPONSE_CACHE = _ResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL, LLM_CACHE_DIR)
+# Execution plans keyed on project, goal and workspace fingerprint (see _plan_cache_key).
+PLAN_CACHE = _ResponseCache(PLAN_CACHE_MAX_ENTRIES, LLM_CACHE_TTL)
+
+# Project/trace the current task is working for; tasks spawned from a run inherit it.
+_LLM_CONTEXT: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("llm_context", default={})
+
+class LLMMetrics:
+    """Per-call LLM accounting: aggregate counters/histograms plus the call log of recent traces."""
+
+    BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self, max_traces: int = 500):
+        self.max_traces = max_traces
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self._traces: "OrderedDict[Tuple[str, str], List[Dict[str, Any]]]" = OrderedDict()
+
+    def record(self, call: Dict[str, Any]) -> None:
+        with self._lock:
+            series = self._series.setdefault((call["site"], call["model"], call["endpoint"]), {
+                "calls": 0, "errors": 0, "cached": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "seconds": 0.0, "buckets": [0] * len(self.BUCKETS),
+            })
+            series["calls"] += 1
+            series["errors"] += call["status"] != "ok"
+            series["cached"] += bool(call["cached"])
+            series["retries"] += call["retries"]
+            series["prompt_tokens"] += call["prompt_tokens"]
+            series["completion_tokens"] += call["completion_tokens"]
+            series["seconds"] += call["seconds"]
+            for i, bound in enumerate(self.BUCKETS):
+                if call["seconds"] <= bound:
+                    series["buckets"][i] += 1
+            if call.get("trace_id"):
+                key = (call.get("project_id", ""), call["trace_id"])
+                self._traces.setdefault(key, []).append(call)
+                self._traces.move_to_end(key)
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+
+    def trace_calls(self, project_id: str, trace_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._traces.get((project_id, trace_id)) or [])
+
+    @staticmethod
+    def summarize(calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+        by_site: Dict[str, Dict[str, Any]] = {}
+        for call in calls:
+            site = by_site.setdefault(call["site"], {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                     "seconds": 0.0, "retries": 0, "cached": 0})
+            site["calls"] += 1
+            site["prompt_tokens"] += call["prompt_tokens"]
+            site["completion_tokens"] += call["completion_tokens"]
+            site["seconds"] = round(site["seconds"] + call["seconds"], 3)
+            site["retries"] += call["retries"]
+            site["cached"] += bool(call["cached"])
+        return {
+            "calls": len(calls),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in calls),
+            "completion_tokens": sum(c["completion_tokens"] for c in calls),
+            "seconds": round(sum(c["seconds"] for c in calls), 3),
+            "by_site": by_site,
+        }
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{"site": site, "model": model, "endpoint": endpoint,
+                     **{k: v for k, v in series.items() if k != "buckets"}}
+                    for (site, model, endpoint), series in sorted(self._series.items())]
+
+    def prometheus(self) -> List[str]:
+        def esc(v: str) -> str:
+            return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        with self._lock:
+            items = [(k, dict(v, buckets=list(v["buckets"]))) for k, v in sorted(self._series.items())]
+        labelled = [(f'site="{esc(site)}",model="{esc(model)}",endpoint="{esc(endpoint)}"', series)
+                    for (site, model, endpoint), series in items]
+        lines: List[str] = []
+        # Each family's samples must follow its own HELP/TYPE lines as one contiguous group.
+        for name, field, help_text in (
+            ("llm_calls_total", "calls", "LLM calls by call site, model and endpoint."),
+            ("llm_call_errors_total", "errors", "Failed LLM calls."),
+            ("llm_call_cached_total", "cached", "LLM calls served from the response cache."),
+            ("llm_call_retries_total", "retries", "Retries spent on LLM calls."),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f"{name}{{{labels}}} {series[field]}" for labels, series in labelled]
+        lines += ["# HELP llm_tokens_total Tokens reported by the provider.", "# TYPE llm_tokens_total counter"]
+        for labels, series in labelled:
+            lines.append(f'llm_tokens_total{{{labels},kind="prompt"}} {series["prompt_tokens"]}')
+            lines.append(f'llm_tokens_total{{{labels},kind="completion"}} {series["completion_tokens"]}')
+        lines += ["# HELP llm_call_seconds Wall time of LLM calls.", "# TYPE llm_call_seconds histogram"]
+        for labels, series in labelled:
+            for bound, count in zip(self.BUCKETS, series["buckets"]):
+                lines.append(f'llm_call_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'llm_call_seconds_bucket{{{labels},le="+Inf"}} {series["calls"]}')
+            lines.append(f"llm_call_seconds_sum{{{labels}}} {round(series['seconds'], 6)}")
+            lines.append(f"llm_call_seconds_count{{{labels}}} {series['calls']}")
+        return lines
+
+LLM_METRICS = LLMMetrics()
+
+def _record_llm_call(path: str, payload: Dict[str, Any], site: str, started: float, response: Any = None,
+                     error: Optional[BaseException] = None, cached: bool = False, retries: int = 0,
+                     step: Optional[int] = None) -> None:
+    usage = (response or {}).get("usage") or {} if isinstance(response, dict) else {}
+    ctx = _LLM_CONTEXT.get()
+    call = {
+        "ts": started,
+        "site": site,
+        "step": step,
+        "model": str(payload.get("model") or payload.get("agent_id") or ""),
+        "endpoint": path,
+        "status": "ok" if error is None else "error",
+        "cached": cached,
+        "retries": retries,
+        "prompt_tokens": 0 if cached else int(usage.get("prompt_tokens") or 0),
+        "completion_tokens": 0 if cached else int(usage.get("completion_tokens") or 0),
+        "seconds": round(time.perf_counter() - started, 4),
+        "project_id": ctx.get("project_id", ""),
+        "trace_id": ctx.get("trace_id", ""),
+    }
+    if error is not None:
+        call["error"] = str(error.detail if isinstance(error, HTTPException) else error)[:300]
+    LLM_METRICS.record(call)
+    if call["trace_id"] and call["project_id"]:
+        try:
+            run_dir = os.path.join(RUNS_DIR, call["project_id"], call["trace_id"])
+            os.makedirs(run_dir, exist_ok=True)
+            with open(os.path.join(run_dir, "llm_calls.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(call, ensure_ascii=False) + "\n")
+        except OSError:
+            pass
+
+def _read_llm_calls(project_id: str, trace_id: str) -> List[Dict[str, Any]]:
+    calls = []
+    try:
+        with open(os.path.join(RUNS_DIR, project_id, trace_id, "llm_calls.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                call = _try_parse_json(line)
+                if isinstance(call, dict):
+                    calls.append(call)
+    except OSError:
+        pass
+    return calls
+
+async def _send_with_retries(path: str, payload: Dict[str, Any], site: str, send: Callable[[_Provider], Any],
+                             retries: List[int]) -> Any:
+    """Send via the provider pool and that provider's rate limiter, retrying 429/5xx and transport errors.
+
+    Calls with side effects are only resent when they cannot have been processed; no retry starts once
+    MISTRAL_RETRY_BUDGET seconds have passed. Each attempt picks a provider afresh, so retries move away
+    from a failing endpoint.
+    `retries[0]` is updated with the number of retries spent.
+    """
+    pool = _provider_pool()
+    estimate = _estimate_tokens(payload)
+    lane = _LANES.get(site, 2)
+    started = time.monotonic()
+    for attempt in range(MISTRAL_MAX_RETRIES + 1):
+        retries[0] = attempt
+        provider = pool.acquire(str(payload.get("model") or ""))
+        try:
+            await provider.limiter.acquire(estimate, lane)
+            r = await send(provider)
+        except (httpx.TransportError, httpx.TimeoutException) as e:
+            pool.release(provider, False)
+            delay = _retry_delay(attempt)
+            if not (_replayable(path, error=e) and _retry_allowed(attempt, started, delay)):
+                raise
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            pool.release(provider, None)
+            raise
+        pool.release(provider, r.status_code < 500)
+        if r.status_code in RETRYABLE_STATUS and _replayable(path, status=r.status_code):
+            delay = _retry_delay(attempt, r.headers.get("retry-after"))
+            if r.status_code == 429:
+                provider.limiter.pause(delay)
+                delay = 0.0 if len(pool.providers) > 1 else delay  # another key may have headroom
+            if _retry_allowed(attempt, started, delay):
+                await asyncio.sleep(delay)
+                continue
+        data = _raise_for_mistral(r)
+        usage = data.get("usage") if isinstance(data, dict) else None
+        provider.limiter.settle(estimate, int((usage or {}).get("prompt_tokens") or 0) + int((usage or {}).get("completion_tokens") or 0))
+        return data
+
+async def mistral_post_async(path: str, payload: Dict[str, Any], *, cache: bool = False, site: str = "other",
+                             step: Optional[int] = None) -> Any:
+    # cache=True is for deterministic call sites only (planner, gates, classifiers, visualizer).
+    started = time.perf_counter()
+    payload = _route_model(site, payload)
+    key = _ResponseCache.key(path, payload) if cache else ""
+    if cache:
+        hit = LLM_RESPONSE_CACHE.get(key)
+        if hit is not None:
+            _record_llm_call(path, payload, site, started, hit, cached=True, step=step)
+            return hit
+    retries = [0]
+    try:
+        data = await _send_with_retries(path, payload, site, lambda p: _async_client(p.base_url).post(
+            f"{p.base_url}{path}", headers=p.headers(), json=payload), retries)
+    except Exception as e:
+        _record_llm_call(path, payload, site, started, error=e, retries=retries[0], step=step)
+        raise
+    _record_llm_call(path, payload, site, started, data, retries=retries[0], step=step)
+    if cache:
+        LLM_RESPONSE_CACHE.put(key, data)
+    return data
+
+async def mistral_stream_async(path: str, payload: Dict[str, Any], site: str = "other",
+                               retries: Optional[List[int]] = None) -> AsyncIterator[Dict[str, Any]]:
+    # Retries only happen before the first chunk; a stream that broke midway is not replayed.
+    pool = _provider_pool()
+    estimate = _estimate_tokens(payload)
+    retries = retries if retries is not None else [0]
+    started = time.monotonic()
+    for attempt in range(MISTRAL_MAX_RETRIES + 1):
+        retries[0] = attempt
+        provider = pool.acquire(str(payload.get("model") or ""))
+        healthy: Optional[bool] = None  # stays None if the call is cancelled before the endpoint answers
+        yielded = False
+        try:
+            await provider.limiter.acquire(estimate, _LANES.get(site, 2))
+            headers = {**provider.headers(), "Accept": "text/event-stream"}
+            client = _async_client(provider.base_url)
+            async with client.stream("POST", f"{provider.base_url}{path}", headers=headers, json={**payload, "stream": True}) as r:
+                healthy = r.status_code < 500
+                if r.status_code >= 400:
+                    await r.aread()
+                    delay = _retry_delay(attempt, r.headers.get("retry-after"))
+                    if r.status_code == 429:
+                        provider.limiter.pause(delay)
+                    if (r.status_code in RETRYABLE_STATUS and _replayable(path, status=r.status_code)
+                            and _retry_allowed(attempt, started, delay)):
+                        await asyncio.sleep(delay)
+                        continue
+                    _raise_for_mistral(r)
+                async for line in r.aiter_lines():
+                    line = line.strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = _try_parse_json(data)
+                    if isinstance(chunk, dict):
+                        yielded = True
+                        yield chunk
+            return
+        except (httpx.TransportError, httpx.TimeoutException) as e:
+            healthy = False
+            delay = _retry_delay(attempt)
+            if yielded or not (_replayable(path, error=e) and _retry_allowed(attempt, started, delay)):
+                raise
+            await asyncio.sleep(delay)
+        finally:
+            pool.release(provider, healthy)
+
+async def _stream_chat_completion(payload: Dict[str, Any], on_delta: Callable[[str], None], site: str = "other",
+                                  step: Optional[int] = None) -> Dict[str, Any]:
+    """Stream a chat completion, forwarding content deltas, and reassemble it into the non-streaming shape."""
+    started = time.perf_counter()
+    payload = _route_model(site, payload)
+    retries = [0]
+    try:
+        response = await _collect_chat_stream(payload, on_delta, site, retries)
+    except Exception as e:
+        _record_llm_call("/v1/chat/completions", payload, site, started, error=e, retries=retries[0], step=step)
+        raise
+    _record_llm_call("/v1/chat/completions", payload, site, started, response, retries=retries[0], step=step)
+    return response
+
+async def _collect_chat_stream(payload: Dict[str, Any], on_delta: Callable[[str], None], site: str,
+                               retries: List[int]) -> Dict[str, Any]:
+    parts: List[str] = []
+    tool_calls: Dict[int, Dict[str, Any]] = {}
+    usage = None
+    finish_reason = None
+    async for chunk in mistral_stream_async("/v1/chat/completions", payload, site, retries):
+        usage = chunk.get("usage") or usage
+        for choice in chunk.get("choices") or []:
+            delta = choice.get("delta") or {}
+            text = delta.get("content")
+            if isinstance(text, str) and text:
+                parts.append(text)
+                on_delta(text)
+            for tc in delta.get("tool_calls") or []:
+                idx = tc.get("index", len(tool_calls))
+                cur = tool_calls.setdefault(idx, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                if tc.get("id"):
+                    cur["id"] = tc["id"]
+                fn = tc.get("function") or {}
+                if fn.get("name"):
+                    cur["function"]["name"] = fn["name"]
+                args = fn.get("arguments")
+                if isinstance(args, dict):
+                    cur["function"]["arguments"] = json.dumps(args)
+                elif args:
+                    cur["function"]["arguments"] += args
+            finish_reason = choice.get("finish_reason") or finish_reason
+    message: Dict[str, Any] = {"role": "assistant", "content": "".join(parts)}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    return {"choices": [{"message": message, "finish_reason": finish_reason}], "usage": usage}
 
 def _norm_filename(filename: str) -> str:
     filename = filename.replace("\\", "/").strip()
@@ -399,122 +2017,849 @@ def _write_allowed(project_id: str, filename: str) -> Tuple[bool, str]:
         return False, "blocked: self_modify permission is OFF for non-preview writes"
     return True, "ok"
 
-def tool_create_file(project_id: str, filename: str, content: str) -> Dict[str, Any]:
+_WRITE_TMP_SUFFIX = ".wstmp"
+
+def _content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+class _WorkspaceIndex:
+    """Per-project in-memory file index: rel path -> {size, mtime, hash}.
+
+    Workspace tools update entries as they write. External edits are picked up by the
+    watchdog observer when it is installed, otherwise by a rescan once the index is
+    older than WORKSPACE_INDEX_TTL. Content hashes are computed lazily.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.watched = False
+        self._projects: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.RLock()
+
+    def _scan(self, project_id: str, previous: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        base = _project_root(project_id)
+        files: Dict[str, Dict[str, Any]] = {}
+        stack = [base]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(_WRITE_TMP_SUFFIX):
+                    continue
+                rel = os.path.relpath(entry.path, base).replace("\\", "/")
+                old = previous.get(rel)
+                same = old is not None and old["size"] == st.st_size and old["mtime"] == st.st_mtime_ns
+                files[rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": old["hash"] if same else None}
+        return files
+
+    def _state(self, project_id: str) -> Dict[str, Any]:
+        """Current state of a project, rescanning it when stale. The walk runs outside the lock."""
+        with self.lock:
+            state = self._projects.get(project_id)
+            stale = state is None or state["dirty"] or (
+                not self.watched and time.monotonic() - state["scanned"] > self.ttl)
+            if not stale:
+                return state
+            previous = dict(state["files"]) if state else {}
+            gen = state["gen"] if state else 0
+        files = self._scan(project_id, previous)
+        with self.lock:
+            current = self._projects.get(project_id)
+            if current is not state:  # another thread swapped in a newer scan meanwhile
+                return current
+            # Writes recorded against the old state during the walk may be missing from it: rescan next time.
+            changed = state is not None and state["gen"] != gen
+            fresh = self._projects[project_id] = {"files": files, "sorted": None, "scanned": time.monotonic(),
+                                                  "dirty": changed, "gen": 0}
+            return fresh
+
+    def paths(self, project_id: str) -> List[str]:
+        state = self._state(project_id)
+        with self.lock:
+            if state["sorted"] is None:
+                state["sorted"] = sorted(state["files"])
+            return state["sorted"]
+
+    def entry(self, project_id: str, rel: str) -> Optional[Dict[str, Any]]:
+        state = self._state(project_id)
+        with self.lock:
+            meta = state["files"].get(rel)
+            return dict(meta, path=rel) if meta else None
+
+    def file_hash(self, project_id: str, rel: str) -> Optional[str]:
+        state = self._state(project_id)
+        with self.lock:
+            meta = state["files"].get(rel)
+            if meta is None or meta["hash"] is not None:
+                return meta and meta["hash"]
+        try:
+            path = _resolve_path(project_id, rel)
+            st = os.stat(path)
+            with open(path, "rb") as f:
+                digest = _content_hash(f.read())
+        except OSError:
+            return None
+        with self.lock:
+            if (meta["size"], meta["mtime"]) == (st.st_size, st.st_mtime_ns):
+                meta["hash"] = digest
+        return digest
+
+    def record_write(self, project_id: str, rel: str, data: Optional[bytes] = None) -> None:
+        if project_id not in self._projects:
+            return
+        try:
+            st = os.stat(_resolve_path(project_id, rel))
+        except OSError:
+            self.record_delete(project_id, rel)
+            return
+        digest = _content_hash(data) if data is not None else None
+        with self.lock:
+            state = self._projects.get(project_id)
+            if state is None:
+                return
+            state["gen"] += 1
+            if rel not in state["files"]:
+                state["sorted"] = None
+            state["files"][rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": digest}
+
+    def record_delete(self, project_id: str, rel: str) -> None:
+        with self.lock:
+            state = self._projects.get(project_id)
+            if state is not None:
+                state["gen"] += 1
+                if state["files"].pop(rel, None) is not None:
+                    state["sorted"] = None
+
+    def mark_dirty(self, project_id: str) -> None:
+        with self.lock:
+            state = self._projects.get(project_id)
+            if state is not None:
+                state["gen"] += 1
+                state["dirty"] = True
+
+    def fingerprint(self, project_id: str) -> str:
+        """Digest of every path, size and mtime: changes whenever the workspace does, without reading files."""
+        state = self._state(project_id)
+        with self.lock:
+            files = state["files"]
+            material = json.dumps(sorted((p, m["size"], m["mtime"]) for p, m in files.items()))
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"projects": len(self._projects), "files": sum(len(s["files"]) for s in self._projects.values()),
+                    "watched": self.watched}
+
+WORKSPACE_INDEX = _WorkspaceIndex(WORKSPACE_INDEX_TTL)
+
+class _WorkspaceWatchHandler(FileSystemEventHandler):
+    def on_any_event(self, event: Any) -> None:
+        rel = os.path.relpath(event.src_path, PROJECTS_DIR).replace("\\", "/")
+        project_id, _, path = rel.partition("/")
+        if not path or project_id.startswith("..") or path.endswith(_WRITE_TMP_SUFFIX):
+            return
+        if event.is_directory or event.event_type == "moved":
+            WORKSPACE_INDEX.mark_dirty(project_id)
+        elif os.path.exists(event.src_path):
+            WORKSPACE_INDEX.record_write(project_id, path)
+        else:
+            WORKSPACE_INDEX.record_delete(project_id, path)
+
+_WORKSPACE_OBSERVER: Any = None
+
+@app.on_event("startup")
+def _start_workspace_watcher() -> None:
+    global _WORKSPACE_OBSERVER
+    if Observer is None or not WORKSPACE_WATCH or _WORKSPACE_OBSERVER is not None:
+        return
+    _WORKSPACE_OBSERVER = Observer()
+    _WORKSPACE_OBSERVER.schedule(_WorkspaceWatchHandler(), PROJECTS_DIR, recursive=True)
+    _WORKSPACE_OBSERVER.daemon = True
+    _WORKSPACE_OBSERVER.start()
+    WORKSPACE_INDEX.watched = True
+
+@app.on_event("shutdown")
+def _stop_workspace_watcher() -> None:
+    global _WORKSPACE_OBSERVER
+    if _WORKSPACE_OBSERVER is not None:
+        _WORKSPACE_OBSERVER.stop()
+        _WORKSPACE_OBSERVER = None
+        WORKSPACE_INDEX.watched = False
+
+# Held or awaited locks are kept alive by their callers; idle ones drop out of the map.
+_PATH_LOCKS: "weakref.WeakValueDictionary[Tuple[str, str], Any]" = weakref.WeakValueDictionary()
+_PATH_LOCKS_GUARD = threading.Lock()
+
+@contextlib.contextmanager
+def _path_locks(project_id: str, filenames: List[str]):
+    """Hold the write locks of several workspace paths, taken in sorted order so callers never deadlock."""
+    with _PATH_LOCKS_GUARD:
+        locks = [_PATH_LOCKS.setdefault((project_id, f), threading.Lock()) for f in sorted(set(filenames))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+def _atomic_write(out_path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(out_path), f".{os.path.basename(out_path)}.{uuid.uuid4().hex[:8]}{_WRITE_TMP_SUFFIX}")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, out_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+def _disk_hash(out_path: str) -> str:
+    """Content hash of the file on disk; "" when it does not exist."""
+    try:
+        with open(out_path, "rb") as f:
+            return _content_hash(f.read())
+    except FileNotFoundError:
+        return ""
+
+def _hash_conflict(out_path: str, filename: str, expected_hash: Optional[str]) -> Optional[Dict[str, Any]]:
+    if expected_hash is None:
+        return None
+    current = _disk_hash(out_path)
+    if current == expected_hash:
+        return None
+    return {"ok": False, "error": "conflict", "path": f"workspace/{filename}",
+            "expected_hash": expected_hash, "current_hash": current}
+
+def tool_create_file(project_id: str, filename: str, content: str, expected_hash: Optional[str] = None) -> Dict[str, Any]:
     filename = _norm_filename(filename)
     ok, reason = _write_allowed(project_id, filename)
     if not ok:
         return {"ok": False, "error": reason, "path": f"workspace/{filename}"}
     out_path = _resolve_path(project_id, filename)
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(content)
-    return {"ok": True, "path": f"workspace/{filename}", "bytes": len(content.encode("utf-8"))}
-
-def tool_read_file(project_id: str, filename: str) -> Dict[str, Any]:
+    data = content.encode("utf-8")
+    with _path_locks(project_id, [filename]):
+        conflict = _hash_conflict(out_path, filename, expected_hash)
+        if conflict:
+            return conflict
+        _atomic_write(out_path, data)
+        WORKSPACE_INDEX.record_write(project_id, filename, data)
+    return {"ok": True, "path": f"workspace/{filename}", "bytes": len(data), "hash": _content_hash(data)}
+
+_DIGEST_MEMO: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_DIGEST_LOCK = threading.Lock()
+
+def _file_digest(out_path: str) -> str:
+    """sha256 of a file, streamed in chunks and memoized on (path, mtime, size)."""
+    st = os.stat(out_path)
+    key = (out_path, st.st_mtime_ns, st.st_size)
+    with _DIGEST_LOCK:
+        if key in _DIGEST_MEMO:
+            _DIGEST_MEMO.move_to_end(key)
+            return _DIGEST_MEMO[key]
+    digest = hashlib.sha256()
+    with open(out_path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b""):
+            digest.update(chunk)
+    with _DIGEST_LOCK:
+        _DIGEST_MEMO[key] = digest.hexdigest()
+        while len(_DIGEST_MEMO) > 1024:
+            _DIGEST_MEMO.popitem(last=False)
+    return _DIGEST_MEMO[key]
+
+def _grep_file(out_path: str, pattern: str, context: int, max_matches: int) -> Dict[str, Any]:
+    """grep -n style matches with context, streamed line by line."""
+    try:
+        regex = re.compile(pattern)
+    except re.error:
+        regex = re.compile(re.escape(pattern))
+    context = max(0, context)
+    before: deque = deque(maxlen=context)
+    out: List[str] = []
+    lines: List[int] = []
+    last_emitted, after, truncated = 0, 0, False
+    with open(out_path, "r", encoding="utf-8", errors="replace", newline="") as f:
+        for n, line in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+            if regex.search(line):
+                if len(lines) >= max_matches:
+                    truncated = True
+                    break
+                first = before[0][0] if before else n
+                if out and first > last_emitted + 1:
+                    out.append("--")
+                out += [f"{m}-{text}" for m, text in before]
+                before.clear()
+                out.append(f"{n}:{line}")
+                lines.append(n)
+                last_emitted, after = n, context
+            elif after:
+                out.append(f"{n}-{line}")
+                last_emitted, after = n, after - 1
+            else:
+                before.append((n, line))
+    return {"content": "\n".join(out), "matches": lines, "truncated": truncated}
+
+def tool_read_file(project_id: str, filename: str, offset: Optional[int] = None, limit: Optional[int] = None,
+                   unit: str = "line", pattern: Optional[str] = None, context: int = 2,
+                   max_chars: int = READ_FILE_MAX_CHARS) -> Dict[str, Any]:
+    """Read a workspace file: whole (capped at max_chars), a line or byte window, or grep matches.
+
+    Nothing but the requested window is held in memory; `next_offset` is set when more remains.
+    """
     filename = _norm_filename(filename)
     out_path = _resolve_path(project_id, filename)
-    if not os.path.exists(out_path):
+    if not os.path.isfile(out_path):
         return {"ok": False, "error": "File not found", "path": f"workspace/{filename}"}
-    with open(out_path, "r", encoding="utf-8") as f:
-        content = f.read()
-    if len(content) > 200_000:
-        content = content[:200_000] + "\n\n[TRUNCATED]"
-    return {"ok": True, "path": f"workspace/{filename}", "content": content}
-
-def tool_patch_file(project_id: str, filename: str, find: str, replace: str, count: int = 1) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"ok": True, "path": f"workspace/{filename}", "hash": _file_digest(out_path)}
+
+    if pattern:
+        result.update(_grep_file(out_path, pattern, context, READ_GREP_MAX_MATCHES))
+        return result
+
+    if unit == "byte":
+        size = os.path.getsize(out_path)
+        start = min(max(0, offset or 0), size)
+        with open(out_path, "rb") as f:
+            f.seek(start)
+            data = f.read(max(1, min(max_chars, limit if limit is not None else max_chars)))
+        # Stop at a character boundary so the next window starts on a whole UTF-8 sequence.
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        content = decoder.decode(data, final=start + len(data) >= size)
+        pending = len(decoder.getstate()[0])
+        if 0 < pending < len(data):
+            data = data[:-pending]
+        elif pending:
+            content = data.decode("utf-8", errors="replace")
+        result.update(content=content, offset=start, bytes=len(data), size=size)
+        if start + len(data) < size:
+            result["next_offset"] = start + len(data)
+        return result
+
+    with open(out_path, "r", encoding="utf-8", newline="") as f:
+        if offset is None and limit is None:
+            content = f.read(max_chars + 1)
+            if len(content) <= max_chars:
+                result["content"] = content
+                return result
+            cut = content[:max_chars]
+            if "\n" not in cut:
+                # One line longer than the cap (minified files): continue by bytes instead.
+                result.update(content=cut + f"\n[TRUNCATED: read_file with unit='byte', offset={len(cut.encode('utf-8'))} to continue]",
+                              truncated=True, next_offset=len(cut.encode("utf-8")), next_unit="byte")
+                return result
+            cut = cut[:cut.rfind("\n") + 1]
+            shown = cut.count("\n")
+            result.update(content=cut + f"\n[TRUNCATED: read_file with offset={shown} to continue]",
+                          truncated=True, next_offset=shown)
+            return result
+        start = max(0, offset or 0)
+        count = max(0, limit if limit is not None else READ_FILE_DEFAULT_LINES)
+        window = list(itertools.islice(f, start, start + count + 1))
+    more = len(window) > count
+    window = window[:count]
+    if window and len(window[0]) > max_chars:
+        with open(out_path, "r", encoding="utf-8", newline="") as f:
+            line_start = sum(len(line.encode("utf-8")) for line in itertools.islice(f, start))
+        part = window[0][:max_chars]
+        result.update(content=part, start_line=start + 1, end_line=start + 1, truncated=True,
+                      next_offset=line_start + len(part.encode("utf-8")), next_unit="byte")
+        return result
+    while window and sum(map(len, window)) > max_chars:
+        window.pop()
+        more = True
+    result.update(content="".join(window), start_line=start + 1, end_line=start + len(window))
+    if more:
+        result["next_offset"] = start + len(window)
+    return result
+
+_HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+def _parse_unified_diff(diff: str) -> List[Dict[str, Any]]:
+    """Turn a single-file unified diff into find/replace hunks anchored at their old line numbers."""
+    hunks: List[Dict[str, Any]] = []
+    current: Optional[Dict[str, Any]] = None
+    for line in diff.rstrip("\n").splitlines():
+        header = _HUNK_HEADER_RE.match(line)
+        if header:
+            current = {"line": int(header.group(1)), "old": [], "new": []}
+            hunks.append(current)
+        elif current is None or line.startswith(("---", "+++")) and not current["old"] and not current["new"]:
+            continue
+        elif line.startswith("\\"):
+            continue
+        elif line.startswith("-"):
+            current["old"].append(line[1:])
+        elif line.startswith("+"):
+            current["new"].append(line[1:])
+        else:
+            text = line[1:] if line.startswith(" ") else line
+            current["old"].append(text)
+            current["new"].append(text)
+    out = []
+    for h in hunks:
+        if h["old"]:
+            out.append({"find": "\n".join(h["old"]), "replace": "\n".join(h["new"]), "line": h["line"], "lines": True})
+        else:
+            # Pure insertion: "-N,0" means after old line N.
+            out.append({"start_line": h["line"] + 1, "end_line": h["line"], "replace": "\n".join(h["new"])})
+    if not out:
+        raise ValueError("No hunks found in diff.")
+    return out
+
+def _line_offsets(text: str) -> List[int]:
+    offsets = [0]
+    for line in text.splitlines(keepends=True):
+        offsets.append(offsets[-1] + len(line))
+    return offsets
+
+def _line_span(text: str, offsets: List[int], start: int, end: int) -> Tuple[int, int]:
+    """Character span of lines [start, end) without the final line break."""
+    lo, hi = offsets[start], offsets[end]
+    if end > start:
+        last = text[offsets[end - 1]:hi]
+        hi -= len(last) - len(last.rstrip("\r\n"))
+    return lo, hi
+
+def _indent_of(line: str) -> str:
+    return line[:len(line) - len(line.lstrip())]
+
+def _reindent(text: str, want: List[str], found: List[str]) -> str:
+    """Carry the indentation of the matched file lines over to the replacement (offset or scale)."""
+    pairs = [(len(_indent_of(w)), _indent_of(f)) for w, f in zip(want, found) if w.strip()]
+    if all(len(f) == w for w, f in pairs):
+        return text
+    unit = next((f[0] for _, f in pairs if f), " ")
+    shifts = {len(f) - w for w, f in pairs}
+    ratios = {len(f) / w for w, f in pairs if w}
+    if len(shifts) == 1:
+        shift = shifts.pop()
+        width = lambda n: n + shift
+    elif len(ratios) == 1 and all(not f for w, f in pairs if not w):
+        ratio = ratios.pop()
+        width = lambda n: round(n * ratio)
+    else:
+        return text
+    out = []
+    for line in text.split("\n"):
+        n = len(_indent_of(line))
+        out.append(unit * max(0, width(n)) + line[n:] if line.strip() else line)
+    return "\n".join(out)
+
+def _trim_blank_lines(block: List[str]) -> List[str]:
+    lo, hi = 0, len(block)
+    while lo < hi and not block[lo].strip():
+        lo += 1
+    while hi > lo and not block[hi - 1].strip():
+        hi -= 1
+    return block[lo:hi]
+
+def _locate_hunk(text: str, lines: List[str], offsets: List[int], hunk: Dict[str, Any]) -> Tuple[List[Tuple[int, int, str]], Dict[str, Any]]:
+    """Resolve one hunk to character spans of `text` plus their replacement text."""
+    replace = str(hunk.get("replace", ""))
+    if hunk.get("start_line") is not None and not hunk.get("find"):
+        start = int(hunk["start_line"])
+        end = start if hunk.get("end_line") is None else int(hunk["end_line"])
+        if start < 1 or end < start - 1 or end > len(lines):
+            raise ValueError(f"Line range {start}-{end} is outside the file ({len(lines)} lines).")
+        if end == start - 1:
+            pos = offsets[start - 1]
+            if pos == len(text) and text and not text.endswith("\n"):
+                return [(pos, pos, "\n" + replace.rstrip("\n"))], {"match": "insert", "line": start}
+            return [(pos, pos, replace + "\n")], {"match": "insert", "line": start}
+        lo, hi = _line_span(text, offsets, start - 1, end)
+        return [(lo, hi, replace.rstrip("\n"))], {"match": "line_range", "line": start}
+
+    find = str(hunk.get("find", ""))
+    if not find:
+        raise ValueError("Hunk needs find text or a start_line.")
+    hint = int(hunk.get("line") or hunk.get("start_line") or 0)
+    count = int(hunk.get("count", 1))
+    if count == 0:
+        raise ValueError("count must be at least 1 (or -1 for every match).")
+
+    def nearest(candidates: List[int], key: Callable[[int], int]) -> List[int]:
+        if hint and count == 1:
+            candidates = sorted(candidates, key=lambda c: abs(key(c) - hint))
+        return candidates if count < 0 else candidates[:count]
+
+    if not hunk.get("lines"):
+        found, pos = [], text.find(find)
+        while pos != -1:
+            found.append(pos)
+            pos = text.find(find, pos + len(find))
+        if found:
+            picked = nearest(found, lambda p: bisect.bisect_right(offsets, p))
+            return [(p, p + len(find), replace) for p in picked], {"match": "exact", "line": bisect.bisect_right(offsets, picked[0])}
+
+    # Diff hunks are exact about blank lines; free-form find/replace text loses its blank edges on both sides.
+    want = find.split("\n") if hunk.get("lines") else _trim_blank_lines(find.split("\n"))
+    if not any(l.strip() for l in want):
+        raise ValueError("Hunk find text is blank.")
+    size = len(want)
+    stripped = [l.strip() for l in lines]
+    target = [l.strip() for l in want]
+    replace_block = replace if hunk.get("lines") else "\n".join(_trim_blank_lines(replace.split("\n")))
+
+    def spans_for(starts: List[int], how: str, extra: Optional[Dict[str, Any]] = None):
+        picked = nearest(starts, lambda i: i + 1)
+        spans = []
+        for i in picked:
+            lo, hi = _line_span(text, offsets, i, i + size)
+            if hunk.get("lines") and not replace_block:
+                hi = offsets[i + size]  # a pure deletion takes its line breaks with it
+            spans.append((lo, hi, _reindent(replace_block, want, lines[i:i + size])))
+        return spans, dict({"match": how, "line": picked[0] + 1}, **(extra or {}))
+
+    matches: List[int] = []
+    for i in range(len(lines) - size + 1):
+        if stripped[i:i + size] == target and (not matches or i >= matches[-1] + size):
+            matches.append(i)
+    if matches:
+        return spans_for(matches, "whitespace")
+    if size < 2:
+        # A single partial line is too little context to rewrite a whole line on a fuzzy match.
+        raise ValueError("Find-text not found; patch not applied.")
+
+    needle = "\n".join(target)
+    best, best_score, tie = -1, 0.0, False
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    matcher.set_seq2(needle)
+    for i in range(max(0, len(lines) - size + 1)):
+        matcher.set_seq1("\n".join(stripped[i:i + size]))
+        if matcher.real_quick_ratio() < PATCH_FUZZY_THRESHOLD or matcher.quick_ratio() < PATCH_FUZZY_THRESHOLD:
+            continue
+        score = matcher.ratio()
+        if score > best_score + 1e-9:
+            best, best_score, tie = i, score, False
+        elif abs(score - best_score) <= 1e-9 and hint and abs(i + 1 - hint) < abs(best + 1 - hint):
+            best = i
+        elif abs(score - best_score) <= 1e-9:
+            tie = True
+    if best >= 0 and best_score >= PATCH_FUZZY_THRESHOLD and not (tie and not hint):
+        return spans_for([best], "fuzzy", {"score": round(best_score, 3)})
+    raise ValueError("Find-text not found; patch not applied.")
+
+def _apply_hunks(text: str, hunks: List[Dict[str, Any]]) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    """Apply hunks addressed against the original `text`.
+
+    Each hunk is {find, replace[, count, line]} or {start_line[, end_line], replace}. Find text
+    is matched exactly, then line-by-line ignoring indentation, then fuzzily. Returns the new
+    text (None unless every hunk applied) and one result per hunk.
+    """
+    lines = text.splitlines()
+    offsets = _line_offsets(text)
+    results: List[Dict[str, Any]] = []
+    edits: List[Tuple[int, int, str, int]] = []
+    for n, hunk in enumerate(hunks):
+        try:
+            spans, info = _locate_hunk(text, lines, offsets, hunk)
+        except (ValueError, TypeError) as e:
+            results.append({"ok": False, "error": str(e)})
+            continue
+        results.append(dict(info, ok=True))
+        edits += [(lo, hi, rep, n) for lo, hi, rep in spans]
+    edits.sort()
+    for (lo1, hi1, _, n1), (lo2, hi2, _, n2) in zip(edits, edits[1:]):
+        if lo2 < hi1 or (lo2 == hi1 == lo1 == hi2 and n1 != n2):
+            results[n2].update(ok=False, error=f"Overlaps hunk {n1 + 1}.")
+    if not all(r["ok"] for r in results):
+        return None, results
+    for lo, hi, rep, _ in reversed(edits):
+        text = text[:lo] + rep + text[hi:]
+    return text, results
+
+def _patch_hunks(find: str = "", replace: str = "", count: int = 1, hunks: Optional[List[Dict[str, Any]]] = None,
+                 diff: Optional[str] = None) -> List[Dict[str, Any]]:
+    if diff:
+        return _parse_unified_diff(diff)
+    if hunks:
+        return [dict(h) for h in hunks]
+    return [{"find": find, "replace": replace, "count": count}]
+
+def tool_patch_file(project_id: str, filename: str, find: str = "", replace: str = "", count: int = 1,
+                    expected_hash: Optional[str] = None, hunks: Optional[List[Dict[str, Any]]] = None,
+                    diff: Optional[str] = None) -> Dict[str, Any]:
     filename = _norm_filename(filename)
     ok, reason = _write_allowed(project_id, filename)
     if not ok:
         return {"ok": False, "error": reason, "path": f"workspace/{filename}"}
     out_path = _resolve_path(project_id, filename)
-    if not os.path.exists(out_path):
-        raise ValueError("File not found for patching.")
-    with open(out_path, "r", encoding="utf-8") as f:
-        content = f.read()
-    if find not in content:
-        return {"ok": False, "path": f"workspace/{filename}", "error": "Find-text not found; patch not applied."}
-    new_content = content.replace(find, replace, count)
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(new_content)
-    return {"ok": True, "path": f"workspace/{filename}", "patched": True}
-
-def tool_list_workspace(project_id: str) -> Dict[str, Any]:
-    base = _project_root(project_id)
-    files: List[str] = []
-    for root_dir, _, fnames in os.walk(base):
-        for fn in fnames:
-            full = os.path.join(root_dir, fn)
-            rel = os.path.relpath(full, base).replace('\\', '/')
-            files.append(rel)
-    files.sort()
-    return {'ok': True, 'files': files}
-
-def tool_describe_visuals(project_id: str, model: str) -> Dict[str, Any]:
+    with _path_locks(project_id, [filename]):
+        if not os.path.exists(out_path):
+            raise ValueError("File not found for patching.")
+        conflict = _hash_conflict(out_path, filename, expected_hash)
+        if conflict:
+            return conflict
+        with open(out_path, "r", encoding="utf-8", newline="") as f:
+            content = f.read()
+        try:
+            patched, results = _apply_hunks(content, _patch_hunks(find, replace, count, hunks, diff))
+        except ValueError as e:
+            return {"ok": False, "path": f"workspace/{filename}", "error": str(e)}
+        if patched is None:
+            errors = [f"hunk {i + 1}: {r['error']}" for i, r in enumerate(results) if not r["ok"]]
+            error = results[0]["error"] if len(results) == 1 else "; ".join(errors)
+            return {"ok": False, "path": f"workspace/{filename}", "error": error, "hunks": results}
+        data = patched.encode("utf-8")
+        _atomic_write(out_path, data)
+        WORKSPACE_INDEX.record_write(project_id, filename, data)
+    return {"ok": True, "path": f"workspace/{filename}", "patched": True, "hash": _content_hash(data), "hunks": results}
+
+def tool_list_workspace(project_id: str, prefix: str = "", offset: int = 0, limit: Optional[int] = None,
+                        detail: bool = False) -> Dict[str, Any]:
+    paths = WORKSPACE_INDEX.paths(project_id)
+    if prefix:
+        prefix = prefix.lstrip("/").replace("\\", "/")
+        lo = bisect.bisect_left(paths, prefix)
+        hi = bisect.bisect_left(paths, prefix + "\uffff")
+        paths = paths[lo:hi]
+    total = len(paths)
+    offset = max(0, offset)
+    end = total if limit is None else min(total, offset + max(0, limit))
+    files = paths[offset:end]
+    result: Dict[str, Any] = {'ok': True, 'files': files, 'total': total}
+    if end < total:
+        result['next_offset'] = end
+    if detail:
+        result['entries'] = [
+            dict(WORKSPACE_INDEX.entry(project_id, p) or {"path": p}, hash=WORKSPACE_INDEX.file_hash(project_id, p))
+            for p in files
+        ]
+    return result
+
+# describe_visuals results per project, keyed on a fingerprint of the preview sources.
+VISUALS_CACHE: Dict[str, Dict[str, Any]] = {}
+_VISUALS_INFLIGHT: Dict[Tuple[str, str, str], "asyncio.Future"] = {}
+_PREVIEW_ASSETS: Dict[str, List[str]] = {}
+_ASSET_REF_RE = re.compile(r"""<(?:link|script|img|source)\b[^>]*?\b(?:href|src)\s*=\s*["']([^"'#?]+)""", re.I)
+
+def _preview_assets(project_id: str, html_hash: str) -> List[str]:
+    """Local files referenced from preview/index.html, memoized per HTML content hash."""
+    if html_hash not in _PREVIEW_ASSETS:
+        if len(_PREVIEW_ASSETS) > 256:
+            _PREVIEW_ASSETS.clear()
+        with open(_resolve_path(project_id, "preview/index.html"), "r", encoding="utf-8") as f:
+            html = f.read()
+        assets = set()
+        for ref in _ASSET_REF_RE.findall(html):
+            if "://" in ref or ref.startswith(("//", "data:", "/")):
+                continue
+            rel = os.path.normpath(os.path.join("preview", ref)).replace("\\", "/")
+            if not rel.startswith(".."):
+                assets.add(rel)
+        _PREVIEW_ASSETS[html_hash] = sorted(assets - {"preview/index.html"})
+    return _PREVIEW_ASSETS[html_hash]
+
+def _preview_fingerprint(project_id: str) -> Optional[str]:
+    html_hash = WORKSPACE_INDEX.file_hash(project_id, "preview/index.html")
+    if html_hash is None:
+        return None
+    paths = sorted(set(_preview_assets(project_id, html_hash)) | {"preview/styles.css"})
+    parts = [html_hash] + [f"{p}:{WORKSPACE_INDEX.file_hash(project_id, p) or ''}" for p in paths]
+    return _content_hash("|".join(parts).encode("utf-8"))
+
+def _read_preview_sources(project_id: str) -> Tuple[str, str, Dict[str, str]]:
+    """HTML, styles.css and every other local asset the fingerprint covers (binary ones by hash)."""
+    html_path = _resolve_path(project_id, "preview/index.html")
+    css_path = _resolve_path(project_id, "preview/styles.css")
+    html_content = ""
+    if os.path.exists(html_path):
+        with open(html_path, "r", encoding="utf-8") as f:
+            html_content = f.read()
+    css_content = ""
+    if os.path.exists(css_path):
+        with open(css_path, "r", encoding="utf-8") as f:
+            css_content = f.read()
+    assets: Dict[str, str] = {}
+    html_hash = WORKSPACE_INDEX.file_hash(project_id, "preview/index.html")
+    for rel in _preview_assets(project_id, html_hash) if html_hash else []:
+        if rel == "preview/styles.css":
+            continue
+        try:
+            with open(_resolve_path(project_id, rel), "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        try:
+            assets[rel] = data.decode("utf-8")
+        except UnicodeDecodeError:
+            assets[rel] = f"<binary file, {len(data)} bytes, sha256 {_content_hash(data)}>"
+    return html_content, css_content, assets
+
+async def _generate_visual_description(project_id: str, model: str, fingerprint: str) -> str:
+    html_content, css_content, assets = await anyio.to_thread.run_sync(_read_preview_sources, project_id)
+    if not html_content:
+        return "The preview is empty. There is no HTML content."
+
+    visualizer_prompt = (
+        "You are an expert front-end developer. Based on the following HTML and CSS, render the page in your mind and describe its visual appearance in plain English. "
+        "Be detailed and literal. Describe the layout, colors, typography, spacing, and key elements. "
+        "This description will be used by other agents to understand the current state of the UI."
+    )
+
+    resp = await mistral_post_async("/v1/chat/completions", {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": visualizer_prompt},
+            {"role": "user", "content": json.dumps({"html": html_content, "css": css_content, **({"assets": assets} if assets else {})})},
+        ],
+        "temperature": 0.1,
+    }, cache=True, site="visualizer")
+    description = ((resp.get("choices") or [{}])[0].get("message") or {}).get("content", "")
+    VISUALS_CACHE[project_id] = {"fingerprint": fingerprint, "model": model, "description": description}
+    return description
+
+async def _describe_visuals_once(project_id: str, model: str, fingerprint: str) -> str:
+    # Concurrent requests for the same preview state share one LLM call.
+    key = (project_id, model, fingerprint)
+    task = _VISUALS_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_generate_visual_description(project_id, model, fingerprint))
+        _VISUALS_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _VISUALS_INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
+
+def _cached_visuals(project_id: str, model: str, fingerprint: str) -> Optional[str]:
+    cached = VISUALS_CACHE.get(project_id)
+    if cached and cached["fingerprint"] == fingerprint and cached["model"] == model:
+        return cached["description"]
+    return None
+
+async def _refresh_visuals(project_id: str, model: str) -> None:
+    fingerprint = await anyio.to_thread.run_sync(_preview_fingerprint, project_id)
+    if fingerprint is not None and _cached_visuals(project_id, model, fingerprint) is None:
+        await _describe_visuals_once(project_id, model, fingerprint)
+
+def _schedule_visuals_refresh(project_id: str, model: str) -> None:
+    if DESCRIBE_VISUALS_EAGER:
+        _spawn(_refresh_visuals(project_id, model))
+
+async def tool_describe_visuals(project_id: str, model: str) -> Dict[str, Any]:
     _emit_event(project_id, "describe_visuals", "Visualizer", "Analyzing UI code to describe visuals...", status="Working")
     try:
-        html_path = _resolve_path(project_id, "preview/index.html")
-        css_path = _resolve_path(project_id, "preview/styles.css")
-        html_content = ""
-        if os.path.exists(html_path):
-            with open(html_path, "r", encoding="utf-8") as f:
-                html_content = f.read()
-        css_content = ""
-        if os.path.exists(css_path):
-            with open(css_path, "r", encoding="utf-8") as f:
-                css_content = f.read()
-        
-        if not html_content:
+        fingerprint = await anyio.to_thread.run_sync(_preview_fingerprint, project_id)
+        if fingerprint is None:
             return {"ok": True, "description": "The preview is empty. There is no HTML content."}
-
-        visualizer_prompt = (
-            "You are an expert front-end developer. Based on the following HTML and CSS, render the page in your mind and describe its visual appearance in plain English. "
-            "Be detailed and literal. Describe the layout, colors, typography, spacing, and key elements. "
-            "This description will be used by other agents to understand the current state of the UI."
-        )
-        
-        resp = mistral_post("/v1/chat/completions", {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": visualizer_prompt},
-                {"role": "user", "content": json.dumps({"html": html_content, "css": css_content})},
-            ],
-            "temperature": 0.1,
-        })
-        description = ((resp.get("choices") or [{}])[0].get("message") or {}).get("content", "")
+        description = _cached_visuals(project_id, model, fingerprint)
+        if description is not None:
+            _emit_event(project_id, "describe_visuals", "Visualizer", "Preview unchanged; reused visual description.", status="Done")
+            return {"ok": True, "description": description, "cached": True}
+        description = await _describe_visuals_once(project_id, model, fingerprint)
         _emit_event(project_id, "describe_visuals", "Visualizer", "Visual description generated.", status="Done")
         return {"ok": True, "description": description}
     except Exception as e:
         return {"ok": False, "error": f"Failed to describe visuals: {str(e)}"}
 
+_EXPECTED_HASH_PARAM = {"type": "string", "description": "Hash returned by an earlier read or write; the call fails with a conflict if the file changed since."}
+
 TOOLS = [
     {"type": "function", "function": {
         "name": "create_file",
         "description": "Create/overwrite a file in workspace/. For UI use 'preview/index.html', 'preview/styles.css', etc.",
-        "parameters": {"type": "object", "properties": {"filename": {"type": "string"}, "content": {"type": "string"}}, "required": ["filename", "content"]},
+        "parameters": {"type": "object", "properties": {"filename": {"type": "string"}, "content": {"type": "string"},
+                                                       "expected_hash": _EXPECTED_HASH_PARAM},
+                       "required": ["filename", "content"]},
     }},
     {"type": "function", "function": {
         "name": "read_file",
-        "description": "Read a file from workspace/ (use before editing).",
-        "parameters": {"type": "object", "properties": {"filename": {"type": "string"}}, "required": ["filename"]},
+        "description": "Read a file from workspace/ (use before editing). For large files read a window with offset/limit "
+                       "(lines, or bytes with unit='byte') or search with `pattern` (regex; returns matching lines with "
+                       "`context` lines around them). Continue from `next_offset` when present (in bytes when `next_unit` is 'byte').",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "filename": {"type": "string"},
+                "offset": {"type": "integer"},
+                "limit": {"type": "integer"},
+                "unit": {"type": "string", "enum": ["line", "byte"], "default": "line"},
+                "pattern": {"type": "string"},
+                "context": {"type": "integer", "default": 2}
+            },
+            "required": ["filename"]
+        },
     }},
     {"type": "function", "function": {
         "name": "patch_file",
-        "description": "Patch an existing file by replacing a matching text snippet (string replace). Use read_file first.",
+        "description": "Patch an existing file. Give find/replace, several `hunks`, or a unified `diff`. Find text tolerates "
+                       "indentation differences and small typos; a hunk may instead address start_line/end_line (1-based). "
+                       "Every hunk is matched against the file as it was before this call.",
         "parameters": {
             "type": "object",
             "properties": {
                 "filename": {"type": "string"},
                 "find": {"type": "string"},
                 "replace": {"type": "string"},
-                "count": {"type": "integer", "default": 1}
+                "count": {"type": "integer", "default": 1},
+                "hunks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "find": {"type": "string"},
+                            "replace": {"type": "string"},
+                            "count": {"type": "integer", "default": 1},
+                            "start_line": {"type": "integer"},
+                            "end_line": {"type": "integer"}
+                        },
+                        "required": ["replace"]
+                    }
+                },
+                "diff": {"type": "string"},
+                "expected_hash": _EXPECTED_HASH_PARAM
             },
-            "required": ["filename", "find", "replace"]
+            "required": ["filename"]
+        },
+    }},
+    {"type": "function", "function": {
+        "name": "apply_changes",
+        "description": "Apply several file changes in one call, all-or-nothing (e.g. create index.html, styles.css and app.js together). "
+                       "Each change is {op: create|patch|delete, filename, content (create), find/replace/count (patch)}.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "changes": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "op": {"type": "string", "enum": ["create", "patch", "delete"]},
+                            "filename": {"type": "string"},
+                            "content": {"type": "string"},
+                            "find": {"type": "string"},
+                            "replace": {"type": "string"},
+                            "count": {"type": "integer", "default": 1},
+                            "expected_hash": _EXPECTED_HASH_PARAM
+                        },
+                        "required": ["op", "filename"]
+                    }
+                }
+            },
+            "required": ["changes"]
         },
     }},
     {"type": "function", "function": {
         "name": "list_workspace",
-        "description": "List all files in workspace/.",
-        "parameters": {"type": "object", "properties": {}, "required": []},
+        "description": "List files in workspace/, optionally only those under a path prefix (e.g. 'preview/'). Page with offset/limit.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "prefix": {"type": "string"},
+                "offset": {"type": "integer", "default": 0},
+                "limit": {"type": "integer"}
+            },
+            "required": []
+        },
     }},
     {"type": "function", "function": {
         "name": "describe_visuals",
@@ -524,51 +2869,278 @@ TOOLS = [
     {"type": "function", "function": {
         "name": "delete_file",
         "description": "Deletes a file from the workspace.",
-        "parameters": {"type": "object", "properties": {"filename": {"type": "string"}}, "required": ["filename"]},
+        "parameters": {"type": "object", "properties": {"filename": {"type": "string"}, "expected_hash": _EXPECTED_HASH_PARAM},
+                       "required": ["filename"]},
     }},
 ]
 
-def tool_delete_file(project_id: str, filename: str) -> Dict[str, Any]:
+def tool_delete_file(project_id: str, filename: str, expected_hash: Optional[str] = None) -> Dict[str, Any]:
     filename = _norm_filename(filename)
     ok, reason = _write_allowed(project_id, filename)
     if not ok:
         return {"ok": False, "error": reason, "path": f"workspace/{filename}"}
     out_path = _resolve_path(project_id, filename)
-    if not os.path.exists(out_path):
-        return {"ok": False, "error": "File not found", "path": f"workspace/{filename}"}
-    os.remove(out_path)
+    with _path_locks(project_id, [filename]):
+        if not os.path.exists(out_path):
+            return {"ok": False, "error": "File not found", "path": f"workspace/{filename}"}
+        conflict = _hash_conflict(out_path, filename, expected_hash)
+        if conflict:
+            return conflict
+        os.remove(out_path)
+        WORKSPACE_INDEX.record_delete(project_id, filename)
     return {"ok": True, "path": f"workspace/{filename}"}
 
-def run_tool(project_id: str, model: str, tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+def tool_read_files(project_id: str, filenames: List[str]) -> Dict[str, Any]:
+    files = []
+    for name in filenames:
+        try:
+            files.append(tool_read_file(project_id, str(name)))
+        except (ValueError, OSError) as e:  # includes UnicodeDecodeError for binary files
+            files.append({"ok": False, "error": str(e), "path": f"workspace/{name}"})
+    return {"ok": all(f.get("ok") for f in files), "files": files}
+
+_CHANGE_OPS = ("create", "patch", "delete")
+
+def tool_apply_changes(project_id: str, changes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Apply create/patch/delete operations all-or-nothing.
+
+    Operations run in order against an in-memory view of the affected files; the
+    workspace is only touched once every operation succeeded. `results` has one
+    entry per operation either way.
+    """
+    results: List[Dict[str, Any]] = []
+    names: List[str] = []
+    for change in changes:
+        if not isinstance(change, dict):
+            error = "each change must be an object"
+            return {"ok": False, "applied": False, "error": error, "results": results + [{"ok": False, "error": error}]}
+        op = str(change.get("op", "")).lower()
+        try:
+            name = _norm_filename(str(change.get("filename") or change.get("path") or ""))
+        except ValueError as e:
+            return {"ok": False, "applied": False, "error": str(e), "results": results + [{"ok": False, "op": op, "error": str(e)}]}
+        ok, reason = _write_allowed(project_id, name) if op in _CHANGE_OPS else (False, f"unknown op: {op!r}")
+        if not ok:
+            return {"ok": False, "applied": False, "error": reason,
+                    "results": results + [{"ok": False, "op": op, "path": f"workspace/{name}", "error": reason}]}
+        results.append({"ok": None, "op": op, "path": f"workspace/{name}"})
+        names.append(name)
+
+    with _path_locks(project_id, names):
+        original: Dict[str, Optional[bytes]] = {}
+        staged: Dict[str, Optional[bytes]] = {}
+
+        def current(name: str) -> Optional[bytes]:
+            if name not in original:
+                try:
+                    with open(_resolve_path(project_id, name), "rb") as f:
+                        original[name] = f.read()
+                except FileNotFoundError:
+                    original[name] = None
+                staged[name] = original[name]
+            return staged[name]
+
+        failed = None
+        for i, (change, name) in enumerate(zip(changes, names)):
+            result, data = results[i], current(name)
+            expected = change.get("expected_hash")
+            if expected is not None and (_content_hash(data) if data is not None else "") != expected:
+                result.update(ok=False, error="conflict", current_hash=_content_hash(data) if data is not None else "")
+            elif result["op"] == "create":
+                staged[name] = str(change.get("content", "")).encode("utf-8")
+            elif data is None:
+                result.update(ok=False, error="File not found")
+            elif result["op"] == "delete":
+                staged[name] = None
+            else:
+                try:
+                    patched, hunks = _apply_hunks(data.decode("utf-8"), _patch_hunks(
+                        str(change.get("find", "")), str(change.get("replace", "")), int(change.get("count", 1)),
+                        change.get("hunks"), change.get("diff")))
+                except (ValueError, TypeError) as e:  # bad count/hunks, or content that is not UTF-8
+                    patched, hunks = None, [{"ok": False, "error": str(e)}]
+                result["hunks"] = hunks
+                if patched is None:
+                    result.update(ok=False, error="; ".join(h["error"] for h in hunks if not h["ok"]))
+                else:
+                    staged[name] = patched.encode("utf-8")
+            if result["ok"] is False:
+                failed = result["error"]
+                break
+            result["ok"] = True
+            if staged[name] is not None:
+                result["hash"] = _content_hash(staged[name])
+        if failed is not None:
+            for result in results:
+                if result["ok"] is None:
+                    result.update(ok=False, error="not attempted")
+            return {"ok": False, "applied": False, "error": failed, "results": results}
+
+        committed: List[str] = []
+        try:
+            for name, data in staged.items():
+                if data == original[name]:
+                    continue
+                out_path = _resolve_path(project_id, name)
+                if data is None:
+                    os.remove(out_path)
+                else:
+                    _atomic_write(out_path, data)
+                committed.append(name)
+        except Exception:
+            for name in committed:
+                out_path = _resolve_path(project_id, name)
+                if original[name] is None:
+                    with contextlib.suppress(OSError):
+                        os.remove(out_path)
+                else:
+                    _atomic_write(out_path, original[name])
+            WORKSPACE_INDEX.mark_dirty(project_id)
+            raise
+        for name in committed:
+            if staged[name] is None:
+                WORKSPACE_INDEX.record_delete(project_id, name)
+            else:
+                WORKSPACE_INDEX.record_write(project_id, name, staged[name])
+    return {"ok": True, "applied": True, "results": results}
+
+async def run_tool(project_id: str, model: str, tool_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    if tool_name == "describe_visuals":
+        return await tool_describe_visuals(project_id=project_id, model=model)
     if tool_name == "create_file":
-        return tool_create_file(project_id=project_id, filename=args["filename"], content=args["content"])
-    if tool_name == "read_file":
-        return tool_read_file(project_id=project_id, filename=args["filename"])
-    if tool_name == "patch_file":
-        return tool_patch_file(project_id=project_id, filename=args["filename"], find=args["find"], replace=args["replace"], count=int(args.get("count", 1)))
-    if tool_name == "list_workspace":
-        return tool_list_workspace(project_id=project_id)
+        call = functools.partial(tool_create_file, project_id=project_id, filename=args["filename"], content=args["content"],
+                                 expected_hash=args.get("expected_hash"))
+    elif tool_name == "read_file":
+        call = functools.partial(
+            tool_read_file, project_id=project_id, filename=args["filename"],
+            offset=int(args["offset"]) if args.get("offset") is not None else None,
+            limit=int(args["limit"]) if args.get("limit") is not None else None,
+            unit=str(args.get("unit") or "line"), pattern=args.get("pattern") or None,
+            context=int(args.get("context", 2)), max_chars=READ_FILE_TOOL_MAX_CHARS)
+    elif tool_name == "patch_file":
+        call = functools.partial(tool_patch_file, project_id=project_id, filename=args["filename"], find=str(args.get("find", "")),
+                                 replace=str(args.get("replace", "")), count=int(args.get("count", 1)),
+                                 hunks=args.get("hunks"), diff=args.get("diff"), expected_hash=args.get("expected_hash"))
+    elif tool_name == "list_workspace":
+        call = functools.partial(tool_list_workspace, project_id=project_id, prefix=str(args.get("prefix", "")),
+                                 offset=int(args.get("offset", 0)), limit=int(args["limit"]) if args.get("limit") else None)
+    elif tool_name == "delete_file":
+        call = functools.partial(tool_delete_file, project_id=project_id, filename=args["filename"],
+                                 expected_hash=args.get("expected_hash"))
+    elif tool_name == "apply_changes":
+        call = functools.partial(tool_apply_changes, project_id=project_id, changes=list(args.get("changes") or []))
+    else:
+        raise ValueError(f"Unknown tool: {tool_name}")
+    return await anyio.to_thread.run_sync(call)
+
+READ_ONLY_TOOLS = {"read_file", "list_workspace", "describe_visuals"}
+
+def _tool_args(tc: Dict[str, Any]) -> Dict[str, Any]:
+    raw = (tc.get("function") or {}).get("arguments") or {}
+    if isinstance(raw, str):
+        raw = _try_parse_json(raw) if raw.strip() else {}
+    if not isinstance(raw, dict):
+        raise ValueError("Tool arguments must be a JSON object.")
+    return raw
+
+def _tool_call_paths(tool_name: str, args: Dict[str, Any]) -> Optional[set]:
+    # None means the call may touch any path in the project.
+    if tool_name in ("create_file", "read_file", "patch_file", "delete_file"):
+        try:
+            return {_norm_filename(str(args.get("filename", "")))}
+        except ValueError:
+            return set()
+    if tool_name == "apply_changes":
+        try:
+            return {_norm_filename(str(c.get("filename") or c.get("path") or "")) for c in args.get("changes") or []}
+        except (ValueError, AttributeError):
+            return set()
     if tool_name == "describe_visuals":
-        return tool_describe_visuals(project_id=project_id, model=model)
-    if tool_name == "delete_file":
-        return tool_delete_file(project_id=project_id, filename=args["filename"])
-    raise ValueError(f"Unknown tool: {tool_name}")
+        return {"preview/index.html", "preview/styles.css"}
+    return None
+
+def _written_files(tool_calls: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> List[str]:
+    touched = []
+    for tc, result in zip(tool_calls, results):
+        name = (tc.get("function") or {}).get("name")
+        if name in READ_ONLY_TOOLS or not (result.get("result") or {}).get("ok"):
+            continue
+        try:
+            touched += sorted(_tool_call_paths(name, _tool_args(tc)) or [])
+        except Exception:
+            continue
+    return touched
+
+def _tool_calls_conflict(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    if a["read_only"] and b["read_only"]:
+        return False
+    if a["paths"] is None or b["paths"] is None:
+        return True
+    return bool(a["paths"] & b["paths"])
+
+async def _run_tool_calls(project_id: str, model: str, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Run one step's tool calls concurrently; calls touching the same path keep their original order."""
+    specs: List[Dict[str, Any]] = []
+    for tc in tool_calls:
+        name = (tc.get("function") or {}).get("name", "")
+        try:
+            args = _tool_args(tc)
+            specs.append({"name": name, "args": args, "paths": _tool_call_paths(name, args),
+                          "read_only": name in READ_ONLY_TOOLS, "error": None})
+        except Exception as e:
+            specs.append({"name": name, "args": {}, "paths": set(), "read_only": True, "error": e})
+
+    limiter = asyncio.Semaphore(WORKFLOW_TOOL_CONCURRENCY)
+    done = [asyncio.Event() for _ in tool_calls]
+    results: List[Dict[str, Any]] = [{} for _ in tool_calls]
+
+    async def run_one(i: int) -> None:
+        spec = specs[i]
+        try:
+            for j in range(i):
+                if _tool_calls_conflict(specs[j], spec):
+                    await done[j].wait()
+            if spec["error"] is not None:
+                raise spec["error"]
+            async with limiter:
+                result = await run_tool(project_id, model, spec["name"], spec["args"])
+        except Exception as e:
+            result = {"ok": False, "error": str(e)}
+        finally:
+            done[i].set()
+        results[i] = {"tool_call_id": tool_calls[i].get("id"), "result": result}
+
+    await asyncio.gather(*(run_one(i) for i in range(len(tool_calls))))
+    return results
 
 class WriteRequest(BaseModel):
     project_id: str = "default"
     path: str
     content: str
+    expected_hash: Optional[str] = None
 
 class PatchRequest(BaseModel):
     project_id: str = "default"
     path: str
-    find: str
-    replace: str
+    find: str = ""
+    replace: str = ""
     count: int = 1
+    expected_hash: Optional[str] = None
+    hunks: Optional[List[Dict[str, Any]]] = None
+    diff: Optional[str] = None
 
 class DeleteRequest(BaseModel):
     project_id: str = "default"
     path: str
+    expected_hash: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    project_id: str = "default"
+    operations: List[Dict[str, Any]]
+
+class ReadManyRequest(BaseModel):
+    project_id: str = "default"
+    paths: List[str]
 
 class WorkflowRequest(BaseModel):
     model: str
@@ -578,15 +3150,43 @@ class WorkflowRequest(BaseModel):
     enable_postprocess: bool = True
     max_steps: int = Field(10, ge=1, le=25)
     permissions: Dict[str, Any] = Field(default_factory=dict)
+    plan: Optional[Dict[str, Any]] = None  # precomputed (e.g. user-approved) plan; skips the planning call
 
 class PermissionsRequest(BaseModel):
     project_id: str = "default"
     permissions: Dict[str, Any] = Field(default_factory=dict)
 
-def _is_user_confirmation(model: str, user_message: str, chat_history: List[Dict[str, Any]]) -> Tuple[str, float]:
-    context = chat_history[-4:] + [{"role": "user", "content": user_message}]
+async def _classify(kind: str, text: str, ask_llm: Callable[[], Awaitable[Tuple[Any, ...]]],
+                    fallback: Tuple[Any, ...]) -> Tuple[Tuple[Any, ...], str]:
+    """Answer from LOCAL_CLASSIFIER when it is confident, otherwise ask the LLM and log its label.
+    Returns (result, source) where source is "local", "llm" or "fallback"."""
+    label, conf = LOCAL_CLASSIFIER.predict(kind, text) if FAST_CLASSIFIER else (None, 0.0)
+    if label is not None and conf >= FAST_CLASSIFIER_THRESHOLD:
+        LOCAL_CLASSIFIER.record(kind, text, label, "local", (label, conf))
+        if random.random() < FAST_CLASSIFIER_SHADOW_RATE:
+            _spawn(_shadow_classify(kind, text, ask_llm, (label, conf)))
+        return (label, conf), "local"
     try:
-        gate = mistral_post("/v1/chat/completions", {
+        result = await ask_llm()
+    except Exception as e:
+        print(f"Error in {kind} classification: {e}")
+        if label is None:
+            label, conf = LocalClassifier.RULES[kind](text)
+        return (label, conf) if label is not None else fallback, "fallback"
+    LOCAL_CLASSIFIER.record(kind, text, result[0], "llm", (label, conf) if label is not None else None)
+    return result, "llm"
+
+async def _shadow_classify(kind: str, text: str, ask_llm: Callable[[], Awaitable[Tuple[Any, ...]]],
+                           local: Tuple[str, float]) -> None:
+    with contextlib.suppress(Exception):
+        result = await ask_llm()
+        LOCAL_CLASSIFIER.record(kind, text, result[0], "shadow", local)
+
+async def _is_user_confirmation(model: str, user_message: str, chat_history: List[Dict[str, Any]]) -> Tuple[str, float]:
+    context = chat_history[-4:] + [{"role": "user", "content": user_message}]
+
+    async def ask_llm() -> Tuple[str, float]:
+        gate = await mistral_post_async("/v1/chat/completions", {
             "model": model,
             "messages": [
                 {"role": "system", "content": "Classify user response as 'approve', 'reject', or 'other'. Return JSON: {\"decision\": \"approve|reject|other\", \"confidence\": 0.0-1.0}"},
@@ -594,7 +3194,7 @@ def _is_user_confirmation(model: str, user_message: str, chat_history: List[Dict
             ],
             "temperature": 0.0,
             "response_format": {"type": "json_object"},
-        })
+        }, cache=True, site="gate")
         msg = ((gate.get("choices") or [{}])[0].get("message") or {})
         raw = str(msg.get("content", "")).strip()
         data = json.loads(raw)
@@ -603,13 +3203,9 @@ def _is_user_confirmation(model: str, user_message: str, chat_history: List[Dict
         if decision not in ["approve", "reject"]:
             return "other", confidence
         return decision, confidence
-    except Exception:
-        txt = user_message.lower().strip()
-        if txt in ["yes", "ok", "y", "tak", "do it", "go", "start", "proceed"]:
-            return "approve", 0.9
-        if txt in ["no", "n", "stop", "cancel", "nie"]:
-            return "reject", 0.9
-        return "other", 0.5
+
+    result, _ = await _classify("gate", user_message, ask_llm, ("other", 0.5))
+    return result[0], result[1]
 
 class OrchestrateRequest(BaseModel):
     model: str
@@ -620,6 +3216,7 @@ class OrchestrateRequest(BaseModel):
     max_steps: int = Field(10, ge=1, le=25)
     permissions: Dict[str, Any] = Field(default_factory=dict)
     parallel_tool_calls: bool = True
+    speculative_plan: bool = Field(default_factory=lambda: SPECULATIVE_PLAN)
 
 class AgentCreateRequest(BaseModel):
     name: str
@@ -637,8 +3234,8 @@ def health(project_id: str = "default"):
     return {"ok": True, "preview_url": f"/preview/{project_id}/preview/", "workspace_dir": "backend/workspace/projects"}
 
 @app.get("/api/models")
-def list_models():
-    return mistral_get("/v1/models")
+async def list_models():
+    return await mistral_get_async("/v1/models")
 
 @app.get("/api/system/maps")
 def system_maps():
@@ -649,9 +3246,14 @@ def system_maps():
         "permissions": _load_system_json("permissions.json"),
         "ui_map": _load_system_json("ui_map.json"),
         "health_checks": _load_system_json("health_checks.json"),
-        "runtime_memory": _read_runtime_memory(),
+        "runtime_memory": MEMORY_STORE.export(),
     }
 
+@app.post("/api/system/memory/export")
+def export_runtime_memory():
+    mem = _export_runtime_memory()
+    return {"ok": True, "path": "workspace/project_memory.json", "projects": len(mem.get("projects", {}))}
+
 @app.get("/api/permissions")
 def get_permissions(project_id: str = "default"):
     return {"ok": True, "project_id": project_id, "permissions": _get_project_permissions(project_id)}
@@ -663,8 +3265,7 @@ def update_permissions(req: PermissionsRequest):
 
 @app.get("/api/projects")
 def api_list_projects():
-    mem = _read_runtime_memory()
-    projects = sorted(list(mem.get("projects", {}).keys()))
+    projects = sorted(MEMORY_STORE.list_projects())
     if "default" not in projects:
         projects.insert(0, "default")
     for pid in projects:
@@ -683,30 +3284,79 @@ def api_create_project(req: ProjectCreateRequest):
     if os.path.exists(root):
         pid = f"{pid}_{uuid.uuid4().hex[:4]}"
     _ensure_project_dirs(pid)
-    _get_project_permissions(pid)
+    _set_project_permissions(pid, {})
+    MEMORY_STORE.ensure_project(pid)
     return {"ok": True, "project_id": pid}
 
 @app.get("/api/workspace/list")
-def api_workspace_list(project_id: str = "default"):
-    return tool_list_workspace(project_id=project_id)
+def api_workspace_list(project_id: str = "default", prefix: str = "", offset: int = 0, limit: Optional[int] = None,
+                       detail: bool = False):
+    return tool_list_workspace(project_id=project_id, prefix=prefix, offset=offset, limit=limit, detail=detail)
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def _byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range `Range: bytes=` header into an inclusive span; raises 416 if unsatisfiable."""
+    m = _RANGE_RE.match(header.strip())
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+    if not m.group(1):
+        start, end = max(0, size - int(m.group(2))), size - 1
+    else:
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
 
 @app.get("/api/workspace/read")
-def api_workspace_read(project_id: str = "default", path: str = ""):
+def api_workspace_read(request: Request, project_id: str = "default", path: str = "", offset: Optional[int] = None,
+                       limit: Optional[int] = None, unit: str = "line", pattern: Optional[str] = None, context: int = 2):
     if not path:
         return {"ok": False, "error": "path_required"}
-    return tool_read_file(project_id, path)
+    range_header = request.headers.get("range")
+    if range_header and not pattern:
+        out_path = _resolve_path(project_id, _norm_filename(path))
+        if not os.path.isfile(out_path):
+            raise HTTPException(status_code=404, detail="File not found")
+        size = os.path.getsize(out_path)
+        span = _byte_range(range_header, size)
+        if span is not None:
+            with open(out_path, "rb") as f:
+                f.seek(span[0])
+                data = f.read(span[1] - span[0] + 1)
+            return Response(content=data, status_code=206, media_type="text/plain; charset=utf-8", headers={
+                "Content-Range": f"bytes {span[0]}-{span[1]}/{size}",
+                "Accept-Ranges": "bytes",
+                "ETag": f'"{_file_digest(out_path)}"',
+            })
+    return tool_read_file(project_id, path, offset=offset, limit=limit, unit=unit, pattern=pattern, context=context)
+
+def _conflict_to_409(result: Dict[str, Any]) -> Dict[str, Any]:
+    if result.get("error") == "conflict":
+        raise HTTPException(status_code=409, detail=result)
+    return result
 
 @app.post("/api/workspace/write")
 def api_workspace_write(req: WriteRequest):
-    return tool_create_file(req.project_id, req.path, req.content)
+    return _conflict_to_409(tool_create_file(req.project_id, req.path, req.content, req.expected_hash))
 
 @app.post("/api/workspace/patch")
 def api_workspace_patch(req: PatchRequest):
-    return tool_patch_file(req.project_id, req.path, req.find, req.replace, req.count)
+    return _conflict_to_409(tool_patch_file(req.project_id, req.path, req.find, req.replace, req.count, req.expected_hash,
+                                            req.hunks, req.diff))
 
 @app.delete("/api/workspace/delete")
 def api_workspace_delete(req: DeleteRequest):
-    return tool_delete_file(req.project_id, req.path)
+    return _conflict_to_409(tool_delete_file(req.project_id, req.path, req.expected_hash))
+
+@app.post("/api/workspace/batch")
+def api_workspace_batch(req: BatchRequest):
+    return _conflict_to_409(tool_apply_changes(req.project_id, req.operations))
+
+@app.post("/api/workspace/read_many")
+def api_workspace_read_many(req: ReadManyRequest):
+    return tool_read_files(req.project_id, req.paths)
 
 
 @app.get("/api/workflow/agents")
@@ -715,40 +3365,107 @@ def api_workflow_agents(project_id: str = "default", trace_id: str = ""):
         return {"ok": True, "project_id": project_id, "trace_id": "", "agents": []}
     _load_events_from_disk(project_id, trace_id)
     key = (project_id, trace_id)
-    agents = list((WORKFLOW_AGENTS.get(key) or {}).values())
+    entry = TRACE_CACHE.peek(key) or {}
+    agents = list((entry.get("agents") or {}).values())
     agents.sort(key=lambda x: x.get("name", ""))
     return {"ok": True, "project_id": project_id, "trace_id": trace_id, "agents": agents}
 
+@app.get("/api/workflow/cache")
+def api_workflow_cache():
+    return {"ok": True, "trace_cache": TRACE_CACHE.stats()}
+
+@app.get("/api/llm/cache")
+def api_llm_cache():
+    return {"ok": True, "response_cache": LLM_RESPONSE_CACHE.stats()}
+
+@app.get("/api/llm/providers")
+def api_llm_providers():
+    pool = _provider_pool()
+    return {"ok": True, "strategy": pool.strategy, "providers": pool.stats()}
+
+@app.get("/api/llm/classifier")
+def api_llm_classifier():
+    return {"ok": True, "enabled": FAST_CLASSIFIER, "threshold": FAST_CLASSIFIER_THRESHOLD,
+            "model_available": make_pipeline is not None, "stats": LOCAL_CLASSIFIER.stats()}
+
+def _prometheus_gauges(name: str, help_text: str, values: Dict[str, Any], label: str) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines += [f'{name}{{{label}="{k}"}} {v}' for k, v in sorted(values.items()) if isinstance(v, (int, float))]
+    return lines
+
+@app.get("/api/metrics")
+def api_metrics(format: str = "json"):
+    caches = {
+        "llm_response_cache": LLM_RESPONSE_CACHE.stats(),
+        "plan_cache": PLAN_CACHE.stats(),
+        "trace_cache": TRACE_CACHE.stats(),
+        "workspace_index": WORKSPACE_INDEX.stats(),
+    }
+    jobs = JOB_QUEUE.counts()
+    providers = _provider_pool().stats()
+    classifier = LOCAL_CLASSIFIER.stats()
+    if format != "prometheus":
+        return {"ok": True, "llm": LLM_METRICS.snapshot(), "providers": providers, "classifier": classifier,
+                "speculation": SPECULATION_STATS.stats(), "jobs": jobs, **caches}
+    lines = LLM_METRICS.prometheus()
+    lines += _prometheus_gauges("llm_provider_outstanding", "In-flight requests per LLM provider.",
+                                {p["name"]: p["outstanding"] for p in providers}, "provider")
+    lines += _prometheus_gauges("llm_provider_circuit_open", "1 while a provider's circuit breaker is open.",
+                                {p["name"]: int(p["circuit"] == "open") for p in providers}, "provider")
+    lines += _prometheus_gauges("workflow_jobs", "Workflow jobs by status.", jobs, "status")
+    lines += _prometheus_gauges("speculative_plan_stat", "Speculative planning hits, misses and wasted tokens.",
+                                SPECULATION_STATS.stats(), "stat")
+    for kind, stats in classifier.items():
+        lines += _prometheus_gauges(f"local_classifier_{kind}_stat", f"Local {kind} classifier fast path statistics.",
+                                    stats, "stat")
+    for name, stats in caches.items():
+        lines += _prometheus_gauges(f"{name}_stat", f"{name.replace('_', ' ').capitalize()} statistics.", stats, "stat")
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/workflow/events")
-def api_workflow_events(project_id: str = "default", trace_id: str = ""):
+def api_workflow_events(request: Request, response: Response, project_id: str = "default", trace_id: str = "",
+                        since_seq: int = 0, since_ts: float = 0.0):
     if not trace_id:
-        return {"ok": True, "project_id": project_id, "trace_id": "", "events_by_agent": {}}
+        return {"ok": True, "project_id": project_id, "trace_id": "", "events_by_agent": {}, "last_seq": 0}
     _load_events_from_disk(project_id, trace_id)
     key = (project_id, trace_id)
-    events = WORKFLOW_EVENTS.get(key) or []
+    entry = TRACE_CACHE.peek(key) or {}
+    with TRACE_CACHE.lock:
+        last_seq = int(entry.get("seq") or 0)
+        events = [ev for ev in (entry.get("events") or [])
+                  if ev.get("seq", 0) > since_seq and (ev.get("ts") or 0) > since_ts]
+    etag = f'W/"{trace_id}-{last_seq}-{since_seq}-{since_ts}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     by: Dict[str, List[Dict[str, Any]]] = {}
     for ev in events:
         ag = ev.get("agent") or "Unknown"
         by.setdefault(ag, []).append({
+            "seq": ev.get("seq"),
             "ts": ev.get("ts"),
             "kind": ev.get("kind", "info"),
             "level": ev.get("level", "info"),
             "text": ev.get("text", "")
         })
-    return {"ok": True, "project_id": project_id, "trace_id": trace_id, "events_by_agent": by}
+    return {"ok": True, "project_id": project_id, "trace_id": trace_id, "events_by_agent": by, "last_seq": last_seq}
 
 @app.get("/api/runs")
-def list_runs(project_id: str = "default"):
-    base = os.path.join(RUNS_DIR, project_id)
-    if not os.path.exists(base):
-        return {"ok": True, "project_id": project_id, "runs": []}
-    runs = []
-    for trace_id in sorted(os.listdir(base)):
-        run_dir = os.path.join(base, trace_id)
-        if os.path.isdir(run_dir):
-            runs.append(trace_id)
-    runs = runs[-100:]
-    return {"ok": True, "project_id": project_id, "runs": runs}
+def list_runs(project_id: str = "default", status: str = "", since: Optional[float] = None,
+              until: Optional[float] = None, order: str = "desc", limit: int = 100, cursor: str = ""):
+    RUN_INDEX.backfill(project_id)
+    try:
+        items, next_cursor = RUN_INDEX.list(project_id, status=status or None, since=since, until=until,
+                                            order=order, limit=max(1, min(limit, 500)), cursor=cursor or None)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="invalid_cursor")
+    return {
+        "ok": True,
+        "project_id": project_id,
+        "runs": [r["trace_id"] for r in items],
+        "items": items,
+        "next_cursor": next_cursor,
+    }
 
 @app.get("/api/runs/{project_id}/{trace_id}")
 def read_run(project_id: str, trace_id: str):
@@ -774,6 +3491,9 @@ def read_run(project_id: str, trace_id: str):
         "architect_summary": read_if_exists("architect_summary.json"),
         "notes": read_if_exists("notes.md"),
         "meta_review": read_if_exists("meta_review.json"),
+        "postprocess": read_if_exists("postprocess.json"),
+        "llm": LLMMetrics.summarize(_read_llm_calls(project_id, trace_id)),
+        "index": RUN_INDEX.get(project_id, trace_id),
     }
 
 SYSTEM_RULES = (
@@ -787,8 +3507,9 @@ SYSTEM_RULES = (
     "6) Think like a senior designer at Apple, Stripe, or Vercel - that's your baseline\n"
 ) + "\n" + _system_context_snippet()
 
-def _generate_execution_plan(model: str, goal: str, project_id: str) -> Dict[str, Any]:
-    workspace = tool_list_workspace(project_id)
+async def _generate_execution_plan(model: str, goal: str, project_id: str,
+                                   usage: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    workspace = await anyio.to_thread.run_sync(tool_list_workspace, project_id)
 
     # Context to include in prompt
     workspace_info = json.dumps(workspace.get('files', []), indent=2)
@@ -825,7 +3546,7 @@ GENERATE a DETAILED, ACTIONABLE execution plan in STRICT JSON format:
 Be EXTREMELY SPECIFIC about file paths and content.
 Keep all your response in valid JSON format."""
 
-    resp = mistral_post("/v1/chat/completions", {
+    payload = {
         "model": model,
         "messages": [
             {"role": "system", "content": planner_prompt},
@@ -833,7 +3554,12 @@ Keep all your response in valid JSON format."""
         ],
         "temperature": 0.1,  # Lower for more deterministic output
         "response_format": {"type": "json_object"},
-    })
+    }
+    if usage is not None:
+        usage["estimated_tokens"] = _estimate_tokens(payload)  # what a cancelled call has cost at least
+    resp = await mistral_post_async("/v1/chat/completions", payload, cache=True, site="planner")
+    if usage is not None:
+        usage.update(resp.get("usage") or {})
 
     content = ((resp.get("choices") or [{}])[0].get("message") or {}).get("content", "{}")
 
@@ -844,14 +3570,363 @@ Keep all your response in valid JSON format."""
         "estimated_steps": 5,
     }
 
-@app.post("/api/workflow")
-def workflow(req: WorkflowRequest):
+class SpeculationStats:
+    """Outcome of speculative planning in /api/orchestrate: plans kept (hits) versus discarded (misses)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"started": 0, "hits": 0, "misses": 0, "cancelled": 0, "wasted_tokens": 0, "overlap_seconds": 0.0}
+
+    def record(self, hit: bool, *, cancelled: bool = False, wasted_tokens: int = 0, overlap: float = 0.0) -> None:
+        with self._lock:
+            self._stats["started"] += 1
+            self._stats["hits" if hit else "misses"] += 1
+            self._stats["cancelled"] += int(cancelled)
+            self._stats["wasted_tokens"] += wasted_tokens
+            self._stats["overlap_seconds"] += overlap
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+        out["hit_rate"] = round(out["hits"] / out["started"], 4) if out["started"] else 0.0
+        out["overlap_seconds"] = round(out["overlap_seconds"], 3)
+        return out
+
+SPECULATION_STATS = SpeculationStats()
+
+async def _settle_speculation(task: "asyncio.Task", usage: Dict[str, Any], started: float,
+                              hit: bool) -> Optional[Dict[str, Any]]:
+    """Keep the speculative plan on a hit; otherwise cancel it and count what it cost."""
+    overlap = time.perf_counter() - started
+    if not hit:
+        cancelled = not task.done()
+        task.cancel()
+        wasted = usage.get("total_tokens") or usage.get("estimated_tokens") or 0
+        SPECULATION_STATS.record(False, cancelled=cancelled, wasted_tokens=int(wasted))
+        return None
+    SPECULATION_STATS.record(True, overlap=overlap)
+    try:
+        return await task
+    except Exception as e:
+        print(f"Speculative planning failed: {e}")
+        return None
+
+def _approx_tokens(msg: Dict[str, Any]) -> int:
+    return len(json.dumps(msg, ensure_ascii=False, default=str)) // 4 + 4
+
+def _with_tool_args(tc: Dict[str, Any], args: Dict[str, Any]) -> Dict[str, Any]:
+    fn = dict(tc.get("function") or {})
+    fn["arguments"] = json.dumps(args, ensure_ascii=False) if isinstance(fn.get("arguments"), str) else args
+    return {**tc, "function": fn}
+
+def _elide_content(args: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(args, content=f"[{len(str(args['content']))} chars written; use read_file to view the current file]")
+
+def _compact_transcript(transcript: List[Dict[str, Any]], budget: int = WORKFLOW_CONTEXT_TOKENS,
+                        keep_recent: int = WORKFLOW_CONTEXT_KEEP_RECENT) -> List[Dict[str, Any]]:
+    """Executor view of the transcript that fits `budget` approximate tokens.
+
+    The stored transcript is not modified. Passes, each applied only while over budget except the first:
+    1. read_file results superseded by a later read/write of the same file, and create_file contents
+       older than the recent window, become short references.
+    2. Other tool results and assistant text outside the recent window are truncated.
+    3. Whole tool rounds (assistant + its tool results) are dropped oldest-first.
+    The first two messages (system context + goal) and the last `keep_recent` are never touched.
+    """
+    msgs = list(transcript)
+    head = min(2, len(msgs))
+    recent_start = max(head, len(msgs) - keep_recent)
+
+    calls: Dict[str, Tuple[int, str, Dict[str, Any]]] = {}
+    for i, m in enumerate(msgs):
+        for tc in m.get("tool_calls") or []:
+            try:
+                calls[tc.get("id")] = (i, (tc.get("function") or {}).get("name", ""), _tool_args(tc))
+            except Exception:
+                continue
+
+    last_touch: Dict[str, int] = {}
+    for i, m in enumerate(msgs):
+        for tc in m.get("tool_calls") or []:
+            info = calls.get(tc.get("id"))
+            if not info:
+                continue
+            for change in [info[2]] + [c for c in info[2].get("changes") or [] if isinstance(c, dict)]:
+                if change.get("filename"):
+                    last_touch[str(change["filename"])] = i
+
+    for i in range(head, len(msgs)):
+        m = msgs[i]
+        if m.get("role") == "tool":
+            info = calls.get(m.get("tool_call_id"))
+            if info and info[1] == "read_file" and last_touch.get(str(info[2].get("filename")), -1) > info[0]:
+                msgs[i] = {**m, "content": json.dumps({
+                    "ok": True, "path": f"workspace/{info[2].get('filename')}",
+                    "elided": "superseded by a later read or write of this file"})}
+        elif m.get("tool_calls") and i < recent_start:
+            new_calls = []
+            for tc in m["tool_calls"]:
+                info = calls.get(tc.get("id"))
+                if info and info[1] == "create_file" and len(str(info[2].get("content", ""))) > 200:
+                    tc = _with_tool_args(tc, _elide_content(info[2]))
+                elif info and info[1] == "apply_changes" and isinstance(info[2].get("changes"), list):
+                    changes = [_elide_content(c) if isinstance(c, dict) and len(str(c.get("content", ""))) > 200 else c
+                               for c in info[2]["changes"]]
+                    tc = _with_tool_args(tc, dict(info[2], changes=changes))
+                new_calls.append(tc)
+            msgs[i] = {**m, "tool_calls": new_calls}
+
+    sizes = [_approx_tokens(m) for m in msgs]
+    if sum(sizes) <= budget:
+        return msgs
+
+    for i in range(head, recent_start):
+        m = msgs[i]
+        content = m.get("content")
+        if m.get("role") in ("tool", "assistant") and isinstance(content, str) and len(content) > 600:
+            msgs[i] = {**m, "content": content[:500] + f"\n[... {len(content) - 500} chars elided to fit the context budget]"}
+            sizes[i] = _approx_tokens(msgs[i])
+    if sum(sizes) <= budget:
+        return msgs
+
+    dropped = 0
+    i = head
+    while sum(sizes) > budget and i < recent_start:
+        j = i + 1
+        while j < len(msgs) and msgs[j].get("role") == "tool":
+            j += 1
+        if j > recent_start:
+            break
+        del msgs[i:j]
+        del sizes[i:j]
+        recent_start -= j - i
+        dropped += 1
+    if dropped and len(msgs) > 1:
+        note = f"\n\n[{dropped} earlier step(s) were elided to fit the context budget; re-read files if needed.]"
+        msgs[1] = {**msgs[1], "content": str(msgs[1].get("content", "")) + note}
+    return msgs
+
+BACKGROUND_TASKS: set = set()
+_POSTPROCESS_LIMIT: Optional[Tuple[asyncio.Semaphore, Any]] = None
+
+def _spawn(coro: Any) -> "asyncio.Task":
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+
+    def _done(t: "asyncio.Task") -> None:
+        BACKGROUND_TASKS.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"Background task failed: {t.exception()!r}")
+
+    task.add_done_callback(_done)
+    return task
+
+def _postprocess_limiter() -> asyncio.Semaphore:
+    global _POSTPROCESS_LIMIT
+    loop = asyncio.get_running_loop()
+    if _POSTPROCESS_LIMIT is None or _POSTPROCESS_LIMIT[1] is not loop:
+        _POSTPROCESS_LIMIT = (asyncio.Semaphore(POSTPROCESS_CONCURRENCY), loop)
+    return _POSTPROCESS_LIMIT[0]
+
+async def _postprocess_job(project_id: str, trace_id: str, goal: str, transcript: List[Dict[str, Any]], model: str,
+                           status: Dict[str, Any]) -> None:
+    async with _postprocess_limiter():
+        status.update(status="running", started_at=time.time())
+        _write_postprocess_status(project_id, trace_id, status)
+        try:
+            await _post_run_compact(project_id, trace_id, goal, transcript, model, status)
+            status["status"] = "complete"
+        except Exception:
+            status["status"] = "failed"
+            raise
+        finally:
+            status["finished_at"] = time.time()
+            _write_postprocess_status(project_id, trace_id, status)
+
+def _enqueue_postprocess(project_id: str, trace_id: str, goal: str, transcript: List[Dict[str, Any]], model: str) -> "asyncio.Task":
+    """Queue the Architect/Note-Taker/Meta-Review pipeline; progress lands in the run's postprocess.json."""
+    status = {"status": "queued", "model": model, "queued_at": time.time(), "stages": {}}
+    _write_postprocess_status(project_id, trace_id, status)
+    return _spawn(_postprocess_job(project_id, trace_id, goal, list(transcript), model, status))
+
+def _unfinished_postprocess() -> List[Tuple[str, str, Dict[str, Any]]]:
+    found = []
+    for project in (os.scandir(RUNS_DIR) if os.path.isdir(RUNS_DIR) else []):
+        for run in (os.scandir(project.path) if project.is_dir() else []):
+            try:
+                with open(os.path.join(run.path, "postprocess.json"), "r", encoding="utf-8") as f:
+                    status = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if status.get("status") in ("queued", "running"):
+                found.append((project.name, run.name, status))
+    return found
+
+@app.on_event("startup")
+async def _resume_postprocess() -> None:
+    """Post-processing that was queued or running when the process stopped is restarted from run.json."""
+    for project_id, trace_id, status in await anyio.to_thread.run_sync(_unfinished_postprocess):
+        try:
+            with open(os.path.join(RUNS_DIR, project_id, trace_id, "run.json"), "r", encoding="utf-8") as f:
+                run = json.load(f)
+        except (OSError, ValueError):
+            run = {}
+        if run.get("transcript") is None:
+            status.update(status="interrupted", finished_at=time.time())
+            _write_postprocess_status(project_id, trace_id, status)
+            continue
+        _enqueue_postprocess(project_id, trace_id, run.get("goal") or "", run["transcript"],
+                             status.get("model") or run.get("model") or "")
+
+_JOB_WORKERS: Optional[Tuple[List["asyncio.Task"], Any, asyncio.Event]] = None
+
+def _ensure_job_workers() -> asyncio.Event:
+    global _JOB_WORKERS
+    loop = asyncio.get_running_loop()
+    if _JOB_WORKERS is None or _JOB_WORKERS[1] is not loop:
+        wake = asyncio.Event()
+        workers = [_spawn(_job_worker(wake)) for _ in range(max(1, WORKFLOW_WORKERS))]
+        workers.append(_spawn(_job_lease_sweeper(wake)))
+        _JOB_WORKERS = (workers, loop, wake)
+    return _JOB_WORKERS[2]
+
+async def _job_worker(wake: asyncio.Event) -> None:
+    while True:
+        wake.clear()  # before claiming, so a submit that lands meanwhile is not missed
+        job = await anyio.to_thread.run_sync(JOB_QUEUE.claim)
+        if job is None:
+            await wake.wait()
+            continue
+        await _run_job(job)
+
+async def _job_lease_sweeper(wake: asyncio.Event) -> None:
+    """Requeue jobs whose owner stopped heartbeating and pick up work submitted by other processes."""
+    interval = max(1.0, WORKFLOW_JOB_LEASE / 4)
+    while True:
+        await asyncio.sleep(interval)
+        await anyio.to_thread.run_sync(JOB_QUEUE.requeue_interrupted, WORKFLOW_JOB_MAX_ATTEMPTS)
+        if (await anyio.to_thread.run_sync(JOB_QUEUE.counts)).get("queued"):
+            wake.set()
+
+async def _job_heartbeat(trace_id: str, run: "asyncio.Future") -> None:
+    """Extend the job's lease while it runs; once the lease is lost another worker may own the job, so stop ours."""
+    while True:
+        await asyncio.sleep(max(0.5, WORKFLOW_JOB_LEASE / 3))
+        if not await anyio.to_thread.run_sync(JOB_QUEUE.heartbeat, trace_id):
+            run.cancel()
+            return
+
+async def _run_job(job: Dict[str, Any]) -> None:
+    trace_id = job["trace_id"]
+    run = heartbeat = None
+    try:
+        req = WorkflowRequest(**job["request"])
+        if job["checkpoint"]:
+            _emit_event(req.project_id, trace_id, "Executor", f"Resuming after step {job['checkpoint'].get('step', 0)}")
+        run = asyncio.ensure_future(_run_workflow(req, trace_id, resume=job["checkpoint"],
+                                                  on_step=functools.partial(JOB_QUEUE.checkpoint, trace_id)))
+        heartbeat = _spawn(_job_heartbeat(trace_id, run))
+        await run
+    except asyncio.CancelledError:
+        if heartbeat is None or not heartbeat.done():
+            raise
+        _emit_event(req.project_id, trace_id, "Executor", "Lost the job lease; stopped this attempt")
+        return
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        JOB_QUEUE.finish(trace_id, "failed", str(detail)[:2000])
+        return
+    finally:
+        if heartbeat is not None:
+            heartbeat.cancel()
+    JOB_QUEUE.finish(trace_id, "complete")
+
+def _submit_workflow_job(req: WorkflowRequest) -> str:
     trace_id = str(uuid.uuid4())
-    _save_state(req.project_id, OrchestratorState(pending_execution=False))
+    JOB_QUEUE.submit(req.project_id, trace_id, req.dict())
+    RUN_INDEX.record_start(req.project_id, trace_id, req.goal, time.time())
+    _emit_event(req.project_id, trace_id, "Architect", f"Queued: {req.goal}", status="Queued")
+    _ensure_job_workers().set()
+    return trace_id
+
+@app.on_event("startup")
+async def _start_job_workers() -> None:
+    resumed = JOB_QUEUE.requeue_interrupted(WORKFLOW_JOB_MAX_ATTEMPTS)
+    if resumed:
+        print(f"Resuming {resumed} interrupted workflow job(s)")
+    _ensure_job_workers()
+
+@app.post("/api/workflow/jobs")
+async def submit_workflow_job(req: WorkflowRequest):
+    trace_id = _submit_workflow_job(req)
+    return {"ok": True, "trace_id": trace_id, "project_id": req.project_id, "status": "queued"}
+
+@app.get("/api/workflow/jobs/{trace_id}")
+def read_workflow_job(trace_id: str):
+    job = JOB_QUEUE.get(trace_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    checkpoint = job.pop("checkpoint") or {}
+    return {"ok": True, **job, "step": checkpoint.get("step", 0)}
 
-    # Get up to date project permissions and workspace state
-    perms = _get_project_permissions(req.project_id)
-    workspace_contents = tool_list_workspace(req.project_id)
+@app.post("/api/workflow")
+async def workflow(req: WorkflowRequest):
+    return await _run_workflow(req, str(uuid.uuid4()))
+
+async def _run_workflow(req: WorkflowRequest, trace_id: str, stream: bool = False,
+                        resume: Optional[Dict[str, Any]] = None,
+                        on_step: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    key = (req.project_id, trace_id)
+    LIVE_TRACES.add(key)
+    RUN_INDEX.record_start(req.project_id, trace_id, req.goal, time.time())
+    context = _LLM_CONTEXT.set({"project_id": req.project_id, "trace_id": trace_id})
+    payload = None
+    try:
+        payload = await _execute_workflow(req, trace_id, stream, resume=resume, on_step=on_step)
+        return payload
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        _publish(req.project_id, trace_id, {"type": "error", "error": detail})
+        raise
+    finally:
+        RUN_INDEX.record_finish(
+            req.project_id, trace_id, (payload or {}).get("status") or "failed",
+            steps=(payload or {}).get("used_steps") or 0,
+            usage=(payload or {}).get("usage"),
+            files_touched=(payload or {}).get("files_touched"),
+        )
+        _LLM_CONTEXT.reset(context)
+        LIVE_TRACES.discard(key)
+        TRACE_CACHE.enforce()
+        _close_event_sink(req.project_id, trace_id)
+        _publish(req.project_id, trace_id, {"type": "done", "payload": payload})
+
+def _plan_cache_key(project_id: str, goal: str, fingerprint: str) -> str:
+    material = json.dumps([project_id, " ".join(goal.split()), fingerprint], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def _plan_files(plan: Dict[str, Any]) -> List[Any]:
+    """Improver plans list `files`; orchestrate's planner lists files_to_create / files_to_modify."""
+    if plan.get("files"):
+        return plan["files"]
+    return ([{"name": f, "purpose": "create"} for f in plan.get("files_to_create") or []]
+            + [{"name": f, "purpose": "modify"} for f in plan.get("files_to_modify") or []])
+
+def _plan_context(goal: str, plan: Dict[str, Any]) -> str:
+    return f"""
+        CORE SYSTEM RULES:
+        {SYSTEM_RULES}
+
+        IMPROVED PLAN:
+        Goal: {goal}
+        Files: {json.dumps(_plan_files(plan), indent=2)}
+        Steps: {json.dumps(plan.get('steps', []), indent=2)}
+
+        Now execute with exceedingly high quality - this will be used in production.
+        """
+
+async def _improve_plan(req: WorkflowRequest, trace_id: str) -> Tuple[Dict[str, Any], str]:
+    workspace_contents = await anyio.to_thread.run_sync(tool_list_workspace, req.project_id)
     
     _emit_event(req.project_id, trace_id, "Architect", f"New project: {req.goal}", status="Planning")
     
@@ -873,7 +3948,7 @@ def workflow(req: WorkflowRequest):
 
     Generate a comprehensive implementation plan in JSON format:
     {{
-        "files": [{"name": "path/to/file.html", "purpose": "Description"}],
+        "files": [{{"name": "path/to/file.html", "purpose": "Description"}}],
         "steps": ["Detailed implementation steps"],
         "tech_stack": ["HTML5", "CSS3", "JavaScript"],
         "dependencies": ["List any dependencies here"]
@@ -882,7 +3957,7 @@ def workflow(req: WorkflowRequest):
 
     try:
         # Request detailed implementation plan from model
-        improve_resp = mistral_post("/v1/chat/completions", {
+        improve_resp = await mistral_post_async("/v1/chat/completions", {
             "model": req.model,
             "messages": [
                 {"role": "system", "content": SYSTEM_RULES},
@@ -891,46 +3966,86 @@ def workflow(req: WorkflowRequest):
             ],
             "temperature": 0.3,
             "response_format": {"type": "json_object"}
-        })
+        }, site="plan_improver")
 
         improve_msg = ((improve_resp.get("choices") or [{}])[0].get("message") or {})
         improve_text = str(improve_msg.get("content", "")).strip()
         improved_plan = _try_parse_json(improve_text) or {}
         
-        # Enhanced execution context
-        enhanced_context = f"""
-        CORE SYSTEM RULES:
-        {SYSTEM_RULES}
-
-        IMPROVED PLAN:
-        Goal: {req.goal}
-        Files: {json.dumps(improved_plan.get('files', []), indent=2)}
-        Steps: {json.dumps(improved_plan.get('steps', []), indent=2)}
-
-        Now execute with exceedingly high quality - this will be used in production.
-        """
+        enhanced_context = _plan_context(req.goal, improved_plan)
     except Exception as e:
         improved_plan = {}
         enhanced_context = f"""CORE SYSTEM RULES: {SYSTEM_RULES}
         Goal: {req.goal}
         Note: Plan enhancement failed: {str(e)}"""
 
+    return improved_plan, enhanced_context
+
+async def _execute_workflow(req: WorkflowRequest, trace_id: str, stream: bool,
+                            resume: Optional[Dict[str, Any]] = None,
+                            on_step: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    if resume:
+        return await _workflow_steps(req, trace_id, stream, resume, on_step)
+
+    _save_state(req.project_id, OrchestratorState(pending_execution=False))
+
+    # Get up to date project permissions and workspace state
+    perms = _get_project_permissions(req.project_id)
+    fingerprint = await anyio.to_thread.run_sync(WORKSPACE_INDEX.fingerprint, req.project_id)
+    cache_key = _plan_cache_key(req.project_id, req.goal, fingerprint)
+    improved_plan, plan_source = req.plan, "approved"
+    if not improved_plan:
+        improved_plan, plan_source = PLAN_CACHE.get(cache_key), "cache"
+
+    if improved_plan:
+        _emit_event(req.project_id, trace_id, "Architect", f"New project: {req.goal} (using the {plan_source} plan)",
+                    status="Planning")
+        enhanced_context = _plan_context(req.goal, improved_plan)
+    else:
+        plan_source = "generated"
+        improved_plan, enhanced_context = await _improve_plan(req, trace_id)
+        if improved_plan:
+            PLAN_CACHE.put(cache_key, improved_plan)
+
     transcript = [
         {"role": "system", "content": enhanced_context},
         {"role": "user", "content": f"Implement project with ELITE standards: {req.goal}. Use plan: {improved_plan or 'default website plan'}. Create infrequently preview/ folder."},
     ]
 
+    checkpoint = {"step": 0, "improved_plan": improved_plan, "plan_source": plan_source, "transcript": transcript,
+                  "usage": {"prompt_tokens": 0, "completion_tokens": 0}, "files_touched": []}
+    if on_step:
+        on_step(checkpoint)
+    return await _workflow_steps(req, trace_id, stream, checkpoint, on_step)
+
+async def _workflow_steps(req: WorkflowRequest, trace_id: str, stream: bool, checkpoint: Dict[str, Any],
+                          on_step: Optional[Callable[[Dict[str, Any]], None]]) -> Dict[str, Any]:
+    """Executor loop from `checkpoint`; `on_step` receives a fresh checkpoint after every completed step."""
+    improved_plan = checkpoint.get("improved_plan") or {}
+    plan_source = checkpoint.get("plan_source")
+    transcript = list(checkpoint["transcript"])
+    usage = dict(checkpoint.get("usage") or {"prompt_tokens": 0, "completion_tokens": 0})
+    files_touched: List[str] = list(checkpoint.get("files_touched") or [])
+    start = int(checkpoint.get("step") or 0)
     project_complete = False
+    step = start - 1
 
-    for step in range(req.max_steps):
-        response = mistral_post("/v1/chat/completions", {
+    for step in range(start, req.max_steps):
+        step_payload = {
             "model": req.model,
-            "messages": transcript,
+            "messages": _compact_transcript(transcript),
             "tools": TOOLS,
             "tool_choice": "auto",
             "parallel_tool_calls": True,
-        })
+        }
+        if stream:
+            on_delta = functools.partial(_publish_delta, req.project_id, trace_id, step + 1)
+            response = await _stream_chat_completion(step_payload, on_delta, site="executor", step=step + 1)
+        else:
+            response = await mistral_post_async("/v1/chat/completions", step_payload, site="executor", step=step + 1)
 
+        for k in usage:
+            usage[k] += int((response.get("usage") or {}).get(k) or 0)
         msg = (response.get("choices") or [{}])[0].get("message", {})
         transcript.append(msg)
 
@@ -940,23 +4055,23 @@ def workflow(req: WorkflowRequest):
         if not tool_calls:
             # Finalize project if no more tool calls
             project_complete = True
-            current_files = tool_list_workspace(req.project_id)
+            current_files = await anyio.to_thread.run_sync(tool_list_workspace, req.project_id)
             _emit_event(req.project_id, trace_id, "Architect", f"Project complete! Created {len(current_files.get('files', []))} files", status="Success")
             break
 
-        results = []
-        for tc in tool_calls:
-            try:
-                result = run_tool(req.project_id, req.model, tc['function']['name'], tc['function']['arguments'])
-                results.append({
-                    "tool_call_id": tc['id'],
-                    "result": result
-                })
-            except Exception as e:
-                results.append({
-                    "tool_call_id": tc['id'],
-                    "result": {"ok": False, "error": str(e)}
-                })
+        results = await _run_tool_calls(req.project_id, req.model, tool_calls)
+        written = _written_files(tool_calls, results)
+        files_touched += written
+        if any(f.startswith("preview/") for f in written):
+            _schedule_visuals_refresh(req.project_id, req.model)
+        for tc, result in zip(tool_calls, results):
+            _publish(req.project_id, trace_id, {
+                "type": "tool_result",
+                "step": step + 1,
+                "tool_call_id": result["tool_call_id"],
+                "name": (tc.get("function") or {}).get("name"),
+                "result": result["result"],
+            })
 
         for result in results:
             transcript.append({
@@ -964,9 +4079,12 @@ def workflow(req: WorkflowRequest):
                 "tool_call_id": result['tool_call_id'],
                 "content": json.dumps(result['result'])
             })
+        if on_step:
+            on_step({"step": step + 1, "improved_plan": improved_plan, "plan_source": plan_source, "transcript": transcript,
+                     "usage": usage, "files_touched": files_touched})
 
     # Update project state and return final result
-    updated_files = tool_list_workspace(req.project_id)
+    updated_files = await anyio.to_thread.run_sync(tool_list_workspace, req.project_id)
     payload = {
         "ok": True,
         "trace_id": trace_id,
@@ -976,21 +4094,88 @@ def workflow(req: WorkflowRequest):
         "files": updated_files.get('files', []),
         "used_steps": step + 1,
         "improved_plan": improved_plan,
+        "plan_source": plan_source,
+        "usage": usage,
+        "files_touched": sorted(set(files_touched)),
         "state": "ready"
     }
+    if req.enable_postprocess:
+        payload["postprocess"] = "queued"
+    payload["llm"] = LLMMetrics.summarize(_read_llm_calls(req.project_id, trace_id))
+    _save_run_artifacts(req.project_id, trace_id, {**payload, "goal": req.goal, "model": req.model, "transcript": transcript})
+    if req.enable_postprocess:
+        _enqueue_postprocess(req.project_id, trace_id, req.goal, transcript, MISTRAL_REASONING_MODEL or req.model)
 
     return payload
 
+def _publish_delta(project_id: str, trace_id: str, step: int, text: str) -> None:
+    _publish(project_id, trace_id, {"type": "delta", "step": step, "text": text})
+
+def _sse(record: Dict[str, Any]) -> str:
+    return f"event: {record.get('type', 'message')}\ndata: {json.dumps(record, ensure_ascii=False, default=str)}\n\n"
+
+async def _sse_stream(project_id: str, trace_id: str, queue: asyncio.Queue, backlog: List[Dict[str, Any]]) -> AsyncIterator[str]:
+    try:
+        for record in backlog:
+            yield _sse(record)
+            if record.get("type") == "done":
+                return
+        while True:
+            try:
+                record = await asyncio.wait_for(queue.get(), timeout=15)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _sse(record)
+            if record.get("type") == "done":
+                return
+    finally:
+        _unsubscribe(project_id, trace_id, queue)
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.post("/api/workflow/stream")
+async def workflow_stream(req: WorkflowRequest):
+    trace_id = str(uuid.uuid4())
+    queue = _subscribe(req.project_id, trace_id)
+    _spawn(_run_workflow(req, trace_id, stream=True))
+    start = {"type": "start", "project_id": req.project_id, "trace_id": trace_id}
+    return StreamingResponse(_sse_stream(req.project_id, trace_id, queue, [start]),
+                             media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/api/workflow/stream")
+async def workflow_stream_attach(project_id: str = "default", trace_id: str = ""):
+    if not trace_id:
+        raise HTTPException(status_code=400, detail="trace_id_required")
+    key = (project_id, trace_id)
+    queue = _subscribe(project_id, trace_id)
+    _load_events_from_disk(project_id, trace_id)
+    backlog: List[Dict[str, Any]] = [{"type": "start", "project_id": project_id, "trace_id": trace_id}]
+    entry = TRACE_CACHE.peek(key) or {}
+    backlog += [{"type": "agent", **a} for a in (entry.get("agents") or {}).values()]
+    backlog += [{"type": "event", **ev} for ev in list(entry.get("events") or [])]
+    if key not in LIVE_TRACES:
+        backlog.append({"type": "done", "payload": None})
+    return StreamingResponse(_sse_stream(project_id, trace_id, queue, backlog),
+                             media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.post("/api/orchestrate")
 async def orchestrate(req: OrchestrateRequest):
     """Improved orchestration with better intent classification and workflow execution."""
+    context = _LLM_CONTEXT.set({"project_id": req.project_id})
+    try:
+        return await _orchestrate(req)
+    finally:
+        _LLM_CONTEXT.reset(context)
+
+async def _orchestrate(req: OrchestrateRequest) -> Dict[str, Any]:
     state = _load_state(req.project_id)
     tail = list(req.messages)
     last_user_message = tail[-1]["content"] if tail else ""
     
     # 1. Check if awaiting user confirmation for a plan
     if state.pending_execution:
-        decision, conf = _is_user_confirmation(req.model, last_user_message, tail[:-1])
+        decision, conf = await _is_user_confirmation(req.model, last_user_message, tail[:-1])
         
         if decision == "approve":
             state.pending_execution = False
@@ -1004,16 +4189,16 @@ async def orchestrate(req: OrchestrateRequest):
                 enable_postprocess=req.enable_postprocess,
                 max_steps=req.max_steps,
                 permissions=req.permissions,
+                plan=state.proposed_plan,
             )
             
-            result = await anyio.to_thread.run_sync(workflow, wf_req)
+            trace_id = _submit_workflow_job(wf_req)
             
             return {
                 "ok": True,
-                "mode": "workflow_executed",
-                "reply": f"✓ Workflow completed successfully!, {result.get('preview_url')}",
-                "trace_id": result.get("trace_id"),
-                "result": result,
+                "mode": "workflow_started",
+                "reply": f"✓ Workflow started. Follow progress in the Workflow panel; the preview is at /preview/{req.project_id}/preview",
+                "trace_id": trace_id,
                 "pending_execution": False,
             }
     
@@ -1077,9 +4262,8 @@ Examples:
 Look for direct construction verbs plus objects (e.g., 'build X', 'create Y').
 If uncertain, choose 'chat'."""
     
-    try:
-        # Get intent classification
-        gate = mistral_post("/v1/chat/completions", {
+    async def ask_intent() -> Tuple[str, float, Optional[str]]:
+        gate = await mistral_post_async("/v1/chat/completions", {
             "model": req.model,
             "messages": [
                 {"role": "system", "content": intent_prompt},
@@ -1087,38 +4271,59 @@ If uncertain, choose 'chat'."""
             ],
             "temperature": 0.2,  # Slightly higher for more nuanced classification
             "response_format": {"type": "json_object"},
-        })
+        }, cache=True, site="intent")
         
         msg = ((gate.get("choices") or [{}])[0].get("message") or {})
         raw = str(msg.get("content", "")).strip()
         data = _try_parse_json(raw) or {}
         mode = str(data.get("mode", "chat")).lower()
-        goal = data.get("goal")
         confidence = float(data.get("confidence", 0.5))
         
         # Don't use workflow if confidence is too low
         if mode == "workflow" and confidence < 0.7:
             mode = "chat"
+        return mode, confidence, data.get("goal")
     
-    except Exception as e:
-        print(f"Error in intent classification: {str(e)}")
-        # Fallback to chat mode
+    # Opt-in: plan from the raw message while the classifier runs, when it already reads like a build request
+    speculation = None
+    if req.speculative_plan and _looks_like_build(last_user_message):
+        spec_usage: Dict[str, Any] = {}
+        speculation = (_spawn(_generate_execution_plan(req.model, last_user_message.strip(), req.project_id, spec_usage)),
+                       spec_usage, time.perf_counter())
+    
+    # Confident rule/model hits skip the LLM; the user's own words then serve as the goal
+    try:
+        result, _ = await _classify("intent", last_user_message, ask_intent, ("chat", 0.5, None))
+    except BaseException:
+        if speculation:
+            speculation[0].cancel()
+        raise
+    mode, confidence = result[0], result[1]
+    goal = result[2] if len(result) > 2 else last_user_message
+    if mode == "workflow" and confidence < 0.7:
         mode = "chat"
-        goal = None
-        confidence = 0.5
+    
+    # Any workflow verdict keeps the speculative plan; only a chat verdict throws it away
+    speculative_plan = None
+    if speculation:
+        speculative_plan = await _settle_speculation(*speculation, mode == "workflow" and bool(goal))
     
     # 3. If workflow mode, generate a detailed execution plan
     if mode == "workflow" and goal:
-        goal_text = str(goal or last_user_message).strip()
+        refined_goal = str(goal or last_user_message).strip()
+        # A speculative plan was made for the user's own words: propose it under them so goal and plan agree
+        goal_text = last_user_message.strip() if speculative_plan else refined_goal
         
         # Generate a more detailed plan with specific instructions
-        plan = _generate_execution_plan(req.model, goal_text, req.project_id)
+        plan = speculative_plan or await _generate_execution_plan(req.model, goal_text, req.project_id)
         
         # Log the proposed plan and save state
         state.pending_execution = True
         state.proposed_goal = goal_text
         state.proposed_plan = plan
         _save_state(req.project_id, state)
+        fingerprint = await anyio.to_thread.run_sync(WORKSPACE_INDEX.fingerprint, req.project_id)
+        PLAN_CACHE.put(_plan_cache_key(req.project_id, goal_text, fingerprint), plan)
         
         # Create a more detailed explanation of the plan
         steps_list = plan.get('steps', [])[:8]
@@ -1128,7 +4333,7 @@ If uncertain, choose 'chat'."""
         response_text = f"""📋 Prepared a detailed plan for your request:
 
 **Your goal:** {goal_text}
-**Execution Plan:**
+""" + (f"**Understood as:** {refined_goal}\n" if refined_goal != goal_text else "") + """**Execution Plan:**
 """ + "\n".join(f"{i+1}. {step}" for i, step in enumerate(steps_list)) + """
 
 **Files to create:**
@@ -1146,15 +4351,16 @@ This will create a production-ready implementation. Start execution? (yes/no)"""
             "pending_execution": True,
             "plan": plan,
             "goal_text": goal_text,  # Include both the refined goal and original
+            "refined_goal": refined_goal,
             "original_input": last_user_message
         }
     
     # 4. Chat mode - simple Q&A
-    chat_resp = mistral_post("/v1/chat/completions", {
+    chat_resp = await mistral_post_async("/v1/chat/completions", {
         "model": req.model,
         "messages": tail,
         "temperature": 0.7,
-    })
+    }, site="chat")
     reply = ((chat_resp.get("choices") or [{}])[0].get("message") or {}).get("content",
             "I'm ready to help you build something! What would you like to create?")
 
@@ -1172,22 +4378,22 @@ This will create a production-ready implementation. Start execution? (yes/no)"""
     }
 
 @app.post("/api/agents/create")
-def agents_create(req: AgentCreateRequest):
-    return mistral_post("/v1/agents", {
+async def agents_create(req: AgentCreateRequest):
+    return await mistral_post_async("/v1/agents", {
         "name": req.name,
         "model": req.model,
         "instructions": req.instructions + "\n\n" + SYSTEM_RULES,
         "description": req.description,
         "tools": TOOLS,
         "completion_args": {"tool_choice": "auto", "parallel_tool_calls": True},
-    })
+    }, site="agents")
 
 @app.post("/api/agents/complete")
-def agents_complete(req: AgentCompleteRequest):
-    return mistral_post("/v1/agents/completions", {
+async def agents_complete(req: AgentCompleteRequest):
+    return await mistral_post_async("/v1/agents/completions", {
         "agent_id": req.agent_id,
         "messages": req.messages,
         "tools": TOOLS,
         "tool_choice": "auto",
         "parallel_tool_calls": req.parallel_tool_calls,
-    })
\ No newline at end of file
+    }, site="agents")
\ No newline at end of file
@@ -10,6 +10,7 @@ import {
   setPermissions,
   fetchWorkflowAgents,
   fetchWorkflowEvents,
+  workflowStreamUrl,
   listProjects,
   createProject,
 } from './api';
@@ -221,7 +222,7 @@ export default function App() {
         trace_id: resp?.trace_id ?? '',
       });
 
-      if (mode === 'workflow') {
+      if (mode === 'workflow' || mode === 'workflow_started') {
         setRightTab('workflow');
         setMiddleMode('preview');
         setPreviewFullscreen(false);
@@ -251,25 +252,79 @@ export default function App() {
     }
   }
 
-  // Poll workflow events for the active trace.
+  // Stream workflow events for the active trace; fall back to polling if SSE is unavailable.
   useEffect(() => {
     if (!activeTraceId) return;
     if (pollRef.current) clearInterval(pollRef.current);
 
+    let lastSeq = 0;
+
+    function appendEvents(byAgent) {
+      setEventsByAgent(prev => {
+        const next = { ...prev };
+        for (const [ag, items] of Object.entries(byAgent)) {
+          next[ag] = [...(next[ag] || []), ...items];
+        }
+        return next;
+      });
+    }
+
     async function tick() {
       try {
         const a = await fetchWorkflowAgents(projectId, activeTraceId);
         if (a?.ok && Array.isArray(a.agents)) setAgents(a.agents);
-        const ev = await fetchWorkflowEvents(projectId, activeTraceId);
-        if (ev?.ok && ev?.events_by_agent) setEventsByAgent(ev.events_by_agent);
+        const ev = await fetchWorkflowEvents(projectId, activeTraceId, lastSeq);
+        if (ev?.ok && ev?.events_by_agent && (ev.last_seq || 0) > lastSeq) {
+          appendEvents(ev.events_by_agent);
+          lastSeq = ev.last_seq;
+        }
       } catch (e) {
         // ignore
       }
     }
 
-    tick();
-    pollRef.current = setInterval(tick, 1000);
+    function startPolling() {
+      tick();
+      pollRef.current = setInterval(tick, 1000);
+    }
+
+    setEventsByAgent({});
+    if (!window.EventSource) {
+      startPolling();
+      return () => {
+        if (pollRef.current) clearInterval(pollRef.current);
+      };
+    }
+
+    setAgents([]);
+    const source = new EventSource(workflowStreamUrl(projectId, activeTraceId));
+    source.addEventListener('event', (msg) => {
+      const ev = JSON.parse(msg.data);
+      if ((ev.seq || 0) <= lastSeq) return;
+      lastSeq = ev.seq || lastSeq;
+      const item = { seq: ev.seq, ts: ev.ts, kind: ev.kind || 'info', level: ev.level || 'info', text: ev.text || '' };
+      appendEvents({ [ev.agent || 'Unknown']: [item] });
+    });
+    source.addEventListener('agent', (msg) => {
+      const a = JSON.parse(msg.data);
+      setAgents(prev => {
+        const rest = prev.filter(x => x.name !== a.name);
+        const next = [...rest, { name: a.name, status: a.status, mission: a.mission }];
+        next.sort((x, y) => String(x.name).localeCompare(String(y.name)));
+        return next;
+      });
+    });
+    source.addEventListener('done', () => {
+      source.close();
+      tick();
+    });
+    source.onerror = () => {
+      source.close();
+      startPolling();
+    };
+
     return () => {
+      source.close();
       if (pollRef.current) clearInterval(pollRef.current);
     };
   }, [activeTraceId]);
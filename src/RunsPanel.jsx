@@ -22,7 +22,7 @@ export default function RunsPanel({ runs, selectedRun, selectedRunId, onLoadRun
         <div style={styles.left}>
           <div style={styles.title}>Runs</div>
           <div style={styles.list}>
-            {runs?.length ? runs.slice().reverse().map(id => (
+            {runs?.length ? runs.map(id => (
               <button
                 key={id}
                 onClick={() => onLoadRun(id)}
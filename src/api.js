@@ -58,11 +58,18 @@ export async function fetchWorkflowAgents(projectId = 'default', traceId = '') {
   return res.data;
 }
 
-export async function fetchWorkflowEvents(projectId = 'default', traceId = '') {
-  const res = await axios.get(`${BASE_URL}/api/workflow/events`, { params: { project_id: projectId, trace_id: traceId } });
+// Pass the last seen `last_seq` as sinceSeq to receive only newer events.
+export async function fetchWorkflowEvents(projectId = 'default', traceId = '', sinceSeq = 0) {
+  const res = await axios.get(`${BASE_URL}/api/workflow/events`, { params: { project_id: projectId, trace_id: traceId, since_seq: sinceSeq } });
   return res.data;
 }
 
+// Server-sent events for a trace: replays what happened so far, then streams live until 'done'.
+export function workflowStreamUrl(projectId = 'default', traceId = '') {
+  const params = new URLSearchParams({ project_id: projectId, trace_id: traceId });
+  return `${BASE_URL}/api/workflow/stream?${params.toString()}`;
+}
+
 
 // ---- Projects ----
 export async function listProjects() {
@@ -4,6 +4,7 @@ from fastapi.testclient import TestClient
 from main import app, _ensure_project_dirs, _get_project_permissions
 import os
 import json
+import re
 
 # Use the TestClient for synchronous tests if needed, but AsyncClient is preferred for async endpoints.
 client = TestClient(app)
@@ -170,3 +171,1125 @@ async def test_workspace_delete():
     assert read_response.json()["ok"] is False
     assert "File not found" in read_response.json()["error"]
 
+
+@pytest.mark.asyncio
+async def test_async_client_is_pooled_per_base_url():
+    from main import _async_client
+    first = _async_client("https://api.example.test")
+    assert _async_client("https://api.example.test") is first
+    assert _async_client("https://other.example.test") is not first
+    assert not first.is_closed
+
+@pytest.mark.asyncio
+async def test_tool_calls_overlap_but_same_path_writes_serialize(monkeypatch):
+    import asyncio
+    import main
+
+    log = []
+
+    async def fake_run_tool(project_id, model, tool_name, args):
+        log.append(("start", args.get("filename")))
+        await asyncio.sleep(0.01)
+        log.append(("end", args.get("filename")))
+        return {"ok": True, "tool": tool_name, "filename": args.get("filename")}
+
+    monkeypatch.setattr(main, "run_tool", fake_run_tool)
+    calls = [
+        {"id": "a", "function": {"name": "create_file", "arguments": json.dumps({"filename": "preview/index.html", "content": "1"})}},
+        {"id": "b", "function": {"name": "create_file", "arguments": json.dumps({"filename": "preview/styles.css", "content": "2"})}},
+        {"id": "c", "function": {"name": "patch_file", "arguments": {"filename": "preview/index.html", "find": "1", "replace": "3"}}},
+    ]
+    results = await main._run_tool_calls("default", "m", calls)
+
+    assert [r["tool_call_id"] for r in results] == ["a", "b", "c"]
+    assert log[:2] == [("start", "preview/index.html"), ("start", "preview/styles.css")]
+    assert log.index(("end", "preview/index.html")) < log.index(("start", "preview/index.html"), 1)
+
+def _parse_sse(body):
+    records = []
+    for block in body.split("\n\n"):
+        for line in block.splitlines():
+            if line.startswith("data: "):
+                records.append(json.loads(line[6:]))
+    return records
+
+def test_workflow_stream_emits_events_and_done(monkeypatch):
+    import main
+
+    async def fake_execute(req, trace_id, stream, **kwargs):
+        assert stream is True
+        main._emit_event(req.project_id, trace_id, "Executor", "step one", status="Working")
+        main._publish_delta(req.project_id, trace_id, 1, "hel")
+        return {"ok": True, "trace_id": trace_id, "status": "complete"}
+
+    monkeypatch.setattr(main, "_execute_workflow", fake_execute)
+    response = client.post("/api/workflow/stream", json={"model": "m", "goal": "g", "project_id": "default"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    records = _parse_sse(response.text)
+    types = [r["type"] for r in records]
+    assert types[0] == "start"
+    assert "event" in types and "delta" in types
+    assert records[-1]["type"] == "done"
+    assert records[-1]["payload"]["status"] == "complete"
+
+def test_workflow_stream_attach_replays_finished_trace():
+    import main
+    main._emit_event("default", "stream-replay-trace", "Architect", "hello")
+    response = client.get("/api/workflow/stream?project_id=default&trace_id=stream-replay-trace")
+    records = _parse_sse(response.text)
+    assert any(r["type"] == "event" and r["text"] == "hello" for r in records)
+    assert records[-1]["type"] == "done"
+
+def test_sqlite_memory_store_migrates_json_and_updates_rows(tmp_path):
+    from main import SqliteMemoryStore, _read_runtime_memory, _write_runtime_memory
+
+    legacy = tmp_path / "project_memory.json"
+    _write_runtime_memory({"version": "1.0.0", "projects": {"alpha": {"state": {"pending_execution": True}}}}, str(legacy))
+    store = SqliteMemoryStore(str(tmp_path / "runtime.db"), legacy_json_path=str(legacy))
+
+    assert store.list_projects() == ["alpha"]
+    assert store.get_field("alpha", "state") == {"pending_execution": True}
+
+    store.update_field("beta", "bad_examples", lambda cur: (cur or []) + [1])
+    store.update_field("beta", "bad_examples", lambda cur: (cur or []) + [2])
+    assert store.get_field("beta", "bad_examples") == [1, 2]
+    assert store.get_project("alpha") == {"state": {"pending_execution": True}}
+
+    # Migration runs once; later edits to the JSON file are not re-imported.
+    _write_runtime_memory({"version": "1.0.0", "projects": {"gamma": {}}}, str(legacy))
+    reopened = SqliteMemoryStore(str(tmp_path / "runtime.db"), legacy_json_path=str(legacy))
+    assert reopened.list_projects() == ["alpha", "beta"]
+    assert reopened.export()["projects"]["beta"]["bad_examples"] == [1, 2]
+
+def test_json_memory_store_writes_and_updates_fields(tmp_path):
+    from main import JsonMemoryStore
+
+    store = JsonMemoryStore(str(tmp_path / "project_memory.json"))
+    store.ensure_project("alpha")
+    store.set_field("alpha", "state", {"pending_execution": True})
+    store.update_field("alpha", "bad_examples", lambda cur: (cur or []) + [1])
+    assert store.list_projects() == ["alpha"]
+    assert store.get_project("alpha") == {"state": {"pending_execution": True}, "bad_examples": [1]}
+
+def test_permissions_read_path_does_not_write_and_sees_external_edits(tmp_path, monkeypatch):
+    import shutil
+    import main
+
+    scratch = tmp_path / "permissions_runtime.json"
+    shutil.copy(main.RUNTIME_PERMISSIONS_PATH, scratch)
+    monkeypatch.setattr(main, "RUNTIME_PERMISSIONS_PATH", str(scratch))
+    before = os.stat(main.RUNTIME_PERMISSIONS_PATH).st_mtime_ns
+    perms = main._get_project_permissions("never-persisted-project")
+    assert perms == main.DEFAULT_PERMISSIONS
+    assert os.stat(main.RUNTIME_PERMISSIONS_PATH).st_mtime_ns == before
+    assert "never-persisted-project" not in main._read_runtime_permissions()["projects"]
+
+    # Another worker rewrites the file: the cache notices the new stat signature.
+    mem = main._read_runtime_permissions()
+    mem["projects"]["external-edit-project"] = {"file_write": False}
+    main._write_runtime_permissions(mem)
+    assert main._get_project_permissions("external-edit-project")["file_write"] is False
+
+def test_event_sink_buffers_live_trace_until_close(tmp_path, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "RUNS_DIR", str(tmp_path))
+    key = ("default", "buffered-sink-trace")
+    path = os.path.join(main.RUNS_DIR, *key, "workflow_events.jsonl")
+    main.LIVE_TRACES.add(key)
+    try:
+        for i in range(3):
+            main._emit_event(*key, "Executor", f"event {i}")
+        assert len(main.TRACE_CACHE.peek(key)["events"]) == 3
+    finally:
+        main.LIVE_TRACES.discard(key)
+        main._close_event_sink(*key)
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["text"] for line in f] == ["event 0", "event 1", "event 2"]
+    assert key not in main.EVENT_SINKS
+
+@pytest.mark.asyncio
+async def test_event_sink_flushes_quiet_runs_after_flush_interval(tmp_path, monkeypatch):
+    import asyncio
+    import main
+
+    monkeypatch.setattr(main, "EVENT_FLUSH_SECONDS", 0.05)
+    on_loop = main._EventSink(str(tmp_path / "loop.jsonl"))
+    on_loop.write("a\n")
+    await asyncio.to_thread(lambda: main._EventSink(str(tmp_path / "thread.jsonl")).write("b\n"))
+    assert not os.path.exists(tmp_path / "loop.jsonl")
+    await asyncio.sleep(0.2)
+    assert (tmp_path / "loop.jsonl").read_text() == "a\n"
+    assert (tmp_path / "thread.jsonl").read_text() == "b\n"
+    on_loop.close()
+
+def test_event_ring_buffer_keeps_latest_events():
+    import main
+
+    key = ("default", "ring-buffer-trace")
+    main.LIVE_TRACES.add(key)
+    try:
+        for i in range(main.WORKFLOW_EVENTS_MAX + 5):
+            main._emit_event(*key, "Executor", f"event {i}")
+    finally:
+        main.LIVE_TRACES.discard(key)
+        main._close_event_sink(*key)
+    events = main.TRACE_CACHE.peek(key)["events"]
+    assert len(events) == main.WORKFLOW_EVENTS_MAX
+    assert events[0]["text"] == "event 5"
+
+def test_trace_cache_evicts_lru_but_keeps_pinned_traces():
+    from main import _TraceCache
+
+    pinned = {("p", "live")}
+    cache = _TraceCache(max_traces=2, max_bytes=10_000, ttl=3600, pinned=pinned)
+    cache.add_event(("p", "live"), {"text": "x"}, 10)
+    cache.add_event(("p", "old"), {"text": "x"}, 10)
+    cache.add_event(("p", "new"), {"text": "x"}, 10)
+
+    assert cache.peek(("p", "live")) is not None
+    assert cache.peek(("p", "old")) is None
+    assert cache.lookup(("p", "new")) is not None
+    assert cache.lookup(("p", "old")) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 1)
+    assert stats["bytes"] == 20
+
+    cache.max_bytes = 15
+    cache.enforce()
+    assert cache.peek(("p", "new")) is None
+    assert cache.peek(("p", "live")) is not None
+
+def test_trace_cache_loads_whole_traces_and_sweeps_ttl_periodically():
+    from collections import deque
+    from main import _TraceCache
+
+    cache = _TraceCache(max_traces=4, max_bytes=50, ttl=3600, pinned=set())
+    cache.add_event(("p", "other"), {"text": "x"}, 10)
+    cache.load(("p", "big"), deque((({"seq": i + 1}, 20) for i in range(5))), {"Executor": {"name": "Executor"}})
+    entry = cache.peek(("p", "big"))
+    assert len(entry["events"]) == 5 and entry["seq"] == 5 and entry["bytes"] == 100
+    assert "Executor" in entry["agents"]
+    assert cache.peek(("p", "other")) is None and cache.stats()["evictions"] == 1
+
+    cache.max_bytes = 10_000
+    cache.ttl = -1  # everything is now expired, but appends only sweep once per sweep_interval
+    cache.add_event(("p", "a"), {"text": "x"}, 1)
+    assert cache.peek(("p", "big")) is not None
+    cache.enforce()
+    assert cache.stats()["traces"] == 0
+
+def test_workflow_events_cursor_and_etag(tmp_path, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "RUNS_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "TRACE_CACHE", main._TraceCache(main.TRACE_CACHE_MAX_TRACES, main.TRACE_CACHE_MAX_BYTES,
+                                                              main.TRACE_CACHE_TTL, main.LIVE_TRACES))
+    for i in range(3):
+        main._emit_event("default", "cursor-trace", "Executor", f"event {i}")
+
+    response = client.get("/api/workflow/events?project_id=default&trace_id=cursor-trace&since_seq=1")
+    data = response.json()
+    assert data["last_seq"] == 3
+    assert [ev["text"] for ev in data["events_by_agent"]["Executor"]] == ["event 1", "event 2"]
+
+    etag = response.headers["etag"]
+    cached = client.get("/api/workflow/events?project_id=default&trace_id=cursor-trace&since_seq=1",
+                        headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+
+    main._emit_event("default", "cursor-trace", "Executor", "event 3")
+    fresh = client.get("/api/workflow/events?project_id=default&trace_id=cursor-trace&since_seq=3",
+                       headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert [ev["seq"] for ev in fresh.json()["events_by_agent"]["Executor"]] == [4]
+
+def test_run_index_pages_newest_first_and_filters(tmp_path):
+    from main import RunIndex
+
+    index = RunIndex(str(tmp_path / "runtime.db"))
+    for i in range(5):
+        index.record_start("p", f"trace-{i}", f"goal {i}", 1000.0 + i)
+    index.record_finish("p", "trace-3", "complete", steps=4, usage={"prompt_tokens": 10, "completion_tokens": 5},
+                        files_touched=["preview/index.html", "preview/index.html"])
+
+    page, cursor = index.list("p", limit=2)
+    assert [r["trace_id"] for r in page] == ["trace-4", "trace-3"]
+    page2, cursor2 = index.list("p", limit=2, cursor=cursor)
+    assert [r["trace_id"] for r in page2] == ["trace-2", "trace-1"]
+    page3, cursor3 = index.list("p", limit=2, cursor=cursor2)
+    assert [r["trace_id"] for r in page3] == ["trace-0"] and cursor3 is None
+
+    done, _ = index.list("p", status="complete")
+    assert done[0]["steps"] == 4 and done[0]["prompt_tokens"] == 10
+    assert done[0]["files_touched"] == ["preview/index.html"]
+    recent, _ = index.list("p", since=1003.0, order="asc")
+    assert [r["trace_id"] for r in recent] == ["trace-3", "trace-4"]
+
+def test_list_runs_backfills_existing_run_directories():
+    response = client.get("/api/runs?project_id=default&limit=3")
+    data = response.json()
+    assert data["ok"] is True
+    assert len(data["runs"]) == 3
+    assert data["next_cursor"]
+    starts = [item["started_at"] for item in data["items"]]
+    assert starts == sorted(starts, reverse=True)
+    assert client.get("/api/runs?project_id=default&cursor=not-a-cursor").status_code == 400
+
+def test_workspace_index_tracks_tool_writes_and_pages_by_prefix(tmp_path, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "PROJECTS_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "WORKSPACE_INDEX", main._WorkspaceIndex(main.WORKSPACE_INDEX_TTL))
+    for name in ("a.html", "b.html", "c.css"):
+        assert main.tool_create_file("default", f"preview/index_test/{name}", name)["ok"] is True
+
+    page = main.tool_list_workspace("default", prefix="preview/index_test/", limit=2, detail=True)
+    assert page["files"] == ["preview/index_test/a.html", "preview/index_test/b.html"]
+    assert page["total"] == 3 and page["next_offset"] == 2
+    assert page["entries"][0]["hash"] == main._content_hash(b"a.html")
+    rest = main.tool_list_workspace("default", prefix="preview/index_test/", offset=2)
+    assert rest["files"] == ["preview/index_test/c.css"] and "next_offset" not in rest
+
+    main.tool_delete_file("default", "preview/index_test/b.html")
+    assert "preview/index_test/b.html" not in main.tool_list_workspace("default")["files"]
+
+    # Files created behind the tools' back show up once the index is stale.
+    external = os.path.join(main._project_root("default"), "preview", "index_test", "external.js")
+    with open(external, "w", encoding="utf-8") as f:
+        f.write("x")
+    monkeypatch.setattr(main.WORKSPACE_INDEX, "ttl", 0.0)
+    assert "preview/index_test/external.js" in main.tool_list_workspace("default")["files"]
+
+def test_workspace_index_scans_outside_its_lock(tmp_path, monkeypatch):
+    import threading
+    import main
+
+    monkeypatch.setattr(main, "PROJECTS_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "WORKSPACE_INDEX", main._WorkspaceIndex(main.WORKSPACE_INDEX_TTL))
+    assert main.tool_create_file("default", "preview/index_lock/a.txt", "a")["ok"] is True
+    index = main._WorkspaceIndex(ttl=60)
+    scanning, release = threading.Event(), threading.Event()
+    real_scan = index._scan
+
+    def slow_scan(project_id, previous):
+        if project_id == "slow":
+            scanning.set()
+            release.wait(5)
+            return {}
+        return real_scan(project_id, previous)
+
+    monkeypatch.setattr(index, "_scan", slow_scan)
+    assert "preview/index_lock/a.txt" in index.paths("default")
+    worker = threading.Thread(target=index.paths, args=("slow",))
+    worker.start()
+    assert scanning.wait(5)
+    # Another project stays readable and writable while "slow" is being walked.
+    index.record_write("default", "preview/index_lock/a.txt", b"a")
+    assert index.file_hash("default", "preview/index_lock/a.txt") == main._content_hash(b"a")
+    release.set()
+    worker.join(5)
+    assert index.paths("slow") == []
+
+    # A write recorded while a rescan is in flight marks the swapped-in state for another scan.
+    index.mark_dirty("default")
+    monkeypatch.setattr(index, "_scan", lambda project_id, previous: (
+        index.record_delete(project_id, "preview/index_lock/a.txt"), real_scan(project_id, previous))[1])
+    index.paths("default")
+    assert index._projects["default"]["dirty"] is True
+
+def test_response_cache_lru_disk_tier_and_ttl(tmp_path):
+    from main import _ResponseCache
+
+    cache = _ResponseCache(max_entries=1, ttl=60, disk_dir=str(tmp_path))
+    k1 = _ResponseCache.key("/v1/chat/completions", {"model": "m", "messages": [{"role": "user", "content": "a"}], "temperature": 0})
+    k2 = _ResponseCache.key("/v1/chat/completions", {"model": "m", "messages": [{"role": "user", "content": "b"}], "temperature": 0})
+    assert k1 != k2
+    cache.put(k1, {"answer": 1})
+    cache.put(k2, {"answer": 2})
+    assert cache.get(k2) == {"answer": 2}
+    assert cache.get(k1) == {"answer": 1}  # evicted from memory, served from disk
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 0)
+
+    expired = _ResponseCache(max_entries=4, ttl=-1, disk_dir=str(tmp_path))
+    assert expired.get(k1) is None
+
+@pytest.mark.asyncio
+async def test_mistral_post_async_serves_cached_calls_without_http(monkeypatch):
+    import main
+
+    calls = []
+
+    class FakeResponse:
+        status_code = 200
+        def json(self):
+            return {"choices": [{"message": {"content": "ok"}}]}
+
+    class FakeClient:
+        async def post(self, url, headers=None, json=None):
+            calls.append(json)
+            return FakeResponse()
+
+    monkeypatch.setattr(main, "MISTRAL_API_KEY", "test-key")
+    monkeypatch.setattr(main, "_async_client", lambda base_url: FakeClient())
+    monkeypatch.setattr(main, "LLM_RESPONSE_CACHE", main._ResponseCache(8, 60))
+    payload = {"model": "m", "messages": [{"role": "user", "content": "same"}], "temperature": 0.0}
+    first = await main.mistral_post_async("/v1/chat/completions", payload, cache=True)
+    second = await main.mistral_post_async("/v1/chat/completions", payload, cache=True)
+    assert first == second
+    assert len(calls) == 1
+    await main.mistral_post_async("/v1/chat/completions", payload)
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_describe_visuals_is_memoized_on_preview_content(monkeypatch):
+    import main
+
+    calls = []
+
+    async def fake_post(path, payload, cache=False, **kwargs):
+        calls.append(payload)
+        return {"choices": [{"message": {"content": f"description {len(calls)}"}}]}
+
+    monkeypatch.setattr(main, "mistral_post_async", fake_post)
+    pid = "visuals-memo-test"
+    main.tool_create_file(pid, "preview/index.html", '<link rel="stylesheet" href="theme.css"><h1>Hi</h1>')
+    main.tool_create_file(pid, "preview/theme.css", "h1{color:red}")
+
+    first = await main.tool_describe_visuals(pid, "m")
+    second = await main.tool_describe_visuals(pid, "m")
+    assert first["description"] == second["description"] == "description 1"
+    assert second["cached"] is True
+    assert len(calls) == 1
+
+    # A change to a linked local asset invalidates the description, and the model is shown the new asset,
+    # so the response cache cannot answer the refreshed prompt with the old description.
+    assert "h1{color:red}" in calls[0]["messages"][1]["content"]
+    main.tool_create_file(pid, "preview/theme.css", "h1{color:blue}")
+    third = await main.tool_describe_visuals(pid, "m")
+    assert third["description"] == "description 2"
+    assert len(calls) == 2
+    assert "h1{color:blue}" in calls[1]["messages"][1]["content"]
+    assert main._ResponseCache.key("/v1/chat/completions", calls[0]) != main._ResponseCache.key("/v1/chat/completions", calls[1])
+
+
+def test_compact_transcript_elides_stale_file_content_and_keeps_tool_pairs():
+    import main
+
+    def call(cid, name, args):
+        return {"id": cid, "type": "function", "function": {"name": name, "arguments": json.dumps(args)}}
+
+    transcript = [
+        {"role": "system", "content": "ctx"},
+        {"role": "user", "content": "goal"},
+        {"role": "assistant", "content": "", "tool_calls": [call("c1", "read_file", {"filename": "a.txt"})]},
+        {"role": "tool", "tool_call_id": "c1", "name": "read_file", "content": json.dumps({"ok": True, "content": "x" * 4000})},
+        {"role": "assistant", "content": "", "tool_calls": [call("c2", "create_file", {"filename": "a.txt", "content": "y" * 4000})]},
+        {"role": "tool", "tool_call_id": "c2", "name": "create_file", "content": json.dumps({"ok": True})},
+        {"role": "assistant", "content": "", "tool_calls": [call("c3", "read_file", {"filename": "b.txt"})]},
+        {"role": "tool", "tool_call_id": "c3", "name": "read_file", "content": json.dumps({"ok": True, "content": "z" * 4000})},
+        {"role": "assistant", "content": "done"},
+    ]
+    original = json.dumps(transcript)
+
+    view = main._compact_transcript(transcript, budget=100_000, keep_recent=3)
+    assert json.dumps(transcript) == original
+    assert "superseded" in view[3]["content"]
+    assert "chars written" in view[4]["tool_calls"][0]["function"]["arguments"]
+    assert view[7] == transcript[7]
+
+    tight = main._compact_transcript(transcript, budget=1_200, keep_recent=3)
+    assert sum(main._approx_tokens(m) for m in tight) <= 1_200
+    assert "elided to fit the context budget" in tight[1]["content"]
+    ids = {tc["id"] for m in tight for tc in m.get("tool_calls") or []}
+    assert all(m["tool_call_id"] in ids for m in tight if m["role"] == "tool")
+
+@pytest.mark.asyncio
+async def test_postprocess_runs_in_background_with_retries_and_status(monkeypatch):
+    import asyncio
+    import main
+
+    monkeypatch.setattr(main, "POSTPROCESS_RETRY_DELAY", 0)
+    release = asyncio.Event()
+    active, peak, failures, seen_by_meta = [0], [0], {"notes": 1}, []
+
+    async def fake_post(path, payload, **kwargs):
+        system = payload["messages"][0]["content"]
+        stage = "architect" if "Architect" in system else "notes" if "Note-Taker" in system else "meta"
+        if stage == "architect":
+            await release.wait()
+            return {"choices": [{"message": {"content": json.dumps({"goal": "g"})}}]}
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        if failures.get(stage):
+            failures[stage] -= 1
+            raise RuntimeError("upstream hiccup")
+        if stage == "meta":
+            seen_by_meta.append(json.loads(payload["messages"][1]["content"]))
+        body = "- watch out" if stage == "notes" else json.dumps({"workflow_issues": []})
+        return {"choices": [{"message": {"content": body}}]}
+
+    monkeypatch.setattr(main, "mistral_post_async", fake_post)
+    task = main._enqueue_postprocess("default", "postprocess-trace", "g", [{"role": "user", "content": "g"}], "m")
+    await asyncio.sleep(0)
+    assert main.read_run("default", "postprocess-trace")["postprocess"]["status"] in ("queued", "running")
+
+    release.set()
+    await task
+    run = main.read_run("default", "postprocess-trace")
+    assert run["postprocess"]["status"] == "complete"
+    assert run["postprocess"]["stages"]["notes"]["attempts"] == 2
+    assert run["notes"].strip() == "- watch out"
+    assert run["architect_summary"] == {"goal": "g"}
+    assert peak[0] == 1 and seen_by_meta[0]["notes"] == "- watch out"
+
+@pytest.mark.asyncio
+async def test_postprocess_left_queued_is_resumed_or_marked_interrupted(tmp_path, monkeypatch):
+    import asyncio
+    import main
+
+    async def fake_post(path, payload, **kwargs):
+        return {"choices": [{"message": {"content": json.dumps({"goal": "g"})}}]}
+
+    monkeypatch.setattr(main, "RUNS_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "mistral_post_async", fake_post)
+    main._save_run_artifacts("p", "with-run", {"goal": "g", "transcript": [{"role": "user", "content": "g"}]})
+    for trace_id in ("with-run", "lost"):
+        main._write_postprocess_status("p", trace_id, {"status": "queued", "model": "m", "stages": {}})
+
+    await main._resume_postprocess()
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[t for t in main.BACKGROUND_TASKS if t.get_loop() is loop])
+    assert main.read_run("p", "with-run")["postprocess"]["status"] == "complete"
+    assert main.read_run("p", "lost")["postprocess"]["status"] == "interrupted"
+
+@pytest.mark.asyncio
+async def test_workflow_job_resumes_from_checkpoint_after_crash(tmp_path, monkeypatch):
+    import asyncio
+    import main
+
+    queue = main.JobQueue(str(tmp_path / "runtime.db"))
+    monkeypatch.setattr(main, "JOB_QUEUE", queue)
+    calls = []
+
+    def tool_step(cid):
+        return {"choices": [{"message": {"role": "assistant", "content": "", "tool_calls": [
+            {"id": cid, "type": "function", "function": {"name": "list_workspace", "arguments": "{}"}}]}}]}
+
+    async def crashing_post(path, payload, **kwargs):
+        calls.append("plan" if "tools" not in payload else "step")
+        if "tools" not in payload:
+            return {"choices": [{"message": {"content": json.dumps({"files": [], "steps": ["s"]})}}]}
+        if calls.count("step") == 1:
+            return tool_step("c1")
+        raise asyncio.CancelledError()  # the worker process dies mid-step
+
+    monkeypatch.setattr(main, "mistral_post_async", crashing_post)
+    req = main.WorkflowRequest(model="m", goal="resume me", project_id="default", enable_postprocess=False, max_steps=5)
+    queue.submit("default", "job-trace", req.dict())
+    with pytest.raises(asyncio.CancelledError):
+        await main._run_job(queue.claim())
+    job = queue.get("job-trace")
+    assert job["status"] == "running" and job["checkpoint"]["step"] == 1
+
+    assert queue.requeue_interrupted(max_attempts=3) == 0  # lease still fresh: another worker may own it
+    assert queue.heartbeat("job-trace", main.JOB_WORKER_ID) and not queue.heartbeat("job-trace", "someone-else")
+    assert queue.requeue_interrupted(max_attempts=3, lease=-1) == 1
+    assert queue.get("job-trace")["owner"] is None
+    calls.clear()
+
+    async def finishing_post(path, payload, **kwargs):
+        calls.append("plan" if "tools" not in payload else "step")
+        return {"choices": [{"message": {"role": "assistant", "content": "done"}}]}
+
+    monkeypatch.setattr(main, "mistral_post_async", finishing_post)
+    job = queue.claim()
+    assert job["attempts"] == 2
+    await main._run_job(job)
+
+    assert calls == ["step"]
+    assert queue.get("job-trace")["status"] == "complete"
+    run = main.read_run("default", "job-trace")["run"]
+    assert run["used_steps"] == 2
+    assert any(m.get("tool_call_id") == "c1" for m in run["transcript"])
+
+def test_submit_workflow_job_endpoint_queues_and_wakes_workers(tmp_path, monkeypatch):
+    import asyncio
+    import main
+
+    queue = main.JobQueue(str(tmp_path / "runtime.db"))
+    monkeypatch.setattr(main, "JOB_QUEUE", queue)
+    monkeypatch.setattr(main, "RUNS_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "_JOB_WORKERS", None)
+
+    async def idle(wake):
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(main, "_job_worker", idle)
+    monkeypatch.setattr(main, "_job_lease_sweeper", idle)
+    response = client.post("/api/workflow/jobs", json={"model": "m", "goal": "queue me", "project_id": "default"})
+    assert response.status_code == 200
+    trace_id = response.json()["trace_id"]
+    assert queue.get(trace_id)["status"] == "queued"
+    assert main._JOB_WORKERS[2].is_set()
+
+@pytest.mark.asyncio
+async def test_workflow_job_fails_bad_requests_and_stops_when_its_lease_is_lost(tmp_path, monkeypatch):
+    import asyncio
+    import main
+
+    queue = main.JobQueue(str(tmp_path / "runtime.db"))
+    monkeypatch.setattr(main, "JOB_QUEUE", queue)
+    monkeypatch.setattr(main, "RUNS_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "WORKFLOW_JOB_LEASE", 0.1)
+
+    queue.submit("default", "bad-job", {"project_id": "default"})
+    await main._run_job(queue.claim())
+    job = queue.get("bad-job")
+    assert job["status"] == "failed" and "field required" in job["error"]
+
+    started, cancelled = asyncio.Event(), []
+
+    async def hanging_post(path, payload, **kwargs):
+        started.set()
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(main, "mistral_post_async", hanging_post)
+    req = main.WorkflowRequest(model="m", goal="steal me", project_id="default", enable_postprocess=False)
+    queue.submit("default", "stolen-job", req.dict())
+    runner = asyncio.ensure_future(main._run_job(queue.claim()))
+    await started.wait()
+    with queue._tx() as conn:  # the lease expired and another worker claimed the job
+        conn.execute("UPDATE jobs SET owner = 'other-worker' WHERE trace_id = 'stolen-job'")
+    await asyncio.wait_for(runner, 5)
+    assert cancelled and queue.get("stolen-job")["owner"] == "other-worker"
+    assert queue.get("stolen-job")["status"] == "running"
+
+def test_workspace_writes_are_serialized_atomic_and_honor_expected_hash():
+    import asyncio
+    import threading
+    import main
+
+    pid, rel = "default", "preview/occ-test.txt"
+    created = main.tool_create_file(pid, rel, "0")
+    assert created["hash"] == main._content_hash(b"0")
+
+    def bump(i):
+        main.tool_patch_file(pid, rel, "|", f"|{i}|", 1)
+
+    main.tool_patch_file(pid, rel, "0", "0|", 1)
+    threads = [threading.Thread(target=bump, args=(i,)) for i in range(1, 21)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    content = main.tool_read_file(pid, rel)["content"]
+    assert sorted(int(x) for x in content.split("|")[1:-1] if x) == list(range(1, 21))
+    assert not [n for n in os.listdir(main._resolve_path(pid, "preview")) if n.endswith(main._WRITE_TMP_SUFFIX)]
+
+    current = main.tool_read_file(pid, rel)["hash"]
+    stale = client.post("/api/workspace/write", json={"project_id": pid, "path": rel, "content": "x", "expected_hash": "stale"})
+    assert stale.status_code == 409
+    assert stale.json()["detail"]["current_hash"] == current
+    ok = client.post("/api/workspace/patch", json={"project_id": pid, "path": rel, "find": "|", "replace": "-",
+                                                   "expected_hash": current})
+    assert ok.status_code == 200 and ok.json()["ok"] is True
+    assert main.tool_delete_file(pid, rel, expected_hash=current)["error"] == "conflict"
+    assert main.tool_delete_file(pid, rel, expected_hash=ok.json()["hash"])["ok"] is True
+    assert main.tool_create_file(pid, rel, "new", expected_hash="")["ok"] is True
+
+    # The agent's tools expose the same check, and idle path locks are not kept around.
+    schemas = {t["function"]["name"]: t["function"]["parameters"] for t in main.TOOLS}
+    assert all("expected_hash" in schemas[name]["properties"] for name in ("create_file", "patch_file", "delete_file"))
+    assert "expected_hash" in schemas["apply_changes"]["properties"]["changes"]["items"]["properties"]
+    result = asyncio.run(main.run_tool(pid, "m", "patch_file", {"filename": rel, "find": "new", "replace": "x",
+                                                                "expected_hash": "stale"}))
+    assert result["error"] == "conflict"
+    assert (pid, rel) not in main._PATH_LOCKS
+
+def test_workspace_batch_is_all_or_nothing_and_read_many():
+    import main
+
+    pid = "default"
+    ok = client.post("/api/workspace/batch", json={"project_id": pid, "operations": [
+        {"op": "create", "filename": "preview/batch/index.html", "content": "<h1>hi</h1>"},
+        {"op": "create", "filename": "preview/batch/styles.css", "content": "h1{}"},
+        {"op": "patch", "filename": "preview/batch/index.html", "find": "hi", "replace": "hello"},
+    ]}).json()
+    assert ok["ok"] is True and [r["ok"] for r in ok["results"]] == [True, True, True]
+
+    failed = client.post("/api/workspace/batch", json={"project_id": pid, "operations": [
+        {"op": "delete", "filename": "preview/batch/styles.css"},
+        {"op": "create", "filename": "preview/batch/app.js", "content": "x"},
+        {"op": "patch", "filename": "preview/batch/index.html", "find": "missing", "replace": "?"},
+        {"op": "create", "filename": "preview/batch/later.js", "content": "y"},
+    ]}).json()
+    assert failed["applied"] is False
+    assert [r["ok"] for r in failed["results"]] == [True, True, False, False]
+    assert failed["results"][3]["error"] == "not attempted"
+
+    read = client.post("/api/workspace/read_many", json={"project_id": pid, "paths": [
+        "preview/batch/index.html", "preview/batch/styles.css", "preview/batch/app.js"]}).json()
+    assert [f["ok"] for f in read["files"]] == [True, True, False]
+    assert read["files"][0]["content"] == "<h1>hello</h1>"
+    assert "preview/batch/app.js" not in main.tool_list_workspace(pid, prefix="preview/batch/")["files"]
+
+    conflict = client.post("/api/workspace/batch", json={"project_id": pid, "operations": [
+        {"op": "delete", "filename": "preview/batch/styles.css", "expected_hash": "stale"}]})
+    assert conflict.status_code == 409
+
+    with open(main._resolve_path(pid, "preview/batch/blob.bin"), "wb") as f:
+        f.write(b"\xff\xfe binary")
+    for op in ({"op": "patch", "filename": "preview/batch/index.html", "find": "hello", "replace": "x", "count": None},
+               {"op": "patch", "filename": "preview/batch/blob.bin", "find": "binary", "replace": "x"}):
+        bad = client.post("/api/workspace/batch", json={"project_id": pid, "operations": [op]})
+        assert bad.status_code == 200 and bad.json()["results"][0]["ok"] is False
+    mixed = client.post("/api/workspace/read_many", json={"project_id": pid, "paths": [
+        "preview/batch/blob.bin", "preview/batch/index.html"]}).json()
+    assert [f["ok"] for f in mixed["files"]] == [False, True]
+
+def test_patch_engine_hunks_diff_whitespace_fuzzy_and_line_ranges():
+    import main
+
+    pid, rel = "default", "preview/patch-engine.js"
+    source = "function a() {\n    return 1;\n}\n\nfunction b() {\n    const total = items.reduce((s, x) => s + x, 0);\n    return total;\n}\n"
+    main.tool_create_file(pid, rel, source)
+
+    result = main.tool_patch_file(pid, rel, hunks=[
+        {"find": "function a() {\n  return 1;\n}", "replace": "function a() {\n  return 2;\n}"},
+        {"find": "const totl = items.reduce((s, x) => s + x, 0);\nreturn total;", "replace": "return items.length;"},
+        {"start_line": 4, "end_line": 4, "replace": "// spacer"},
+    ])
+    assert result["ok"] is True
+    assert [h["match"] for h in result["hunks"]] == ["whitespace", "fuzzy", "line_range"]
+    content = main.tool_read_file(pid, rel)["content"]
+    assert content == "function a() {\n    return 2;\n}\n// spacer\nfunction b() {\n    return items.length;\n}\n"
+
+    diff = "--- a/x\n+++ b/x\n@@ -6,2 +6,3 @@\n     return items.length;\n-}\n+}\n+export { a, b };\n"
+    assert main.tool_patch_file(pid, rel, diff=diff)["ok"] is True
+    assert main.tool_read_file(pid, rel)["content"].endswith("}\nexport { a, b };\n")
+
+    before = main.tool_read_file(pid, rel)["content"]
+    failed = main.tool_patch_file(pid, rel, hunks=[
+        {"find": "return 2;", "replace": "return 3;"},
+        {"find": "no such text anywhere", "replace": "?"},
+    ])
+    assert failed["ok"] is False and [h["ok"] for h in failed["hunks"]] == [True, False]
+    assert main.tool_read_file(pid, rel)["content"] == before
+
+def test_patch_engine_keeps_blank_lines_and_line_edges_exact():
+    from main import _apply_hunks, _parse_unified_diff
+
+    def apply(text, diff):
+        return _apply_hunks(text, _parse_unified_diff(diff))
+
+    assert apply("a\nfoo\n", "@@ -0,0 +1,1 @@\n+top")[0] == "top\na\nfoo\n"
+    assert apply("x\nfoo\n\nbar\n", "@@ -2,2 +2,3 @@\n foo\n \n+baz")[0] == "x\nfoo\n\nbaz\nbar\n"
+    assert apply("a\nb\n\nnext\n", "@@ -3,2 +3,1 @@\n-\n next")[0] == "a\nb\nnext\n"
+    assert apply("a\nb", "@@ -2,0 +3,1 @@\n+c")[0] == "a\nb\nc"
+    patched, results = _apply_hunks("a\nb\n", [{"find": "a", "replace": "z", "count": 0}])
+    assert patched is None and results[0]["ok"] is False and "count" in results[0]["error"]
+
+def test_read_file_windows_grep_and_http_range():
+    import main
+
+    pid, rel = "default", "preview/big.txt"
+    body = "".join(f"line {i}\n" for i in range(1, 1001))
+    main.tool_create_file(pid, rel, body)
+
+    window = main.tool_read_file(pid, rel, offset=10, limit=3)
+    assert window["content"] == "line 11\nline 12\nline 13\n"
+    assert (window["start_line"], window["next_offset"]) == (11, 13)
+    assert window["hash"] == main._content_hash(body.encode())
+
+    chunk = main.tool_read_file(pid, rel, offset=5, limit=6, unit="byte")
+    assert chunk["content"] == body[5:11] and chunk["size"] == len(body)
+
+    grep = main.tool_read_file(pid, rel, pattern=r"^line (500|503)$", context=1)
+    assert grep["matches"] == [500, 503]
+    assert grep["content"].split("\n") == ["499-line 499", "500:line 500", "501-line 501",
+                                          "502-line 502", "503:line 503", "504-line 504"]
+
+    capped = main.tool_read_file(pid, rel, max_chars=100)
+    assert capped["truncated"] is True and capped["content"].startswith("line 1\n")
+    assert main.tool_read_file(pid, rel, offset=capped["next_offset"], limit=1)["content"] == f"line {capped['next_offset'] + 1}\n"
+
+    ranged = client.get("/api/workspace/read", params={"project_id": pid, "path": rel}, headers={"Range": "bytes=0-6"})
+    assert ranged.status_code == 206 and ranged.text == "line 1\n"
+    assert ranged.headers["content-range"] == f"bytes 0-6/{len(body)}"
+    suffix = client.get("/api/workspace/read", params={"project_id": pid, "path": rel}, headers={"Range": "bytes=-9"})
+    assert suffix.text == "line 1000\n"[-9:]
+    bad = client.get("/api/workspace/read", params={"project_id": pid, "path": rel}, headers={"Range": f"bytes={len(body)}-"})
+    assert bad.status_code == 416
+
+def test_read_file_pages_through_a_single_minified_line():
+    import main
+
+    pid, rel = "default", "preview/app.min.js"
+    body = "head\n" + "é" * 25000 + "x" * 25000
+    main.tool_create_file(pid, rel, body)
+
+    assert main.tool_read_file(pid, rel, max_chars=10000)["next_offset"] == 1
+    main.tool_create_file(pid, "preview/one-line.js", "x" * 50000)
+    whole = main.tool_read_file(pid, "preview/one-line.js", max_chars=10000)
+    assert (whole["next_unit"], whole["next_offset"]) == ("byte", 10000)
+
+    window = main.tool_read_file(pid, rel, offset=1, limit=5, max_chars=10000)
+    assert window["content"] == "é" * 10000 and window["next_unit"] == "byte"
+    seen, offset = window["content"], window["next_offset"]
+    while True:
+        page = main.tool_read_file(pid, rel, offset=offset, unit="byte", max_chars=7001)
+        seen += page["content"]
+        if "next_offset" not in page:
+            break
+        assert page["next_offset"] > offset
+        offset = page["next_offset"]
+    assert seen == body[5:]
+
+@pytest.mark.asyncio
+async def test_llm_calls_are_accounted_per_site_trace_and_exported(tmp_path, monkeypatch):
+    import main
+
+    class FakeResponse:
+        status_code = 200
+        def json(self):
+            return {"choices": [{"message": {"content": "ok"}}], "usage": {"prompt_tokens": 7, "completion_tokens": 3}}
+
+    class FakeClient:
+        async def post(self, url, headers=None, json=None):
+            return FakeResponse()
+
+    monkeypatch.setattr(main, "MISTRAL_API_KEY", "test-key")
+    monkeypatch.setattr(main, "_async_client", lambda base_url: FakeClient())
+    monkeypatch.setattr(main, "LLM_METRICS", main.LLMMetrics())
+    monkeypatch.setattr(main, "LLM_RESPONSE_CACHE", main._ResponseCache(8, 60))
+    monkeypatch.setattr(main, "RUNS_DIR", str(tmp_path))
+
+    token = main._LLM_CONTEXT.set({"project_id": "default", "trace_id": "metrics-trace"})
+    try:
+        payload = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+        await main.mistral_post_async("/v1/chat/completions", payload, site="executor", step=1)
+        await main.mistral_post_async("/v1/chat/completions", payload, site="planner", cache=True)
+        await main.mistral_post_async("/v1/chat/completions", payload, site="planner", cache=True)
+    finally:
+        main._LLM_CONTEXT.reset(token)
+
+    summary = main.LLMMetrics.summarize(main._read_llm_calls("default", "metrics-trace"))
+    assert summary["calls"] == 3 and summary["prompt_tokens"] == 14
+    assert summary["by_site"]["planner"] == dict(summary["by_site"]["planner"], calls=2, cached=1)
+    assert main.LLM_METRICS.trace_calls("default", "metrics-trace")[0]["step"] == 1
+
+    text = client.get("/api/metrics", params={"format": "prometheus"}).text
+    assert 'llm_calls_total{site="planner",model="m",endpoint="/v1/chat/completions"} 2' in text
+    assert 'llm_tokens_total{site="executor",model="m",endpoint="/v1/chat/completions",kind="prompt"} 7' in text
+    assert "llm_call_seconds_bucket" in text and "workflow_jobs" in text
+    families = []
+    for line in text.splitlines():
+        name = None if line.startswith("#") else re.sub(r"_(bucket|sum|count)$", "", line.split("{")[0].split()[0])
+        if name and (not families or families[-1] != name):
+            families.append(name)
+    assert len(families) == len(set(families)), "metric families must be contiguous"
+    assert client.get("/api/metrics").json()["llm"][0]["site"] == "executor"
+
+def _stub_server(state):
+    """Local HTTP server standing in for a Mistral-compatible API; queue (status, headers) replies in `script`."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            state["hits"] += 1
+            state.setdefault("models", []).append(body.get("model"))
+            status, headers = state["script"].pop(0) if state["script"] else (state.get("default", 200), {})
+            body = json.dumps({"choices": [{"message": {"content": "ok"}}], "usage": {"prompt_tokens": 1, "completion_tokens": 1}}
+                              if status == 200 else {"message": "slow down"}).encode()
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", server
+
+@pytest.fixture
+def mistral_stub(monkeypatch):
+    import main
+
+    state = {"script": [], "hits": 0}
+    url, server = _stub_server(state)
+    monkeypatch.setattr(main, "MISTRAL_BASE_URL", url)
+    monkeypatch.setattr(main, "MISTRAL_API_KEY", "stub-key")
+    monkeypatch.setattr(main, "MISTRAL_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(main, "LLM_METRICS", main.LLMMetrics())
+    yield state
+    server.shutdown()
+
+@pytest.mark.asyncio
+async def test_mistral_calls_retry_429_and_5xx_honouring_retry_after(mistral_stub, monkeypatch):
+    import time
+    import main
+
+    mistral_stub["script"] = [(429, {"Retry-After": "0.2"}), (503, {})]
+    started = time.monotonic()
+    data = await main.mistral_post_async("/v1/chat/completions", {"model": "m", "messages": []}, site="executor")
+    assert data["choices"][0]["message"]["content"] == "ok"
+    assert mistral_stub["hits"] == 3
+    assert time.monotonic() - started >= 0.2
+    assert main.LLM_METRICS.snapshot()[0]["retries"] == 2
+
+    monkeypatch.setattr(main, "MISTRAL_MAX_RETRIES", 1)
+    mistral_stub["script"] = [(500, {}), (500, {})]
+    with pytest.raises(main.HTTPException) as err:
+        await main.mistral_post_async("/v1/chat/completions", {"model": "m", "messages": []})
+    assert err.value.detail["mistral_status"] == 500
+    mistral_stub["script"] = [(400, {})]
+    with pytest.raises(main.HTTPException):
+        await main.mistral_post_async("/v1/chat/completions", {"model": "m", "messages": []})
+    assert mistral_stub["hits"] == 6
+
+@pytest.mark.asyncio
+async def test_side_effecting_calls_are_not_resent_and_retries_stay_in_budget(mistral_stub, monkeypatch):
+    import httpx
+    import main
+
+    mistral_stub["script"] = [(409, {})]
+    with pytest.raises(main.HTTPException):
+        await main.mistral_post_async("/v1/chat/completions", {"model": "m", "messages": []})
+    mistral_stub["script"] = [(502, {})]
+    with pytest.raises(main.HTTPException):
+        await main.mistral_post_async("/v1/agents", {"model": "m", "name": "a"}, site="agents")
+    assert mistral_stub["hits"] == 2  # neither was sent twice
+
+    sends = []
+
+    async def timing_out(provider):
+        sends.append(provider.name)
+        raise httpx.ReadTimeout("no answer")
+
+    monkeypatch.setattr(main, "MISTRAL_MAX_RETRIES", 2)
+    for path, budget, expected in [("/v1/agents", 60, 1), ("/v1/chat/completions", 60, 3), ("/v1/chat/completions", 0, 1)]:
+        sends.clear()
+        monkeypatch.setattr(main, "MISTRAL_RETRY_BUDGET", budget)
+        with pytest.raises(httpx.ReadTimeout):
+            await main._send_with_retries(path, {"model": "m", "messages": []}, "executor", timing_out, [0])
+        assert len(sends) == expected, path
+
+@pytest.mark.asyncio
+async def test_rate_limiter_serves_interactive_lane_before_bulk():
+    import asyncio
+    import main
+
+    limiter = main._RateLimiter(rpm=1200, tpm=0)  # refills one request every 50ms
+    limiter._requests = 0
+    order = []
+
+    async def call(name, lane):
+        await limiter.acquire(10, lane)
+        order.append(name)
+
+    bulk = [asyncio.create_task(call(f"bulk{i}", main._LANES["executor"])) for i in range(3)]
+    await asyncio.sleep(0.01)
+    gate = asyncio.create_task(call("gate", main._LANES["gate"]))
+    await asyncio.gather(gate, *bulk)
+    assert order[0] == "gate"
+    assert order[1:] == ["bulk0", "bulk1", "bulk2"]
+
+@pytest.mark.asyncio
+async def test_provider_pool_fails_over_trips_circuit_and_routes_models(monkeypatch):
+    import main
+
+    good, bad = {"script": [], "hits": 0}, {"script": [], "hits": 0, "default": 503}
+    good_url, good_server = _stub_server(good)
+    bad_url, bad_server = _stub_server(bad)
+    try:
+        monkeypatch.setattr(main, "MISTRAL_BACKOFF_BASE", 0.001)
+        monkeypatch.setattr(main, "LLM_CIRCUIT_FAILURES", 2)
+        monkeypatch.setattr(main, "LLM_PROVIDERS", json.dumps([
+            {"name": "bad", "base_url": bad_url, "api_key": "k1"},
+            {"name": "good", "base_url": good_url, "api_key": "k2"},
+        ]))
+        monkeypatch.setattr(main, "LLM_MODEL_ROUTES", json.dumps({"gate": "small-model"}))
+        for _ in range(6):
+            data = await main.mistral_post_async("/v1/chat/completions", {"model": "big-model", "messages": []}, site="gate")
+            assert data["choices"][0]["message"]["content"] == "ok"
+        assert bad["hits"] == 2  # then its circuit opened and traffic stayed on the healthy endpoint
+        assert good["hits"] == 6 and set(good["models"]) == {"small-model"}
+        stats = {p["name"]: p for p in client.get("/api/llm/providers").json()["providers"]}
+        assert stats["bad"]["circuit"] == "open" and stats["good"]["circuit"] == "closed"
+    finally:
+        good_server.shutdown()
+        bad_server.shutdown()
+
+@pytest.mark.asyncio
+async def test_cancelled_calls_leave_the_circuit_alone_and_get_errors_trip_it(monkeypatch):
+    import asyncio
+    import main
+
+    monkeypatch.setattr(main, "LLM_CIRCUIT_FAILURES", 2)
+    monkeypatch.setattr(main, "LLM_PROVIDERS", json.dumps([{"name": "flaky", "base_url": "http://127.0.0.1:9", "api_key": "k"}]))
+    pool = main._provider_pool()
+    provider = pool.providers[0]
+    provider.failures = 2  # cooled down: half-open, waiting for one trial request
+
+    async def never_answers(p):
+        await asyncio.sleep(30)
+
+    trial = asyncio.ensure_future(main._send_with_retries("/v1/chat/completions", {"model": "m", "messages": []},
+                                                          "planner", never_answers, [0]))
+    await asyncio.sleep(0.01)
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    stats = pool.stats()[0]
+    assert stats["circuit"] == "half_open" and stats["outstanding"] == 0 and stats["consecutive_failures"] == 2
+
+    provider.failures = 0
+    with pytest.raises(Exception):
+        main.mistral_get("/v1/models")
+    with pytest.raises(Exception):
+        await main.mistral_get_async("/v1/models")
+    assert pool.stats()[0]["consecutive_failures"] == 2
+
+def test_weighted_round_robin_spreads_by_weight():
+    import main
+
+    pool = main.ProviderPool([main._Provider("a", "http://a", "ka", weight=3), main._Provider("b", "http://b", "kb", weight=1)],
+                             "weighted_round_robin")
+    picks = []
+    for _ in range(8):
+        p = pool.acquire()
+        picks.append(p.name)
+        pool.release(p, True)
+    assert picks.count("a") == 6 and picks.count("b") == 2
+
+@pytest.mark.asyncio
+async def test_local_classifier_answers_clear_cases_and_defers_the_rest(tmp_path, monkeypatch):
+    import main
+
+    calls = []
+
+    async def fake_post(path, payload, **kwargs):
+        calls.append(kwargs.get("site"))
+        return {"choices": [{"message": {"content": json.dumps({"decision": "reject", "confidence": 0.8})}}]}
+
+    monkeypatch.setattr(main, "mistral_post_async", fake_post)
+    monkeypatch.setattr(main, "LOCAL_CLASSIFIER", main.LocalClassifier(str(tmp_path / "runtime.db")))
+    monkeypatch.setattr(main, "FAST_CLASSIFIER_SHADOW_RATE", 0.0)
+
+    assert await main._is_user_confirmation("m", "Yes, go ahead!", []) == ("approve", 0.97)
+    assert await main._is_user_confirmation("m", "nope", []) == ("reject", 0.97)
+    assert calls == []
+    assert await main._is_user_confirmation("m", "hmm, maybe after lunch", []) == ("reject", 0.8)
+    assert calls == ["gate"]
+
+    assert main._intent_rules("Build me a React app with a login form")[0] == "workflow"
+    assert main._intent_rules("What frameworks should I use?")[0] == "chat"
+    assert main._intent_rules("I was thinking about the colours")[0] is None
+    for text in ["write me a poem about cats", "update me on the progress so far", "change of plans, just tell me a joke",
+                 "add up 2 and 3 for me", "make sense of this error"]:
+        assert main._intent_rules(text)[1] < main.FAST_CLASSIFIER_THRESHOLD, text
+
+    async def ask_llm():
+        return "chat", 0.9, None
+
+    result, source = await main._classify("intent", "fix it", ask_llm, ("chat", 0.5, None))
+    assert source == "llm" and result[0] == "chat"
+    stats = client.get("/api/llm/classifier").json()["stats"]
+    assert stats["gate"]["local"] == 2 and stats["gate"]["llm"] == 1
+    assert stats["intent"]["compared"] == 1 and stats["intent"]["agreement"] == 0.0
+    rows = main.LOCAL_CLASSIFIER._conn().execute("SELECT kind, label, source FROM classifier_log ORDER BY id").fetchall()
+    assert rows[-1] == ("intent", "chat", "llm")
+
+def test_speculative_plan_overlaps_intent_and_is_discarded_on_chat(tmp_path, monkeypatch):
+    import asyncio
+    import main
+
+    message = "I need a landing page, please make it"
+    events, intent_mode = [], {"mode": "workflow", "goal": "landing page"}
+
+    async def fake_post(path, payload, **kwargs):
+        site = kwargs.get("site")
+        events.append(f"{site}:start")
+        if site == "intent":
+            await asyncio.sleep(0.05)
+            events.append("intent:end")
+            return {"choices": [{"message": {"content": json.dumps(
+                {"mode": intent_mode["mode"], "goal": intent_mode["goal"], "confidence": 0.9})}}]}
+        if site == "planner":
+            await asyncio.sleep(0.02 if intent_mode["mode"] == "workflow" else 5)
+            goal = payload["messages"][1]["content"]
+            return {"choices": [{"message": {"content": json.dumps({"steps": [f"write index.html for {goal}"]})}}],
+                    "usage": {"total_tokens": 40}}
+        return {"choices": [{"message": {"content": "sure"}}]}
+
+    monkeypatch.setattr(main, "mistral_post_async", fake_post)
+    monkeypatch.setattr(main, "LOCAL_CLASSIFIER", main.LocalClassifier(str(tmp_path / "runtime.db")))
+    monkeypatch.setattr(main, "SPECULATION_STATS", main.SpeculationStats())
+    body = {"model": "m", "project_id": "spec-test", "speculative_plan": True,
+            "messages": [{"role": "user", "content": message}]}
+
+    # The classifier rewrites the goal, yet the plan made for the user's own words is kept and proposed under them
+    data = client.post("/api/orchestrate", json=body).json()
+    assert data["mode"] == "plan_proposed" and message in data["plan"]["steps"][0]
+    assert data["goal_text"] == message and data["refined_goal"] == "landing page"
+    assert "**Understood as:** landing page" in data["reply"]
+    assert main._load_state("spec-test").proposed_goal == message
+    assert events.index("planner:start") < events.index("intent:end")
+    assert events.count("planner:start") == 1
+    main._save_state("spec-test", main.OrchestratorState())
+
+    intent_mode["mode"] = "chat"
+    assert client.post("/api/orchestrate", json=body).json()["mode"] == "chat"
+    stats = client.get("/api/metrics").json()["speculation"]
+    assert stats == dict(stats, started=2, hits=1, misses=1, cancelled=1)
+    assert stats["wasted_tokens"] > 0  # estimated for the cancelled plan
+
+@pytest.mark.asyncio
+async def test_approved_plan_is_reused_and_plans_are_cached_per_workspace(monkeypatch):
+    import main
+
+    sites, submitted = [], []
+
+    async def fake_post(path, payload, **kwargs):
+        sites.append(kwargs.get("site"))
+        if kwargs.get("site") == "plan_improver":
+            return {"choices": [{"message": {"content": json.dumps({"files": [], "steps": ["improved"]})}}]}
+        return {"choices": [{"message": {"role": "assistant", "content": "done"}}]}
+
+    monkeypatch.setattr(main, "mistral_post_async", fake_post)
+    monkeypatch.setattr(main, "PLAN_CACHE", main._ResponseCache(8, 60))
+    monkeypatch.setattr(main, "FAST_CLASSIFIER_SHADOW_RATE", 0.0)
+    monkeypatch.setattr(main, "_submit_workflow_job", lambda req: submitted.append(req) or "t-approved")
+    plan = {"steps": ["write index.html"], "files_to_create": ["preview/index.html"]}
+    main._save_state("plan-test", main.OrchestratorState(pending_execution=True, proposed_goal="a page", proposed_plan=plan))
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        resp = await ac.post("/api/orchestrate", json={"model": "m", "project_id": "plan-test",
+                                                       "messages": [{"role": "user", "content": "yes"}]})
+    assert resp.json()["mode"] == "workflow_started" and submitted[0].plan == plan
+
+    run = await main._run_workflow(submitted[0], "t-approved")
+    assert sites == ["executor"] and run["plan_source"] == "approved"
+    assert "preview/index.html" in main.read_run("plan-test", "t-approved")["run"]["transcript"][0]["content"]
+
+    req = main.WorkflowRequest(model="m", goal="cache me", project_id="plan-test", enable_postprocess=False)
+    sources = [(await main._run_workflow(req, f"t-cache-{i}"))["plan_source"] for i in range(2)]
+    assert sources == ["generated", "cache"] and sites.count("plan_improver") == 1
+
+    assert main.tool_create_file("plan-test", "preview/notes.txt", "changed")["ok"]
+    assert (await main._run_workflow(req, "t-cache-2"))["plan_source"] == "generated"